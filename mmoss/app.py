@@ -17,6 +17,8 @@ import logging
 import platform
 from mmoss.server import Server
 from mmoss.network import *
+from mmoss.tickengine import OVERRUNPOLICIES, OVERRUN_SKIP
+from mmoss.bot import BEHAVIOURS, loadBehaviour, runBots
 
 
 __author__ = "Eric Dennison"
@@ -63,6 +65,28 @@ class MMOSSApp(object):
                             help='run mMOSS as a server')
         parser.add_argument('--log','-l', action='store_true', 
                             help='log mMOSS events')
+        parser.add_argument('--tick-rate','-t', metavar='RATE', type=float,
+                            default=1.0/POLL_RATE,
+                            help='server poll cycle rate (Hz)')
+        parser.add_argument('--overrun-policy', metavar='POLICY', 
+                            choices=OVERRUNPOLICIES, default=OVERRUN_SKIP,
+                            help='server handling of overrun poll cycles: '
+                                 +', '.join(OVERRUNPOLICIES))
+        parser.add_argument('--profile', action='store_true', 
+                            help='time server poll cycle phases')
+        parser.add_argument('--udp', action='store_true',
+                            help='receive object updates by UDP datagram')
+        parser.add_argument('--udp-loss', metavar='FRACTION', type=float,
+                            default=0.0,
+                            help='drop this fraction of received datagrams '
+                                 '(to simulate a lossy network)')
+        parser.add_argument('--bots', metavar='COUNT', type=int, default=0,
+                            help='run COUNT headless bot players instead of '
+                                 'the interactive client')
+        parser.add_argument('--bot-behaviour', metavar='BEHAVIOUR', 
+                            type=str, default='random',
+                            help='bot behaviour: '+', '.join(BEHAVIOURS)+
+                                 ' or module.Class')
         self.parser = parser
 
 
@@ -79,8 +103,20 @@ class MMOSSApp(object):
                 logging.basicConfig(filename=SERVER_LOG_FILENAME,
                     level=logging.DEBUG)
             s = Server(self.args.port, 
-                (self.args.width,self.args.height), 0.005)
+                (self.args.width,self.args.height), 0.005,
+                1.0/self.args.tick_rate, self.args.overrun_policy,
+                self.args.profile)
             s.run()
+        elif self.args.bots:
+            if self.args.log:
+                logging.basicConfig(filename=CLIENT_LOG_FILENAME,
+                    level=logging.DEBUG)
+            try:
+                behaviour = loadBehaviour(self.args.bot_behaviour)
+            except ValueError as error:
+                self.parser.error(str(error))
+            runBots(self.args.server_address, self.args.port, 
+                self.args.bots, 1.0/self.args.refresh_rate, behaviour)
         else:
             if self.args.log:
                 logging.basicConfig(filename=CLIENT_LOG_FILENAME,
@@ -0,0 +1,955 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Performance benchmarks for the server hot path: the server poll cycle
+against object population, microbenchmarks of the physics in mmoss.utility
+on realistic object populations, the size and speed of object state
+encodings, the cost of answered versus fire-and-forget server events, the
+cost of sending the same events to many clients, client object 
+construction by the MMOSSFactory, the client screen update bookkeeping 
+(culling and dirty rectangle merging) against object population and the
+update delay of world snapshots sent over TCP or by UDP datagram on a
+simulated lossy network. Run from the top level directory with:
+
+    python -m mmoss.benchmark
+
+Save the results and check later runs against them with:
+
+    python -m mmoss.benchmark --output baseline.json
+    python -m mmoss.benchmark --baseline baseline.json
+
+A run that is slower than the baseline by more than the tolerance on any
+benchmark exits with a nonzero status.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+from __future__ import division
+import sys
+import time
+import math
+import random
+import json
+import argparse
+import heapq
+import pygame
+from numpy import array
+from twisted.protocols import amp
+from twisted.test.proto_helpers import StringTransport
+from mmoss.server import Server
+from mmoss.network import ServerObjectStateEvent, ServerObjectDropEvent
+from mmoss.encoding import encodeStates, decodeStates, gatherStates
+from mmoss.encoding import DeltaEncoder, DeltaDecoder
+from mmoss.datagram import DATAGRAMRECORDS, DATAGRAMSIZE
+from mmoss.datagram import packSnapshot, unpackSnapshot
+from mmoss.outbound import MessageCache
+from mmoss.parametric import Parametric
+from mmoss.render import onScreen, mergeRects
+from mmoss.utility import MMOSSAsteroid, MMOSSBullet, MMOSSShip
+from mmoss.utility import MMOSSFactory, MMOSSObject
+from mmoss.utility import MAXASTEROIDRADIUS
+
+__author__ = "Eric Dennison"
+
+OBJECTCOUNTS = [50, 100, 200, 400, 800]
+"""Object populations to time the server poll cycle against."""
+
+DENSITY = 0.005
+"""Asteroid density (same as the default server)."""
+
+BULLETFRACTION = 0.1
+"""Number of live bullets as a fraction of the asteroid count."""
+
+REPEAT = 20
+"""Number of poll cycles to average over."""
+
+POPULATION = 400
+"""Number of asteroids in the physics microbenchmark population."""
+
+SHIPFRACTION = 0.05
+"""Number of ships as a fraction of the asteroid count."""
+
+PASSES = 5
+"""Number of passes over the population for each physics benchmark (the
+fastest pass is reported)."""
+
+EVENTS = 10000
+"""Number of server events sent in the event answer benchmark."""
+
+BUILDS = 5000
+"""Number of objects built in the factory benchmark."""
+
+CLIENTS = [1, 10, 50]
+"""Numbers of connected clients in the event fan out benchmark."""
+
+SCREENSIZE = (800, 600)
+"""Client screen size in the render benchmark."""
+
+TICKS = 1000
+"""Number of server ticks in the datagram benchmark."""
+
+TICKTIME = 0.02
+"""Seconds between server ticks in the datagram benchmark."""
+
+CHANGEFRACTION = 0.1
+"""Fraction of the objects that change each tick in the datagram benchmark."""
+
+LOSS = 0.02
+"""Simulated packet loss in the datagram benchmark."""
+
+LATENCY = 0.05
+"""Simulated one way network latency (seconds)."""
+
+JITTER = 0.005
+"""Simulated variation in network latency (seconds)."""
+
+RETRANSMIT = 0.2
+"""Time for TCP to retransmit a lost packet (seconds; the minimum TCP
+retransmission timeout)."""
+
+TOLERANCE = 0.25
+"""Fractional slowdown against the baseline that counts as a regression."""
+
+
+def buildServer(count):
+    """Create a server populated with a realistic field of asteroids and
+    bullets. The field size grows with the object count so that the
+    asteroid density stays constant.
+
+    Arguments:
+    count - Number of asteroids.
+    Returns a Server instance.
+    """
+    meanarea = math.pi*((10+MAXASTEROIDRADIUS/5)/2)**2
+    side = int(math.sqrt(count*meanarea/DENSITY))
+    server = Server(0, (side,side), 0.0)
+    for i in range(count):
+        newid = server.getNewID()
+        server.asteroidlist[newid] = MMOSSAsteroid(
+            objectid=newid,
+            gamedimensions=server.gamedimensions,
+            x=random.uniform(0,side),
+            y=random.uniform(0,side),
+            vx=random.uniform(-20,20),
+            vy=random.uniform(-20,20),
+            rr=random.random()-0.5,
+            radius=random.randint(10,int(MAXASTEROIDRADIUS/5)))
+        server.world.attach(server.asteroidlist[newid])
+    for i in range(int(count*BULLETFRACTION)):
+        newid = server.getNewID()
+        bullet = MMOSSBullet(
+            objectid=newid,
+            gamedimensions=server.gamedimensions,
+            x=random.uniform(0,side),
+            y=random.uniform(0,side),
+            azimuth=random.uniform(0,2*math.pi),
+            velocity=random.uniform(20,120))
+        bullet.shooterid = 0
+        bullet.away = True
+        server.world.attach(bullet)
+        server.bulletlist[newid] = bullet
+    return server
+
+
+def benchServerPoll(counts=OBJECTCOUNTS, repeat=REPEAT):
+    """Time the server poll cycle against object population.
+
+    Arguments:
+    counts - List of asteroid counts to try.
+    repeat - Number of poll cycles to average.
+    Returns list of (object count, seconds per tick) tuples.
+    """
+    results = []
+    for count in counts:
+        server = buildServer(count)
+        server.tickengine.stop()
+        objects = len(server.asteroidlist)+len(server.bulletlist)
+        elapsed = 0.0
+        for i in range(repeat):
+            start = time.time()
+            server.serverPoll()
+            elapsed = elapsed + time.time() - start
+        results.append((objects, elapsed/repeat))
+    return results
+
+
+def buildPopulation(count):
+    """Create a stand-alone field of asteroids, ships and bullets (not
+    attached to a WorldState) at the same density as buildServer, with
+    positions cached for the current time.
+
+    Arguments:
+    count - Number of asteroids.
+    Returns tuple of (asteroid list, ship list, bullet list).
+    """
+    meanarea = math.pi*((10+MAXASTEROIDRADIUS/5)/2)**2
+    side = int(math.sqrt(count*meanarea/DENSITY))
+    gamedimensions = array([side,side])
+    now = time.time()
+    asteroids = [MMOSSAsteroid(
+        gamedimensions=gamedimensions,
+        timestamp=now-random.uniform(0,1),
+        x=random.uniform(0,side),
+        y=random.uniform(0,side),
+        vx=random.uniform(-20,20),
+        vy=random.uniform(-20,20),
+        rr=random.random()-0.5,
+        radius=random.randint(10,int(MAXASTEROIDRADIUS/5)))
+        for i in range(count)]
+    ships = []
+    for i in range(max(1,int(count*SHIPFRACTION))):
+        ship = MMOSSShip(
+            gamedimensions=gamedimensions,
+            timestamp=now-random.uniform(0,1),
+            x=random.uniform(0,side),
+            y=random.uniform(0,side),
+            vx=random.uniform(-20,20),
+            vy=random.uniform(-20,20),
+            r=random.uniform(0,2*math.pi))
+        # half of the ships are maneuvering
+        ship.processCommand(ship.timestamp, random.choice([0.0,100.0]),
+            random.choice([0.0,0.0,100.0]), 0.0, 0.0)
+        ships.append(ship)
+    bullets = [MMOSSBullet(
+        gamedimensions=gamedimensions,
+        timestamp=now-random.uniform(0,1),
+        x=random.uniform(0,side),
+        y=random.uniform(0,side),
+        azimuth=random.uniform(0,2*math.pi),
+        velocity=random.uniform(20,120))
+        for i in range(int(count*BULLETFRACTION))]
+    for bullet in bullets:
+        bullet.shooterid = 0
+        bullet.away = True
+    for obj in asteroids+ships+bullets:
+        obj.cachePosition(now-obj.timestamp)
+    return asteroids, ships, bullets
+
+
+def touchingPair(first, second):
+    """Move a solid to just inside collision range of another, approaching
+    it, and cache both positions.
+
+    Arguments:
+    first - Reference to an MMOSSSolid (left in place).
+    second - Reference to an MMOSSSolid (moved).
+    """
+    azimuth = random.uniform(0,2*math.pi)
+    direction = array([math.cos(azimuth), math.sin(azimuth)])
+    second.timestamp = first.timestamp
+    second.X = first.X + direction*(first.radius+second.radius-0.5)
+    second.V = first.V - direction*random.uniform(5,40)
+    first.cachePosition(0.0)
+    second.cachePosition(0.0)
+    second.Xclosest = second.Xcache
+
+
+def physicsBenchmarks(count=POPULATION):
+    """Build the physics microbenchmarks.
+
+    Arguments:
+    count - Number of asteroids in the population.
+    Returns list of (name, operations per pass, function that runs one
+    pass) tuples.
+    """
+    asteroids, ships, bullets = buildPopulation(count)
+    solids = asteroids+ships
+    everything = solids+bullets
+    now = time.time()
+    deltas = [(obj, now-obj.timestamp) for obj in everything]
+    # random solid/other pairs, most of them far apart
+    pairs = [(random.choice(solids), random.choice(everything))
+        for i in range(len(everything))]
+    pairs = [(first, second) for first, second in pairs if first is not second]
+    # pairs that are in contact: one for every ship and one for every
+    # tenth asteroid
+    contacts = []
+    for first in ships+asteroids[:len(asteroids)//10]:
+        second = MMOSSAsteroid(
+            gamedimensions=first.gamedimensions,
+            radius=random.randint(10,int(MAXASTEROIDRADIUS/5)))
+        touchingPair(first, second)
+        contacts.append((first, second))
+    # the collision changes both objects, so each call starts from a copy
+    # of the original states
+    collisions = []
+    for first, second in contacts:
+        firstcopy = type(first)(gamedimensions=first.gamedimensions,
+            radius=first.radius)
+        secondcopy = MMOSSAsteroid(gamedimensions=second.gamedimensions,
+            radius=second.radius)
+        firstcopy.copyDynamics(first)
+        secondcopy.copyDynamics(second)
+        collisions.append((first, second, firstcopy, secondcopy))
+    # a stream of commands for every ship
+    commands = [(ship, [(random.choice([0.0,100.0,-20.0]),
+        random.choice([0.0,0.0,0.0,100.0,-100.0]), 50.0,
+        random.choice([0.0,0.0,0.0,3.0])) for i in range(10)])
+        for ship in ships]
+    parametrics = [(Parametric(first.X, first.V),
+        Parametric(second.Xclosest, second.V),
+        first.radius+second.radius) for first, second in contacts] + \
+        [(Parametric(first.Xcache, first.V), Parametric(second.Xcache,
+        second.V), first.radius+second.radius) for first, second in pairs
+        if second.radius]
+
+    def forecastPosition():
+        for obj, deltat in deltas:
+            obj.forecastPosition(deltat)
+
+    def forecastRates():
+        for obj, deltat in deltas:
+            obj.forecastRates(deltat)
+
+    def insideCollisionDistance():
+        for first, second in pairs:
+            first.insideCollisionDistance(second)
+
+    def checkCollision():
+        for first, second in pairs+contacts:
+            first.checkCollision(second)
+
+    def processSolidCollision():
+        for first, second, firstcopy, secondcopy in collisions:
+            first.copyDynamics(firstcopy)
+            second.copyDynamics(secondcopy)
+            second.Xclosest = secondcopy.X
+            first.processSolidCollision(first.timestamp, second)
+
+    def processCommand():
+        for ship, shipcommands in commands:
+            servertime = ship.timestamp
+            for thrust, ccwthrust, shootv, shoote in shipcommands:
+                servertime = servertime + 0.05
+                ship.processCommand(servertime, thrust, ccwthrust, shootv,
+                    shoote)
+
+    def forecastFuel():
+        for ship, deltat in deltas[len(asteroids):len(solids)]:
+            ship.forecastFuel(deltat)
+
+    def timeatdistance():
+        for first, second, d in parametrics:
+            first.timeatdistance(second, d)
+
+    # client side handling of object state updates
+    factory = MMOSSFactory()
+    updates = [(obj, obj.OBJECTTYPE, obj.timestamp, obj.X[0], obj.X[1],
+        obj.V[0], obj.V[1], obj.a, obj.r, obj.rr) for obj in everything]
+
+    def buildObject():
+        for obj, objecttype, t, x, y, vx, vy, a, r, rr in updates:
+            factory.buildObject(objectid=obj.objectid, displayable=False,
+                gamedimensions=obj.gamedimensions, objecttype=objecttype,
+                timestamp=t, x=x, y=y, vx=vx, vy=vy, a=a, r=r, rr=rr)
+
+    def setDynamics():
+        for obj, objecttype, t, x, y, vx, vy, a, r, rr in updates:
+            obj.setDynamics(t, x, y, vx, vy, a, r, rr)
+
+    return [('forecastPosition', len(deltas), forecastPosition),
+        ('forecastRates', len(deltas), forecastRates),
+        ('insideCollisionDistance', len(pairs), insideCollisionDistance),
+        ('checkCollision', len(pairs)+len(contacts), checkCollision),
+        ('processSolidCollision', len(collisions), processSolidCollision),
+        ('processCommand', sum(len(c) for s, c in commands), processCommand),
+        ('forecastFuel', len(ships), forecastFuel),
+        ('timeatdistance', len(parametrics), timeatdistance),
+        ('buildObject', len(updates), buildObject),
+        ('setDynamics', len(updates), setDynamics)]
+
+
+def benchPhysics(count=POPULATION, passes=PASSES):
+    """Time the physics microbenchmarks.
+
+    Arguments:
+    count - Number of asteroids in the population.
+    passes - Number of passes over the population (fastest is kept).
+    Returns list of (name, seconds per operation) tuples.
+    """
+    results = []
+    for name, operations, function in physicsBenchmarks(count):
+        best = 1E3000
+        for i in range(passes):
+            start = time.time()
+            function()
+            best = min(best, time.time() - start)
+        results.append((name, best/operations))
+    return results
+
+
+def benchEncoding(count=POPULATION, passes=PASSES):
+    """Compare one ServerObjectStateEvent AMP box per object against the
+    packed binary encoding of the whole batch, for a server population.
+
+    Arguments:
+    count - Number of asteroids in the population.
+    passes - Number of encode/decode passes (fastest is kept).
+    Returns list of (name, value) tuples: bytes per update and seconds per
+    update to encode and to decode, for each encoding.
+    """
+    server = buildServer(count)
+    server.tickengine.stop()
+    objects = server.asteroidlist.values()+server.bulletlist.values()
+    updates = len(objects)
+
+    def ampEncode():
+        return "".join([ServerObjectStateEvent.makeArguments({
+            'objectid':obj.objectid,
+            'objecttype':obj.OBJECTTYPE,
+            'objectname':obj.objectname,
+            'eventtime':obj.timestamp,
+            'x':obj.X[0],
+            'y':obj.X[1],
+            'vx':obj.V[0],
+            'vy':obj.V[1],
+            'a':obj.a,
+            'r':obj.r,
+            'rr':obj.rr}, None).serialize() for obj in objects])
+
+    def ampDecode(data):
+        return [ServerObjectStateEvent.parseArguments(box, None)
+            for box in amp.parseString(data)]
+
+    def binaryEncode():
+        return encodeStates(objects)
+
+    def binaryDecode(encoded):
+        return decodeStates(*encoded)
+
+    def best(function, *args):
+        fastest = 1E3000
+        for i in range(passes):
+            start = time.time()
+            function(*args)
+            fastest = min(fastest, time.time() - start)
+        return fastest/updates
+
+    def deltaEncode(encoder, ids, states):
+        sequence, basetime, data = encoder.encode(ids, states)
+        encoder.ack(sequence)
+        return sequence, basetime, data
+
+    def deltaDecode(encoded):
+        # a fresh decoder, so that the sequence is always new
+        decoder = DeltaDecoder()
+        decoder.states = dict(baselines)
+        return decoder.decode(*encoded)
+
+    ampdata = ampEncode()
+    binary = binaryEncode()
+    # delta snapshot of a busy tick: a tenth of the objects collided
+    encoder = DeltaEncoder()
+    decoder = DeltaDecoder()
+    ids, states = gatherStates(objects)
+    full = deltaEncode(encoder, ids, states)
+    records, missing = decoder.decode(*full)
+    if len(records) != updates or missing:
+        raise RuntimeError("delta snapshot decoded %d of %d objects"
+            % (len(records), updates))
+    baselines = decoder.states
+    changed = states.copy()
+    for name in ['time','x','y','vx','vy']:
+        changed[name][::10] += 1.0
+    delta = encoder.encode(ids, changed)
+    return [('amp.bytes', len(ampdata)/updates),
+        ('amp.encode', best(ampEncode)),
+        ('amp.decode', best(ampDecode, ampdata)),
+        ('binary.bytes', len(binary[1])/updates),
+        ('binary.encode', best(binaryEncode)),
+        ('binary.decode', best(binaryDecode, binary)),
+        ('delta.fullbytes', len(full[2])/updates),
+        ('delta.bytes', len(delta[2])/updates),
+        ('delta.encode', best(encoder.encode, ids, changed)),
+        ('delta.decode', best(deltaDecode, delta))]
+
+
+class AnsweredDropEvent(ServerObjectDropEvent):
+    """ServerObjectDropEvent as it was before server events stopped asking
+    for an answer."""
+    commandName = ServerObjectDropEvent.commandName
+    requiresAnswer = True
+    response = [('result', amp.Integer())]
+
+
+class AnsweringReceiver(amp.AMP):
+    """Client end that answers every drop event."""
+
+    def objectDropEvent(self, objectid, eventtime):
+        return {'result':1}
+
+    AnsweredDropEvent.responder(objectDropEvent)
+
+
+class SilentReceiver(amp.AMP):
+    """Client end for drop events that need no answer."""
+
+    def objectDropEvent(self, objectid, eventtime):
+        return {}
+
+    ServerObjectDropEvent.responder(objectDropEvent)
+
+
+def benchAnswers(count=EVENTS):
+    """Send a burst of drop events over an in-memory connection, with and 
+    without answers, and account for the traffic and Deferreds involved.
+
+    Arguments:
+    count - Number of events.
+    Returns list of (name, value) tuples: downstream and upstream bytes per
+    event, Deferreds created per event and seconds per event (send, receive
+    and process answers) for each variant.
+    """
+    results = []
+    for variant, command, receiverclass in [
+        ('answered', AnsweredDropEvent, AnsweringReceiver),
+        ('unanswered', ServerObjectDropEvent, SilentReceiver)]:
+        sender = amp.AMP()
+        sender.makeConnection(StringTransport())
+        receiver = receiverclass()
+        receiver.makeConnection(StringTransport())
+        now = time.time()
+        start = time.time()
+        deferreds = [sender.callRemote(command, objectid=i, eventtime=now)
+            for i in range(count)]
+        downstream = sender.transport.value()
+        receiver.dataReceived(downstream)
+        upstream = receiver.transport.value()
+        sender.dataReceived(upstream)
+        elapsed = time.time() - start
+        created = len([d for d in deferreds if not d is None])
+        results.extend([('%s.downbytes' % variant, len(downstream)/count),
+            ('%s.upbytes' % variant, len(upstream)/count),
+            ('%s.deferreds' % variant, created/count),
+            ('%s.seconds' % variant, elapsed/count)])
+    return results
+
+
+def benchFanout(count=EVENTS//10, clients=CLIENTS):
+    """Send a burst of drop events to every one of a number of clients, 
+    serialized per client by callRemote and encoded once with a 
+    MessageCache.
+
+    Arguments:
+    count - Number of events.
+    clients - List of client counts to try.
+    Returns list of (name, value) tuples: seconds per event for each
+    client count and method.
+    """
+    results = []
+    now = time.time()
+    for clientcount in clients:
+        senders = []
+        for i in range(clientcount):
+            sender = amp.AMP()
+            sender.makeConnection(StringTransport())
+            senders.append(sender)
+        start = time.time()
+        for objectid in range(count):
+            for sender in senders:
+                sender.callRemote(ServerObjectDropEvent, objectid=objectid,
+                    eventtime=now)
+        results.append(('callremote.%d' % clientcount, 
+            (time.time() - start)/count))
+        cache = MessageCache()
+        start = time.time()
+        for objectid in range(count):
+            for sender in senders:
+                sender.transport.write(cache.encode(ServerObjectDropEvent,
+                    (objectid, now), objectid=objectid, eventtime=now))
+        results.append(('cached.%d' % clientcount, 
+            (time.time() - start)/count))
+    return results
+
+
+class LinearFactory(MMOSSFactory):
+    """MMOSSFactory as it was before the type registry: class lists found 
+    with dir() for every factory and a linear scan for every build."""
+
+    def __init__(self):
+        self.notdisplayableclasses = self.getUsableSubclasses(
+            MMOSSObject, False)
+        self.displayableclasses = self.getUsableSubclasses(
+            MMOSSObject, True)
+
+    def getUsableSubclasses(self, parent, displayable):
+        usable = []
+        for cls in parent.__subclasses__():
+            if "OBJECTTYPE" not in dir(cls) or (
+            displayable and ("displayObject" not in dir(cls))):
+                usable.extend(self.getUsableSubclasses(cls, displayable))
+            else:
+                usable.append(cls)
+        return usable
+
+    def buildObject(self, *args, **kwargs):
+        objecttype = kwargs.pop('objecttype', '')
+        displayable = kwargs.pop('displayable', False)
+        if displayable:
+            classes = self.displayableclasses
+        else:
+            classes = self.notdisplayableclasses
+        for cls in classes:
+            if cls.OBJECTTYPE == objecttype:
+                return cls(*args, **kwargs)
+
+
+def benchFactory(count=BUILDS, passes=PASSES):
+    """Time creating a factory and building objects from state updates,
+    with the linear scan factory and the registry factory.
+
+    Arguments:
+    count - Number of objects to build.
+    passes - Number of passes (fastest is kept).
+    Returns list of (name, seconds) tuples: seconds per factory created and
+    per object built.
+    """
+    now = time.time()
+    kinds = [MMOSSAsteroid.OBJECTTYPE]*8 + [MMOSSBullet.OBJECTTYPE]*2
+    updates = [(i+1, random.choice(kinds), now, random.uniform(0,1000),
+        random.uniform(0,1000), random.uniform(-50,50), 
+        random.uniform(-50,50), 0.0, random.uniform(0,6), 0.0) 
+        for i in range(count)]
+
+    def best(function, operations):
+        fastest = 1E3000
+        for i in range(passes):
+            start = time.time()
+            function()
+            fastest = min(fastest, time.time() - start)
+        return fastest/operations
+
+    def create(factoryclass):
+        return lambda: [factoryclass() for i in range(100)]
+
+    def build(factory):
+        def run():
+            for objectid, objecttype, t, x, y, vx, vy, a, r, rr in updates:
+                factory.buildObject(objectid=objectid, displayable=False,
+                    objecttype=objecttype, timestamp=t, x=x, y=y, vx=vx, 
+                    vy=vy, a=a, r=r, rr=rr)
+        return run
+
+    def buildState(factory):
+        def run():
+            for objectid, objecttype, t, x, y, vx, vy, a, r, rr in updates:
+                factory.buildState(objecttype, False, objectid, t, x, y, vx,
+                    vy, a, r, rr)
+        return run
+
+    return [('linear.create', best(create(LinearFactory), 100)),
+        ('registry.create', best(create(MMOSSFactory), 100)),
+        ('linear.build', best(build(LinearFactory()), count)),
+        ('registry.build', best(build(MMOSSFactory()), count)),
+        ('registry.buildState', best(buildState(MMOSSFactory()), count))]
+
+
+def benchRender(counts=OBJECTCOUNTS, passes=PASSES):
+    """Time the client screen update bookkeeping for one frame against 
+    object population: the list of changed rectangles handed to 
+    pygame.display.update when every object is drawn, and when objects off
+    the screen are culled and the rectangles merged. Drawing itself is not
+    timed (it needs a display); culled objects are not drawn at all.
+
+    Arguments:
+    counts - List of asteroid counts to try (the field grows with the count).
+    passes - Number of passes (fastest is kept).
+    Returns list of (object count, seconds for all objects, seconds culled
+    and merged, rectangles for all objects, rectangles culled and merged)
+    tuples.
+    """
+    width, height = SCREENSIZE
+    results = []
+    for count in counts:
+        asteroids, ships, bullets = buildPopulation(count)
+        objects = asteroids+ships+bullets
+        gx, gy = objects[0].gamedimensions
+        sx, sy = random.uniform(0,gx), random.uniform(0,gy)
+        area = pygame.Rect(0, 0, width, height)
+
+        def rectangle(obj, x, y):
+            size = 2*max(obj.radius, 2)
+            return pygame.Rect(int(x)-size//2, int(y)-size//2, size, size)
+
+        def every():
+            rects = []
+            for obj in objects:
+                x, y = (obj.X[0]-sx)%gx, (sy-obj.X[1])%gy
+                rects.append(area.clip(rectangle(obj, x, y)))
+            return rects
+
+        def culled():
+            rects = []
+            for obj in objects:
+                x, y = (obj.X[0]-sx)%gx, (sy-obj.X[1])%gy
+                if onScreen(x, y, obj.radius, width, height, (gx,gy)):
+                    rects.append(rectangle(obj, x, y))
+            return mergeRects(rects, area) or [area]
+
+        def best(function):
+            fastest = 1E3000
+            for i in range(passes):
+                start = time.time()
+                rects = function()
+                fastest = min(fastest, time.time() - start)
+            return fastest, len(rects)
+
+        allseconds, allrects = best(every)
+        culledseconds, culledrects = best(culled)
+        results.append((len(objects), allseconds, culledseconds, allrects,
+            culledrects))
+    return results
+
+
+def benchDatagrams(count=POPULATION, loss=LOSS, ticks=TICKS):
+    """Send the world snapshots of a server population over a simulated
+    lossy network, in order over TCP and as UDP datagrams, and measure the
+    delay between an object changing on the server and the client applying
+    the change. A lost TCP packet holds up everything behind it until it
+    is retransmitted. A lost datagram only delays the objects in it, which
+    are sent again once the client acknowledges a later snapshot (or the
+    acknowledgement window passes).
+
+    Arguments:
+    count - Number of asteroids in the population.
+    loss - Fraction of packets lost.
+    ticks - Number of server ticks to simulate.
+    Returns list of (name, value) tuples: median and 99th percentile update
+    delay (seconds) for each transport, and for datagrams the fraction of
+    datagrams discarded out of order and the objects sent again per tick.
+    """
+    server = buildServer(count)
+    server.tickengine.stop()
+    objects = server.asteroidlist.values()+server.bulletlist.values()
+    changes = [random.sample(objects, int(len(objects)*CHANGEFRACTION))
+        for tick in range(ticks)]
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values)-1, int(p*len(values)))]
+
+    def changeObjects(tick, changed, pending):
+        now = tick*TICKTIME
+        for obj in changes[tick]:
+            obj.timestamp = now
+            changed.setdefault(obj.objectid, now)
+            pending[obj.objectid] = obj
+        return now
+
+    def applyRecords(records, arrival, changed, delays):
+        for record in records:
+            objectid, eventtime = record[0], record[2]
+            # event times travel as offsets from the base time
+            if objectid in changed and eventtime > changed[objectid] - 1E-3:
+                delays.append(arrival - changed.pop(objectid))
+
+    # TCP: snapshots arrive complete and in order
+    encoder = DeltaEncoder()
+    decoder = DeltaDecoder()
+    changed = {}
+    delays = []
+    lastarrival = 0.0
+    for tick in range(ticks):
+        pending = {}
+        now = changeObjects(tick, changed, pending)
+        sequence, basetime, data = encoder.encode(*gatherStates(
+            pending.values()))
+        encoder.ack(sequence)
+        arrival = now + LATENCY + random.uniform(0, JITTER)
+        for segment in range(int(math.ceil(len(data)/DATAGRAMSIZE))):
+            while random.random() < loss:
+                arrival = arrival + RETRANSMIT
+        # head of line blocking
+        lastarrival = max(lastarrival, arrival)
+        applyRecords(decoder.decode(sequence, basetime, data)[0], 
+            lastarrival, changed, delays)
+    results = [('tcp.p50', percentile(delays, 0.50)),
+        ('tcp.p99', percentile(delays, 0.99))]
+
+    # UDP: snapshots may be lost or reordered, acknowledgements come back
+    # over TCP
+    encoder = DeltaEncoder()
+    decoder = DeltaDecoder()
+    changed = {}
+    delays = []
+    pending = {}
+    inflight = []
+    sent = discarded = resent = 0
+    for tick in range(ticks):
+        now = tick*TICKTIME
+        while inflight and inflight[0][0] <= now:
+            arrival, datagram, sequence, missing = heapq.heappop(inflight)
+            if datagram is None:
+                skipped = encoder.ack(sequence, missing)
+                resent = resent + len(skipped)
+                for objectid in skipped:
+                    obj = server.asteroidlist.get(objectid) or \
+                        server.bulletlist[objectid]
+                    pending[objectid] = obj
+                continue
+            sequence, sendtime, basetime, data = unpackSnapshot(datagram)
+            decoded = decoder.decode(sequence, basetime, data)
+            if decoded is None:
+                discarded = discarded + 1
+                continue
+            records, missing = decoded
+            applyRecords(records, arrival, changed, delays)
+            heapq.heappush(inflight, (arrival + LATENCY, None, sequence, 
+                missing))
+        expired = encoder.expire(now)
+        resent = resent + len(expired)
+        for objectid in expired:
+            obj = server.asteroidlist.get(objectid) or \
+                server.bulletlist[objectid]
+            pending[objectid] = obj
+        changeObjects(tick, changed, pending)
+        ids, states = gatherStates(pending.values())
+        pending = {}
+        for start in range(0, len(ids), DATAGRAMRECORDS):
+            sequence, basetime, data = encoder.encode(
+                ids[start:start+DATAGRAMRECORDS], 
+                states[start:start+DATAGRAMRECORDS], now)
+            sent = sent + 1
+            if random.random() >= loss:
+                heapq.heappush(inflight, (now + LATENCY + 
+                    random.uniform(0, JITTER), 
+                    packSnapshot(sequence, now, basetime, data), sequence, 
+                    ()))
+    results.extend([('udp.p50', percentile(delays, 0.50)),
+        ('udp.p99', percentile(delays, 0.99)),
+        ('udp.discarded', discarded/sent),
+        ('udp.resent', resent/ticks)])
+    return results
+
+
+def compareBaseline(results, baseline, tolerance=TOLERANCE):
+    """Compare benchmark results against a baseline.
+
+    Arguments:
+    results - Dictionary of benchmark name: seconds.
+    baseline - Dictionary of benchmark name: seconds.
+    tolerance - Fractional slowdown that counts as a regression.
+    Returns list of (name, baseline seconds, seconds, ratio, True if
+    regressed) tuples for the benchmarks found in both.
+    """
+    comparison = []
+    for name in sorted(results):
+        if name in baseline and baseline[name] > 0:
+            ratio = results[name]/baseline[name]
+            comparison.append((name, baseline[name], results[name], ratio,
+                ratio > 1.0 + tolerance))
+    return comparison
+
+
+def main(argv=None):
+    """Run the benchmarks and report the results. Returns the process exit
+    status: 1 if any benchmark regressed against the baseline."""
+    parser = argparse.ArgumentParser(description='mMOSS benchmarks.')
+    parser.add_argument('--repeat','-r', metavar='REPEAT', type=int,
+                        default=REPEAT, help='poll cycles to average')
+    parser.add_argument('--suite', choices=['all','poll','physics',
+                        'encoding','answers','fanout','factory',
+                        'render','datagram'],
+                        default='all', help='benchmarks to run')
+    parser.add_argument('--population', metavar='COUNT', type=int,
+                        default=POPULATION, 
+                        help='asteroids in the physics population')
+    parser.add_argument('--output','-o', metavar='FILE', type=str,
+                        help='save the results as JSON')
+    parser.add_argument('--baseline','-b', metavar='FILE', type=str,
+                        help='compare against results saved with --output')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float,
+                        default=TOLERANCE, 
+                        help='slowdown against the baseline that fails')
+    parser.add_argument('--udp-loss', metavar='FRACTION', type=float,
+                        default=LOSS, 
+                        help='packet loss simulated in the datagram suite')
+    args = parser.parse_args(argv)
+    random.seed(1)
+    results = {}
+    if args.suite in ['all','poll']:
+        print("server poll tick time versus object count")
+        print("%10s %12s" % ("objects", "ms/tick"))
+        for objects, tick in benchServerPoll(repeat=args.repeat):
+            print("%10d %12.3f" % (objects, tick*1000))
+            results["serverPoll.%d" % objects] = tick
+    if args.suite in ['all','physics']:
+        print("physics time per operation")
+        print("%24s %12s" % ("benchmark", "us/op"))
+        for name, seconds in benchPhysics(args.population):
+            print("%24s %12.3f" % (name, seconds*1E6))
+            results[name] = seconds
+    if args.suite in ['all','encoding']:
+        print("object state encoding per update")
+        print("%24s %12s" % ("benchmark", "bytes or us"))
+        for name, value in benchEncoding(args.population):
+            if name.endswith('.bytes'):
+                print("%24s %12.1f" % (name, value))
+            else:
+                print("%24s %12.3f" % (name, value*1E6))
+            results["encoding.%s" % name] = value
+    if args.suite in ['all','answers']:
+        print("server events with and without answers, per event")
+        print("%24s %12s" % ("benchmark", "value"))
+        for name, value in benchAnswers():
+            if name.endswith('.seconds'):
+                print("%24s %12.3f us" % (name, value*1E6))
+            else:
+                print("%24s %12.3f" % (name, value))
+            results["answers.%s" % name] = value
+    if args.suite in ['all','fanout']:
+        print("drop event sent to every client, per event")
+        print("%24s %12s" % ("benchmark", "us/event"))
+        for name, seconds in benchFanout():
+            print("%24s %12.3f" % (name, seconds*1E6))
+            results["fanout.%s" % name] = seconds
+    if args.suite in ['all','factory']:
+        print("client object factory")
+        print("%24s %12s %12s" % ("benchmark", "us/op", "ops/s"))
+        for name, seconds in benchFactory():
+            print("%24s %12.3f %12.0f" % (name, seconds*1E6, 
+                1/seconds if seconds else 0))
+            results["factory.%s" % name] = seconds
+    if args.suite in ['all','render']:
+        print("client screen update bookkeeping per frame")
+        print("%10s %12s %12s %10s %10s" % ("objects", "all us", 
+            "culled us", "all rects", "rects"))
+        for objects, every, culled, everyrects, culledrects in benchRender():
+            print("%10d %12.3f %12.3f %10d %10d" % (objects, every*1E6,
+                culled*1E6, everyrects, culledrects))
+            results["render.%d.all" % objects] = every
+            results["render.%d.culled" % objects] = culled
+    if args.suite in ['all','datagram']:
+        print("world snapshot update delay at %.1f%% packet loss" % 
+            (args.udp_loss*100))
+        print("%24s %12s" % ("benchmark", "value"))
+        for name, value in benchDatagrams(args.population, args.udp_loss):
+            if name.endswith(('.p50','.p99')):
+                print("%24s %12.1f ms" % (name, value*1000))
+            else:
+                print("%24s %12.3f" % (name, value))
+            results["datagram.%s" % name] = value
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'population':args.population, 'results':results}, f,
+                indent=2, sort_keys=True)
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print("comparison against %s" % (args.baseline))
+        print("%24s %12s %12s %8s" % ("benchmark", "baseline", "now", 
+            "ratio"))
+        for name, old, new, ratio, regressed in compareBaseline(results,
+            baseline, args.tolerance):
+            # counts are shown as is, times in microseconds
+            scale = 1 if name.endswith(('bytes','deferreds','discarded',
+                'resent')) else 1E6
+            print("%24s %12.3f %12.3f %8.2f%s" % (name, old*scale, 
+                new*scale, ratio, "  REGRESSION" if regressed else ""))
+            if regressed:
+                status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,221 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+The bot module defines a headless, scriptable client for generating load on
+the mMOSS server. Bots join, thrust, rotate and fire under the control of a
+pluggable behaviour object, without a pygame display or keyboard, and many
+bots can share a single process and Twisted reactor.
+
+Classes defined:
+1. BotBehaviour - Base class for bot behaviour scripts.
+2. RandomBehaviour - Wander around at random, firing occasionally.
+3. BotClient - Headless mMOSS client driven by a behaviour.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import random
+import logging
+import pygame
+from twisted.internet import reactor
+from client import MMOSSClient
+from utility import MMOSSShip, DEFAULTRADIUS
+
+__author__ = "Eric Dennison"
+
+THRUST = 100.0
+"""Default forward thrust level."""
+
+ROTATETHRUST = 100.0
+"""Default rotational thrust level."""
+
+BULLETV = 50.0
+"""Default bullet velocity."""
+
+BULLETE = 3.0
+"""Default bullet energy."""
+
+
+class BotBehaviour(object):
+
+    """Base class for bot behaviour scripts. A behaviour decides, once per
+    bot poll cycle, what the bot's controls should be. The base class just
+    drifts.
+    """
+
+    def decide(self, bot, servertime):
+        """Choose the control inputs for a bot.
+
+        :param bot: Reference to the BotClient (the ship is bot.myshipobject
+                    and the other objects are in bot.objectlist).
+        :param servertime: Current (estimated) server time.
+        :returns: Tuple of (thrust, ccwthrust, shootv, shoote).
+        """
+        return 0.0, 0.0, 0.0, 0.0
+
+
+class RandomBehaviour(BotBehaviour):
+
+    """Wander around at random: thrust in bursts, turn now and then and fire
+    every so often.
+
+    :param changeinterval: Mean seconds between changes of thrust.
+    :param turnchance: Probability of a rotational impulse per decision.
+    :param firechance: Probability of firing per decision.
+    """
+
+    def __init__(self, changeinterval=1.0, turnchance=0.05, firechance=0.05):
+        self.changeinterval = changeinterval
+        self.turnchance = turnchance
+        self.firechance = firechance
+        self.nextchange = {}
+        self.thrust = {}
+
+    def decide(self, bot, servertime):
+        if servertime >= self.nextchange.get(bot, 0.0):
+            self.thrust[bot] = random.choice([0.0, THRUST, -THRUST/5])
+            self.nextchange[bot] = servertime + random.expovariate(
+                1.0/self.changeinterval)
+        ccwthrust = 0.0
+        if random.random() < self.turnchance:
+            ccwthrust = random.choice([ROTATETHRUST, -ROTATETHRUST])
+        shoote = 0.0
+        if random.random() < self.firechance:
+            shoote = BULLETE
+        return self.thrust[bot], ccwthrust, BULLETV, shoote
+
+
+BEHAVIOURS = {'idle': BotBehaviour, 'random': RandomBehaviour}
+"""Built in behaviours, by name."""
+
+
+def loadBehaviour(name):
+    """Find a behaviour class by name.
+
+    :param name: Name from BEHAVIOURS, or a dotted path to a BotBehaviour
+                 subclass (e.g. "mybots.Hunter").
+    :returns: The behaviour class.
+    :raises ValueError: If the name is neither a built in behaviour nor the
+                        dotted path of a BotBehaviour subclass that can be
+                        imported.
+    """
+    if name in BEHAVIOURS:
+        return BEHAVIOURS[name]
+    modulename, dummy, classname = name.rpartition('.')
+    cls = None
+    if modulename and classname:
+        try:
+            module = __import__(modulename, fromlist=[classname])
+            cls = getattr(module, classname)
+        except (ImportError, AttributeError):
+            pass
+    if not (isinstance(cls, type) and issubclass(cls, BotBehaviour)):
+        raise ValueError("unknown behaviour %r (use one of %s or a dotted "
+            "path to a BotBehaviour subclass)" % (name, 
+                ", ".join(sorted(BEHAVIOURS))))
+    return cls
+
+
+class BotClient(MMOSSClient):
+
+    """Headless client that plays according to a behaviour. Game objects are
+    built without display support and no pygame display or keyboard is used.
+
+    :param address: IP address (in text form e.g. "127.0.0.1")
+    :param port: Internet port number
+    :param refreshrate: Control poll rate (seconds per cycle)
+    :param playername: Name of the player
+    :param behaviour: BotBehaviour instance that drives the bot.
+    :param radius: Radius of the bot ship.
+    """
+
+    displayable = False
+
+    def __init__(self, address, port, refreshrate, playername, behaviour,
+        radius=DEFAULTRADIUS):
+        self.behaviour = behaviour
+        self.radius = radius
+        super(BotClient, self).__init__(None, address, port, refreshrate,
+            playername, (0, 0))
+        self.shipimage = pygame.Surface((2*radius, 2*radius),
+            pygame.SRCALPHA, 32)
+
+    def sendJoinRequest(self):
+        """Create a new ship object and send a join request to the server.
+        """
+        super(BotClient, self).sendJoinRequest()
+        self.myshipobject = MMOSSShip(
+            radius=self.radius,
+            wmax=40,
+            fmax=30,
+            smax=30,
+            image=self.shipimage,
+            objectname=self.playername)
+        self.protocol.sendClientJoinRequest(self.myshipobject,
+            self.joinResponse)
+
+    def notifyJoinRejected(self, reason):
+        """Report that the server refused to let the bot join. Only this
+        bot disconnects; the others share the reactor.
+        
+        :param reason: Explanation from the server.
+        """
+        logging.error("notifyJoinRejected: %s: %s" % (self.playername,
+            reason))
+        self.protocol.transport.loseConnection()
+
+    def handleControls(self):
+        """Ask the behaviour for control inputs and send them to the server
+        when they change anything.
+        """
+        thrust, ccwthrust, shootv, shoote = self.behaviour.decide(self,
+            self.servertime)
+        controlling, shooting = self.myshipobject.processCommand(
+            self.servertime, thrust, ccwthrust, shootv, shoote)
+        if controlling or shooting:
+            self.protocol.sendClientControlEvent(self.myshipobject)
+
+    def clientPoll(self):
+        """Periodic processing: join (or rejoin) and play.
+        """
+        self.servertime, self.clienttime = self.serverTime()
+        self.lastpoll = self.clienttime
+        if not self.hasjoined:
+            self.sendJoinRequest()
+        elif self.hasjoinresponse:
+            # nothing to erase without a screen
+            self.deadobjectlist = []
+            self.handleControls()
+
+
+def startBots(address, port, count, refreshrate, behaviourclass,
+    nameprefix="bot"):
+    """Create a number of bots that share the Twisted reactor. Run the
+    reactor to play.
+
+    :param address: IP address of the server.
+    :param port: Internet port number.
+    :param count: Number of bots.
+    :param refreshrate: Control poll rate (seconds per cycle).
+    :param behaviourclass: BotBehaviour subclass; one instance is shared by
+                           all bots.
+    :param nameprefix: Prefix for the bot player names.
+    :returns: List of BotClient instances.
+    """
+    behaviour = behaviourclass()
+    return [BotClient(address, port, refreshrate,
+        "%s%03d" % (nameprefix, i), behaviour) for i in range(count)]
+
+
+def runBots(address, port, count, refreshrate, behaviourclass):
+    """Create a number of bots and run the Twisted reactor.
+
+    :param address: IP address of the server.
+    :param port: Internet port number.
+    :param count: Number of bots.
+    :param refreshrate: Control poll rate (seconds per cycle).
+    :param behaviourclass: BotBehaviour subclass.
+    """
+    startBots(address, port, count, refreshrate, behaviourclass)
+    reactor.run()
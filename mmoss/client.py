@@ -13,6 +13,7 @@ import sys
 import os.path
 import time
 import logging
+from collections import deque
 import pygame
 from twisted.internet import reactor
 from twisted.internet.protocol import Factory
@@ -22,9 +23,18 @@ from utility import MMOSSShip, MMOSSBullet, MMOSSAsteroid
 from controller import Controller
 from stats import PlayerStats
 from clientprotocol import ClientFactory
+from datagram import DatagramClient
+from playout import PlayoutDelay
+from render import onScreen, mergeRects
 
 __author__ = "Eric Dennison"
 
+VIEWPORTSLACK = 50
+"""Distance the screen may pan before the server is sent a new viewport."""
+
+MAXPENDINGINPUTS = 64
+"""Most control inputs kept for replay while awaiting the server."""
+
 
 class MMOSSClient(object):
 
@@ -44,10 +54,13 @@ class MMOSSClient(object):
     :param screensize: Tuple that specifies requested screen area (W,H)
     """
     
+    displayable = True
+    """Build displayable game objects (False for headless clients)."""
     
     def __init__(self, arguments, address, port, refreshrate, playername, 
         screensize):
-        pygame.init() 
+        if self.displayable:
+            pygame.init() 
         self.controller = Controller([])
         self.lastpoll = time.time()
         self.timedelta = 0.0
@@ -61,10 +74,28 @@ class MMOSSClient(object):
         self.arguments = arguments
         self.id = 0
         self.playerstats = PlayerStats()
+        self.tickstats = {}
+        self.queuestats = {}
+        self.tickprofile = {}
         self.hasjoined = False
         self.hasjoinresponse = False
+        self.viewport = None
         self.objectlist = {}
         self.staticobjectlist = []
+        # objects drawn in the last frame (erased in the next)
+        self.drawnobjects = []
+        # world snapshots by UDP, if asked for on the command line
+        self.usedatagrams = getattr(arguments, 'udp', False)
+        self.datagramloss = getattr(arguments, 'udp_loss', 0.0)
+        self.datagrams = None
+        self.datagramport = None
+        # remote objects are displayed this far in the past, and are only
+        # removed when the display reaches their drop time
+        self.playout = PlayoutDelay()
+        self.pendingdrops = {}
+        # control inputs not yet processed by the server
+        self.inputsequence = 0
+        self.pendinginputs = deque(maxlen=MAXPENDINGINPUTS)
         reactor.connectTCP(address, port, self.factory)
         return
 
@@ -96,23 +127,49 @@ class MMOSSClient(object):
         """
         self.polltask.stop()
         self.pingtask.stop()
+        if not self.datagramport is None:
+            self.datagramport.stopListening()
+            self.datagramport = None
+            self.datagrams = None
+
+    def findObject(self, objectid):
+        """Look up the internal representation of an object, so that a state
+        update from the server can be applied to it in place.
+        
+        :param objectid: Numeric ID of the object.
+        :returns: The object, or None if the client does not know it.
+        """
+        if objectid == self.id:
+            return self.myshipobject
+        return self.objectlist.get(objectid)
 
     def notifyObjectState(self, obj):
-        """Update internal representations for objects when new object
-        state is received from the server.
+        """Update internal representations for objects when state is 
+        received from the server for an object that is not known yet (see
+        findObject; known objects are updated in place).
         
-        :param obj: Instantiated temporary object.
+        :param obj: Instantiated object.
         :type obj: MMOSSObject
         """
         if obj.objectid == self.id:
-            # this is US, so just update parameters
-            self.myshipobject.copyDynamics(obj)
+            # this is US: predicted, and reconciled by notifyOwnShipState
+            pass
         elif self.objectlist.has_key(obj.objectid):
             # update an existing object
             self.objectlist[obj.objectid].copyDynamics(obj)
         elif not isinstance(obj, MMOSSShip):
             # this is a new foreign object (but not a ship)
+            if hasattr(obj, 'recordState'):
+                obj.recordState()
             self.objectlist[obj.objectid] = obj
+
+    def notifySnapshot(self, sendtime):
+        """Account for the arrival of a world snapshot, to adapt the delay
+        at which remote objects are displayed.
+        
+        :param sendtime: Server time the snapshot was sent.
+        """
+        self.playout.arrival(self.serverTime()[0], sendtime)
         
     def notifyNewObject(self, obj):
         """Create an internal representation of an object that has just 
@@ -123,6 +180,8 @@ class MMOSSClient(object):
 
         """
         if not obj.objectid == self.id:
+            # it may be back in view before the display reached its drop
+            self.pendingdrops.pop(obj.objectid, None)
             self.objectlist[obj.objectid] = obj
 
     def notifyPrivateObjectState(self, objectid, wlevel, flevel, slevel):
@@ -139,6 +198,48 @@ class MMOSSClient(object):
         if objectid == self.id:
             self.myshipobject.updateFuel(wlevel, flevel, slevel)
 
+    def recordInput(self, ship):
+        """Keep a control input that is about to be sent to the server, so
+        that it can be replayed on top of the server state until the server
+        has processed it.
+        
+        :param ship: Ship that represents the user control input.
+        :type ship: MMOSSShip
+        :returns: Sequence number of the input.
+        """
+        self.inputsequence = self.inputsequence + 1
+        self.pendinginputs.append((self.inputsequence, ship.timestamp,
+            ship.thrust, ship.ccwthrust, ship.shootv, ship.shoote))
+        return self.inputsequence
+
+    def notifyOwnShipState(self, objectid, sequence, eventtime, x, y, vx, vy,
+        a, r, rr):
+        """Reconcile the predicted state of the client's own ship with the
+        authoritative state from the server: start from the server state and
+        replay the inputs the server has not processed yet. Only the motion
+        of the inputs is replayed: their shots and fuel use were accounted 
+        for when they were first predicted.
+        
+        :param objectid: Numeric ID of the ship.
+        :param sequence: Sequence number of the last input processed.
+        :param eventtime: Server timestamp of the state.
+        """
+        ship = self.myshipobject
+        if not objectid == self.id or ship is None:
+            return
+        pending = self.pendinginputs
+        while pending and pending[0][0] <= sequence:
+            pending.popleft()
+        levels = ship.wlevel, ship.flevel, ship.slevel
+        ship.setDynamics(eventtime, x, y, vx, vy, a, r, rr)
+        for seq, timestamp, thrust, ccwthrust, shootv, shoote in pending:
+            ship.processCommand(max(timestamp, ship.timestamp), thrust,
+                ccwthrust, 0.0, 0.0)
+        ship.wlevel, ship.flevel, ship.slevel = levels
+        # impulses have been sent already
+        ship.ccwthrust = 0.0
+        ship.shoote = 0.0
+
     def notifyObjectDrop(self, objectid, eventtime):
         """Remove internal representations of objects that have been removed
         from the server.
@@ -147,12 +248,32 @@ class MMOSSClient(object):
         :type objectid: int
         :param eventtime: Server time stamp for the drop event
         """
+        obj = self.objectlist.get(objectid)
+        if (self.displayable and hasattr(obj, 'playback') and 
+            not obj is self.myshipobject):
+            # it is displayed in the past: keep it until the display
+            # reaches the drop (see expireDrops)
+            self.pendingdrops[objectid] = eventtime
+            return
         deadobj = self.objectlist.pop(objectid,None)
         if deadobj:
             self.deadobjectlist.append(deadobj)
         if objectid == self.myshipobject.objectid:
             self.hasjoined = False  # this will force us to rejoin!            
 
+    def expireDrops(self, displaytime):
+        """Remove the remote objects whose drop time the display has 
+        reached.
+        
+        :param displaytime: Time at which remote objects are displayed.
+        """
+        for objectid, droptime in self.pendingdrops.items():
+            if droptime <= displaytime:
+                del self.pendingdrops[objectid]
+                deadobj = self.objectlist.pop(objectid, None)
+                if deadobj:
+                    self.deadobjectlist.append(deadobj)
+
     def notifyPlayerStats(self, playername, playtime, killcount, killedcount):
         """Update internal record of peer player statistics.
         
@@ -173,6 +294,55 @@ class MMOSSClient(object):
         """
         pass
         
+    def notifyTickStats(self, tick, overruns, skipped, meanduration, 
+        maxduration):
+        """Record the server tick engine statistics (reported in response to
+        a REQUEST_PROFILE request).
+        
+        :param tick: Number of server poll cycles run.
+        :param overruns: Number of poll cycles that overran their time slot.
+        :param skipped: Number of poll cycles skipped because of overruns.
+        :param meanduration: Mean poll cycle duration (seconds).
+        :param maxduration: Maximum poll cycle duration (seconds).
+        """
+        self.tickstats = {'tick':tick, 'overruns':overruns, 
+            'skipped':skipped, 'meanduration':meanduration,
+            'maxduration':maxduration}
+        self.tickprofile = {}
+
+    def notifyQueueStats(self, priority, private, states, peakdepth, pauses):
+        """Record the statistics of this client's outbound queue on the
+        server (reported in response to a REQUEST_PROFILE request).
+        
+        :param priority: Join, drop and statistics events waiting.
+        :param private: Private ship states waiting.
+        :param states: Object states waiting.
+        :param peakdepth: Most messages and states ever waiting at once.
+        :param pauses: Number of times sending stopped for this client.
+        """
+        self.queuestats = {'priority':priority, 'private':private,
+            'states':states, 'peakdepth':peakdepth, 'pauses':pauses}
+
+    def notifyTickProfile(self, phase, samples, p50, p95, p99):
+        """Record server poll cycle timing for one phase.
+        
+        :param phase: Name of the phase (empty string when done).
+        :param samples: Number of poll cycles sampled.
+        :param p50: Median time in the phase (seconds).
+        :param p95: 95th percentile time in the phase (seconds).
+        :param p99: 99th percentile time in the phase (seconds).
+        """
+        if not phase=="":
+            self.tickprofile[phase] = (samples, p50, p95, p99)
+        else:
+            self.notifyTickProfileComplete()
+
+    def notifyTickProfileComplete(self):
+        """Process display or reporting of the server profile. This method
+        is called when all of the phases have been received.
+        """
+        pass
+
     def joinResponse(self, myid, thetime, gamewidth, gameheight):
         """Initialize internal state in response to succesfully connecting
         to the server. Send a request to the server to report full game state
@@ -196,12 +366,43 @@ class MMOSSClient(object):
             self.objectlist = {}    # clean out our object list
             self.staticobjectlist = []
             self.deadobjectlist = []
+            self.pendingdrops = {}
             self.myshipobject.objectid = myid
             self.objectlist[myid] = self.myshipobject
+            self.viewport = None
+            self.pendinginputs.clear()
             self.protocol.sendClientGenericRequest(REQUEST_FULLUPDATE)
+            if self.usedatagrams and self.datagrams is None:
+                self.protocol.sendClientDatagramRequest(self.datagramResponse)
             logging.info("joinResponse:my id: %d , server time: %f, deltat: %f"
                 % (myid, thetime, self.timedelta))
 
+    def notifyJoinRejected(self, reason):
+        """Report that the server refused to let the player join (the ship 
+        image is too large or not as declared). There is no point trying
+        again with the same ship, so the client stops.
+        
+        :param reason: Explanation from the server.
+        """
+        logging.error("notifyJoinRejected: %s" % (reason))
+        sys.stderr.write("mMOSS: the server refused to join: %s\n" % 
+            (reason))
+        self.stop()
+
+    def datagramResponse(self, token, port):
+        """Open the datagram channel the server has agreed to.
+        
+        :param token: Token to send in hello datagrams.
+        :param port: Server UDP port.
+        """
+        if not self.datagrams is None:
+            return
+        address = (self.protocol.transport.getPeer().host, port)
+        self.datagrams = DatagramClient(self.protocol, token, address,
+            self.datagramloss)
+        self.datagramport = reactor.listenUDP(0, self.datagrams)
+        logging.info("datagramResponse: datagram channel to %s:%d" % address)
+
     def pingResponse(self, originalclienttime, servertime):
         """Process a period ping response from the server. Modifies a running
         average of the timedelta attribute.
@@ -237,26 +438,81 @@ class MMOSSClient(object):
         """
         pass
 
+    def checkViewport(self):
+        """Tell the server which part of the game field is on screen, 
+        whenever the screen has panned or been resized significantly.
+        """
+        sx,sy,w,h = self.screenrect
+        # screenrect is anchored at the upper left corner
+        viewport = (sx, sy-h, w, h)
+        if self.viewport is None or max([abs(new-old) for new,old in
+            zip(viewport, self.viewport)]) > VIEWPORTSLACK:
+            self.viewport = viewport
+            self.protocol.sendClientViewportEvent(*viewport)
+
+    def isOnScreen(self, obj, displaytime):
+        """Test whether an object may be visible at a display time, so that
+        objects far outside the screen are not drawn.
+        
+        :param obj: Object to test.
+        :param displaytime: Time at which the object will be displayed.
+        :returns: True if the object should be drawn.
+        """
+        # the velocity is enough here; the cull margin covers acceleration
+        deltat = displaytime - obj.timestamp
+        X = obj.X
+        V = obj.V
+        x, y = self.gameToScreenCoordinates((X[0]+V[0]*deltat, 
+            X[1]+V[1]*deltat))
+        return onScreen(x, y, obj.screenExtent(), self.screenrect[2], 
+            self.screenrect[3], self.gamedimensions)
+
     def eraseScreen(self):
-        """Periodic call to erase screen objects.
+        """Periodic call to erase screen objects. Only objects that were 
+        drawn in the last frame are erased (including any that have been
+        dropped since).
         """
         if self.hasjoined and self.hasjoinresponse:
             self.changedrects = []
-            for obj in self.deadobjectlist:
+            for obj in self.drawnobjects+self.staticobjectlist:
                 self.changedrects.extend(obj.eraseObject(self.screen))
+            self.drawnobjects = []
             self.deadobjectlist = []
-            for obj in self.objectlist.values()+self.staticobjectlist:
-                self.changedrects.extend(obj.eraseObject(self.screen))
 
     def writeScreen(self):
-        """Periodic call to write screen objects in correct z order.
+        """Periodic call to write screen objects in correct z order. Our own
+        ship is displayed at the current server time and remote objects at
+        the playout delay before it (see MMOSSDisplayableObject.playback).
+        A remote object is only drawn once the display reaches its first
+        state, and until it reaches its drop.
+        Objects outside the screen are not drawn, and the changed screen
+        rectangles are merged before the display is updated (see 
+        mmoss.render).
         """
         if self.hasjoined and self.hasjoinresponse:
-            for obj in sorted(self.objectlist.values()+self.staticobjectlist, 
+            displaytime = self.servertime - self.playout.delay
+            self.expireDrops(displaytime)
+            remote = set(obj for obj in self.objectlist.values() 
+                if not obj is self.myshipobject and hasattr(obj, 'playback'))
+            waiting = set(obj for obj in remote 
+                if not obj.playback(displaytime))
+            times = {}
+            for obj in self.objectlist.values():
+                if obj in waiting:
+                    continue
+                objtime = displaytime if obj in remote else self.servertime
+                if self.isOnScreen(obj, objtime):
+                    times[obj] = objtime
+                    self.drawnobjects.append(obj)
+            for obj in sorted(self.drawnobjects+self.staticobjectlist, 
                 key=lambda obj: obj.z):
-                self.changedrects.extend(obj.displayObject(self.servertime, self.screen))
-            pygame.display.update(self.changedrects)
-            #pygame.display.flip()
+                self.changedrects.extend(obj.displayObject(
+                    times.get(obj, self.servertime), self.screen))
+            rects = mergeRects(self.changedrects, self.screen.get_rect())
+            if rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
 
     def clientPoll(self):
         """Perform periodic processing on the client: poll the user input.
@@ -272,12 +528,15 @@ class MMOSSClient(object):
             self.eraseScreen()
             self.writeScreen()
             self.handleControls()
+            self.checkViewport()
 
     def pingPoll(self):
         """Perform periodic processing on the client to gauge the network
         latency in client/server communications.
         """
         self.protocol.sendClientPing(time.time(), self.pingResponse)
+        if not self.datagrams is None:
+            self.datagrams.sendHello()
         
     def run(self):
         """Run the twisted reactor loop."""
@@ -14,6 +14,9 @@ from twisted.internet import protocol
 
 from mmoss.network import *
 from mmoss.utility import *
+from mmoss.encoding import DeltaDecoder
+from mmoss.imagecache import ImageCache, ImageRejected
+from mmoss.imagecache import compressImage, decompressImage
 
 __author__ = "Eric Dennison"
 
@@ -27,6 +30,10 @@ class ClientProtocol(amp.AMP):
 
     def __init__(self):
         self.objectFactory = MMOSSFactory()        
+        self.snapshots = DeltaDecoder()
+        self.images = ImageCache()
+        # states of objects that are not kept until they join
+        self.earlystates = {}
 
     # Handlers for connection events
     #    
@@ -56,31 +63,89 @@ class ClientProtocol(amp.AMP):
         logging.info("objectStateEvent: id: %s, type: %s, name: %s,"
             "x/y/r/vx/vy/a %f %f %f %f %f %f" % 
             (objectid, objecttype, objectname, x, y, r, vx, vy, a)) 
-        obj = self.objectFactory.buildObject(objectid=objectid,
+        self.applyObjectState(objectid, objecttype, objectname, eventtime, 
+            x, y, vx, vy, a, r, rr)
+        return {}
+
+    ServerObjectStateEvent.responder(objectStateEvent)
+
+    def applyObjectState(self, objectid, objecttype, objectname, eventtime,
+        x, y, vx, vy, a, r, rr):
+        """Apply an object state update. An object the client already knows
+        is updated in place; an object is only built for a new ID.
+        
+        Arguments:
+        objectid - Numeric ID of object.
+        objecttype - Text representation of object type.
+        objectname - Name of the object.
+        eventtime - Server timestamp of state event.
+        """
+        if objectid == self.client.id:
+            # our own ship is predicted, and reconciled with the private
+            # state events
+            return
+        obj = self.client.findObject(objectid)
+        if not obj is None:
+            obj.setDynamics(eventtime, x, y, vx, vy, a, r, rr)
+            return
+        obj = self.objectFactory.buildState(objecttype, 
+            self.client.displayable, objectid, eventtime, 
+            x, y, vx, vy, a, r, rr,
             client=self.client,
-            displayable=True,
             gamedimensions=self.client.gamedimensions,
-            objecttype=objecttype, 
-            objectname=objectname, 
-            timestamp=eventtime, 
-            x=x, y=y, vx=vx, vy=vy, a=a, r=r, rr=rr)
-        self.client.notifyObjectState(obj)        
-        return {'result':1}
+            objectname=objectname)
+        if obj is None:
+            logging.warning("applyObjectState: unknown object type %s" % 
+                (objecttype))
+            return
+        self.client.notifyObjectState(obj)
+        if self.client.findObject(objectid) is None:
+            # a ship that has not joined yet: keep the state for the join
+            self.earlystates[objectid] = (eventtime, x, y, vx, vy, a, r, rr)
 
-    ServerObjectStateEvent.responder(objectStateEvent)
+    def worldSnapshotEvent(self, sequence, sendtime, basetime, states):
+        """Notify the client of the state of all objects that changed during
+        a server poll cycle. The snapshot is acknowledged once applied, with
+        the objects that could not be decoded (they are sent again in full).
+        
+        Arguments:
+        sequence - Snapshot sequence number.
+        sendtime - Server time the snapshot was sent.
+        basetime - Timestamp the record event times are relative to.
+        states - Delta encoded object states.
+        """
+        decoded = self.snapshots.decode(sequence, basetime, states)
+        if decoded is None:
+            # out of order
+            return {}
+        objects, missing = decoded
+        for objectid, objecttype, eventtime, x, y, vx, vy, a, r, rr in \
+            objects:
+            # names travel with the join event
+            self.applyObjectState(objectid, objecttype, "", eventtime, 
+                x, y, vx, vy, a, r, rr)
+        self.client.notifySnapshot(sendtime)
+        self.callRemote(ClientSnapshotAck, sequence=sequence, 
+            missing=missing)
+        return {}
+
+    ServerWorldSnapshotEvent.responder(worldSnapshotEvent)
 
     def objectJoinEvent(self, objectid, objecttype, objectname, radius, 
-        image, imagex, imagey, thrustimg, bulletimg):
-        """Notify the client that a peer/object has joined the game.
+        image, imagex, imagey, imagehash, thrustimg, bulletimg):
+        """Notify the client that a peer/object has joined the game. The join
+        may arrive after the first states of the object (they travel by
+        datagram), so any dynamics already received are kept.
         
         Arguments:
         objectid - Numeric ID of the object.
         objecttype - Text representation of object type.
         objectname - Name of the object.
         radius - Radius of the object (pixels).
-        image - Ship image as a pygame export.
+        image - Compressed ship image (empty if cached).
         imagex - Width of ship image.
         imagey - Height of ship image.
+        imagehash - Content hash of the ship image.
         thrustimg - Image of thrusting (e.g. flames)
         bulletimg - Image of bullet this ship shoots.
         """
@@ -88,21 +153,54 @@ class ClientProtocol(amp.AMP):
             (objectid, objecttype, objectname))
         obj = self.objectFactory.buildObject(objectid=objectid,
             client=self.client,
-            displayable=True,
+            displayable=self.client.displayable,
             gamedimensions=self.client.gamedimensions,
             objecttype=objecttype,
             objectname=objectname,
             radius=radius,
-            image=pygame.image.fromstring(image, (imagex,imagey),
-                "RGBA") if objecttype==MMOSSShipType else None,
+            image=self.shipImage(image, imagex, imagey, imagehash) if 
+                objecttype==MMOSSShipType else None,
             thrustimg=thrustimg,
             bulletimg=bulletimg)
+        self.snapshots.revive(objectid)
+        known = self.client.findObject(objectid)
+        state = self.earlystates.pop(objectid, None)
+        if not known is None:
+            obj.copyDynamics(known)
+            if hasattr(known, 'history'):
+                obj.history = known.history
+        elif not state is None:
+            obj.setDynamics(*state)
         self.client.notifyNewObject(obj)
-        return {'result':1}
-        
+        return {}
+
     ServerObjectJoinEvent.responder(objectJoinEvent)
 
-    def privateObjectStateEvent(self, objectid, wlevel, flevel, slevel):
+    def shipImage(self, image, imagex, imagey, imagehash):
+        """Find the image for a joining ship, in the join event or in the
+        image cache. The cache is kept in step with the server's mirror of
+        it even by clients that do not display anything.
+        
+        Arguments:
+        image - Compressed ship image (empty if cached).
+        imagex - Width of ship image.
+        imagey - Height of ship image.
+        imagehash - Content hash of the ship image.
+        Returns pygame surface (None if not displayable).
+        """
+        if image:
+            surface = None
+            if self.client.displayable:
+                surface = pygame.image.fromstring(decompressImage(image),
+                    (imagex,imagey), "RGBA")
+            self.images.add(imagehash, surface)
+            return surface
+        if not imagehash in self.images:
+            logging.warning("shipImage: image %s not cached" % (imagehash))
+        return self.images.get(imagehash)
+
+    def privateObjectStateEvent(self, objectid, wlevel, flevel, slevel,
+        sequence, eventtime, x, y, vx, vy, a, r, rr):
         """Notify the client of a private state update."
         
         Arguments:
@@ -110,9 +208,13 @@ class ClientProtocol(amp.AMP):
         wlevel - Weapon quantity.
         flevel - Fuel level.
         slevel - Shield level.
+        sequence - Sequence number of the last control event processed.
+        eventtime - Server timestamp of the state.
         """
         self.client.notifyPrivateObjectState(objectid, wlevel, flevel, slevel)
-        return {'result':1}
+        self.client.notifyOwnShipState(objectid, sequence, eventtime, 
+            x, y, vx, vy, a, r, rr)
+        return {}
 
     ServerPrivateObjectStateEvent.responder(privateObjectStateEvent)
 
@@ -123,8 +225,10 @@ class ClientProtocol(amp.AMP):
         objectid - Numeric ID of the object.
         eventtime - Server timestamp for the drop event.
         """
+        self.snapshots.forget(objectid)
+        self.earlystates.pop(objectid, None)
         self.client.notifyObjectDrop(objectid, eventtime)
-        return {'result':1}
+        return {}
 
     ServerObjectDropEvent.responder(objectDropEvent)
 
@@ -139,10 +243,58 @@ class ClientProtocol(amp.AMP):
         """
         self.client.notifyPlayerStats(playername, playtime, killcount, 
             killedcount)
-        return {'result':1}
+        return {}
 
     ServerPlayerStatsEvent.responder(playerStatsEvent)
 
+    def tickStatsEvent(self, tick, overruns, skipped, meanduration, 
+        maxduration):
+        """Notify client of server tick engine statistics.
+        
+        Arguments:
+        tick - Number of server poll cycles run.
+        overruns - Number of poll cycles that overran their time slot.
+        skipped - Number of poll cycles skipped.
+        meanduration - Mean poll cycle duration (seconds).
+        maxduration - Maximum poll cycle duration (seconds).
+        """
+        self.client.notifyTickStats(tick, overruns, skipped, meanduration,
+            maxduration)
+        return {}
+
+    ServerTickStatsEvent.responder(tickStatsEvent)
+
+    def queueStatsEvent(self, priority, private, states, peakdepth, pauses):
+        """Notify client of the statistics of its server outbound queue.
+        
+        Arguments:
+        priority - Join, drop and statistics events waiting.
+        private - Private ship states waiting.
+        states - Object states waiting.
+        peakdepth - Most messages and states ever waiting at once.
+        pauses - Number of times sending stopped for the client.
+        """
+        self.client.notifyQueueStats(priority, private, states, peakdepth,
+            pauses)
+        return {}
+
+    ServerQueueStatsEvent.responder(queueStatsEvent)
+
+    def tickProfileEvent(self, phase, samples, p50, p95, p99):
+        """Notify client of server poll cycle timing for one phase.
+        
+        Arguments:
+        phase - Name of the phase (empty string when done).
+        samples - Number of poll cycles sampled.
+        p50 - Median time in phase.
+        p95 - 95th percentile time in phase.
+        p99 - 99th percentile time in phase.
+        """
+        self.client.notifyTickProfile(phase, samples, p50, p95, p99)
+        return {}
+
+    ServerTickProfileEvent.responder(tickProfileEvent)
+
     #
     # Functions to call from the client
     #
@@ -166,12 +318,14 @@ class ClientProtocol(amp.AMP):
             self.callbackClientPing)
 
     def sendClientControlEvent(self, shipobj):
-        """Generate the ClientControlEvent message.
+        """Generate the ClientControlEvent message. The input is kept by the
+        client until the server has processed it.
         
         Arguments:
         shipobj - Reference to ship that represents the user control input.
         """
         self.callRemote(ClientControlEvent, 
+            sequence=self.client.recordInput(shipobj),
             timestamp=shipobj.timestamp,
             thrust=shipobj.thrust, 
             ccwthrust=shipobj.ccwthrust, 
@@ -191,6 +345,16 @@ class ClientProtocol(amp.AMP):
         self.userCallbackClientJoinRequest(args['shipid'], args['time'], 
             args['gamewidth'], args['gameheight'])
 
+    def errbackClientJoinRequest(self, failure):
+        """Handle the server refusing the ClientJoinRequest message.
+        
+        Arguments:
+        failure - Twisted failure (ImageRejected if the ship image broke 
+        the server limits).
+        """
+        failure.trap(ImageRejected)
+        self.client.notifyJoinRejected(failure.getErrorMessage())
+
     def sendClientJoinRequest(self, ship, callback):
         """Generate the ClientJoinRequest message.
         
@@ -205,12 +369,43 @@ class ClientProtocol(amp.AMP):
             wmax=ship.wmax, 
             fmax=ship.fmax, 
             smax=ship.smax,
-            image=pygame.image.tostring(ship.image,"RGBA"),
+            image=compressImage(pygame.image.tostring(ship.image,"RGBA")),
             imagex=ship.image.get_width(),
             imagey=ship.image.get_height(),
             thrustimg=ship.thrustimg, 
-            bulletimg=ship.bulletimg).addCallback(
-                self.callbackClientJoinRequest)
+            bulletimg=ship.bulletimg).addCallbacks(
+                self.callbackClientJoinRequest, 
+                self.errbackClientJoinRequest)
+
+    def callbackClientDatagramRequest(self, args):
+        """Handle response to the ClientDatagramRequest message.
+        
+        Arguments:
+        args - Attribute dictionary.
+        """
+        self.userCallbackClientDatagramRequest(args['token'], args['port'])
+
+    def sendClientDatagramRequest(self, callback):
+        """Generate the ClientDatagramRequest message.
+        
+        Arguments:
+        callback - Reference to a handler for the datagram request response.
+        """
+        self.userCallbackClientDatagramRequest = callback
+        self.callRemote(ClientDatagramRequest).addCallback(
+            self.callbackClientDatagramRequest)
+
+    def sendClientViewportEvent(self, x, y, width, height):
+        """Generate the ClientViewportEvent message.
+        
+        Arguments:
+        x - Left edge of the viewport (game coordinates).
+        y - Bottom edge of the viewport (game coordinates).
+        width - Width of the viewport.
+        height - Height of the viewport.
+        """
+        self.callRemote(ClientViewportEvent, x=x, y=y, width=width, 
+            height=height)
 
     def sendClientGenericRequest(self, req):
         """Generate GenericRequest message.
@@ -218,6 +413,9 @@ class ClientProtocol(amp.AMP):
         Arguments:
         req - Request.
         """
+        if req == REQUEST_FULLUPDATE:
+            # everything will be sent in full
+            self.snapshots.reset()
         self.callRemote(ClientGenericRequest, request=req)
 
     def sendClientGenericEvent(self, evt):
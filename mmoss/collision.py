@@ -0,0 +1,231 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Collision detection support for the server poll cycle.
+
+Classes defined:
+1. SpatialHash - Uniform grid broadphase over the (wrapping) game field.
+
+Functions defined:
+1. firstContactTime - Earliest contact of two linearly moving objects.
+2. bulletHits - Vectorized, swept bullet versus solid hit test.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+from __future__ import division
+import math
+from numpy import asarray, newaxis, zeros, where, minimum, maximum, sqrt
+from parametric import Parametric
+
+__author__ = "Eric Dennison"
+
+CELLSIZE = 64
+"""Nominal edge length of a broadphase grid cell (pixels)."""
+
+
+class SpatialHash(object):
+
+    """Uniform grid that bins objects by cached position and radius so that
+    only objects sharing a cell need to be tested for collision. The grid
+    wraps at the edges of the game field, just like the objects do.
+    """
+
+    def __init__(self, gamedimensions, cellsize=CELLSIZE):
+        """Create an empty spatial hash.
+
+        Arguments:
+        gamedimensions - Tuple representing (W,H) dimensions of game.
+        cellsize - Nominal edge length of a grid cell. The actual size is
+        adjusted so that a whole number of cells spans the game field.
+        """
+        self.columns = max(1, int(gamedimensions[0] // cellsize))
+        self.rows = max(1, int(gamedimensions[1] // cellsize))
+        self.cellwidth = gamedimensions[0] / self.columns
+        self.cellheight = gamedimensions[1] / self.rows
+        self.cells = {}
+
+    def clear(self):
+        """Remove all objects from the grid."""
+        self.cells = {}
+
+    def _span(self, low, high, size, count):
+        """Compute the (wrapped) cell indices covered by an interval.
+
+        Arguments:
+        low - Lower bound of the interval.
+        high - Upper bound of the interval.
+        size - Cell size along this axis.
+        count - Number of cells along this axis.
+        Returns list of cell indices.
+        """
+        first = int(math.floor(low / size))
+        last = int(math.floor(high / size))
+        if last - first + 1 >= count:
+            return range(count)
+        return [i % count for i in range(first, last + 1)]
+
+    def cellsCovered(self, X, radius):
+        """Compute the cells touched by a circle.
+
+        Arguments:
+        X - Position of the center (cached position, inside the field).
+        radius - Radius of the circle.
+        Returns list of (column, row) cell keys.
+        """
+        columns = self._span(X[0] - radius, X[0] + radius, self.cellwidth,
+            self.columns)
+        rows = self._span(X[1] - radius, X[1] + radius, self.cellheight,
+            self.rows)
+        return [(c, r) for c in columns for r in rows]
+
+    def insert(self, key, X, radius):
+        """Add an object to every cell it touches.
+
+        Arguments:
+        key - Identifier for the object (e.g. index into a list).
+        X - Cached position of the object.
+        radius - Radius of the object.
+        """
+        cells = self.cells
+        for cell in self.cellsCovered(X, radius):
+            if cell in cells:
+                cells[cell].append(key)
+            else:
+                cells[cell] = [key]
+
+    def query(self, X, radius=0):
+        """Find objects sharing a cell with a circle.
+
+        Arguments:
+        X - Position of the center.
+        radius - Radius of the circle.
+        Returns set of keys of potentially overlapping objects.
+        """
+        found = set()
+        cells = self.cells
+        for cell in self.cellsCovered(X, radius):
+            if cell in cells:
+                found.update(cells[cell])
+        return found
+
+    def queryRect(self, x, y, width, height):
+        """Find objects sharing a cell with a rectangle. The rectangle may
+        extend past the edges of the game field (it wraps).
+
+        Arguments:
+        x - Left edge of the rectangle.
+        y - Bottom edge of the rectangle.
+        width - Width of the rectangle.
+        height - Height of the rectangle.
+        Returns set of keys of objects in or near the rectangle.
+        """
+        found = set()
+        cells = self.cells
+        columns = self._span(x, x + width, self.cellwidth, self.columns)
+        rows = self._span(y, y + height, self.cellheight, self.rows)
+        for c in columns:
+            for r in rows:
+                if (c, r) in cells:
+                    found.update(cells[(c, r)])
+        return found
+
+    def candidatePairs(self):
+        """Find all pairs of objects that share at least one cell.
+
+        Returns set of (key1, key2) tuples with key1 < key2.
+        """
+        pairs = set()
+        for members in self.cells.itervalues():
+            count = len(members)
+            if count < 2:
+                continue
+            for i in range(count - 1):
+                first = members[i]
+                for second in members[i + 1:]:
+                    if first < second:
+                        pairs.add((first, second))
+                    else:
+                        pairs.add((second, first))
+        return pairs
+
+
+def firstContactTime(P1, P2, d, tmax):
+    """Find the first time at which two objects moving along straight lines
+    come within a given distance of each other.
+
+    Arguments:
+    P1 - Parametric object for the first object (t=0 at start of interval).
+    P2 - Parametric object for the second object.
+    d - Contact distance.
+    tmax - Length of the time interval.
+    Returns time of first contact in [0,tmax], or None if no contact.
+    """
+    if P1.distance(P2, 0) < d:
+        return 0.0
+    times = [t.real for t in P1.timeatdistance(P2, d) 
+        if t.imag == 0 and 0 <= t.real <= tmax]
+    if times:
+        return min(times)
+    return None
+
+
+def bulletHits(solidX, solidV, solidradius, solidids, bulletX, bulletV, 
+    bulletaway, shooterids, sweep, gamedimensions):
+    """Batched, swept bullet versus solid hit test. Relative positions are
+    computed for every (solid, bullet) pair at once, wrapped to the nearest 
+    image across the edges of the game field, and each pair is traced back 
+    along its relative velocity over the bullet's sweep interval, so fast 
+    bullets cannot tunnel through small ships between poll cycles. The exact
+    contact time of each candidate is found with Parametric.timeatdistance.
+
+    A bullet cannot hit anything until it is *away*, i.e. it has been seen
+    outside of the ship that fired it (see MMOSSSolid.checkCollision). Each
+    bullet hits at most one solid, the first one it touches.
+
+    Arguments:
+    solidX - Array (S x 2) of solid positions at the end of the interval.
+    solidV - Array (S x 2) of solid velocities.
+    solidradius - Array (S) of solid radii.
+    solidids - Array (S) of solid object IDs.
+    bulletX - Array (B x 2) of bullet positions at the end of the interval.
+    bulletV - Array (B x 2) of bullet velocities.
+    bulletaway - Boolean array (B) of current bullet away flags.
+    shooterids - Array (B) of the object IDs of the bullet shooters.
+    sweep - Array (B) of seconds to trace each bullet back (0 for a plain 
+    overlap test at the end of the interval).
+    gamedimensions - Tuple representing (W,H) dimensions of game.
+    Returns tuple of (list of (solid index, bullet index, contact time) hits,
+    boolean array (B) of updated away flags). Contact times are seconds
+    before the end of the interval.
+    """
+    W = asarray(gamedimensions, dtype=float)
+    D = bulletX[newaxis,:,:] - solidX[:,newaxis,:]
+    D = (D + W/2) % W - W/2
+    R2 = (solidradius**2)[:,newaxis]
+    inside = (D**2).sum(axis=2) < R2
+    # the shooter clears its own bullet once the bullet is outside of it
+    own = solidids[:,newaxis] == shooterids[newaxis,:]
+    newlyaway = ~bulletaway & (own & ~inside).any(axis=0)
+    away = bulletaway | newlyaway
+    # closest approach of each pair while tracing back over the sweep
+    Vrel = bulletV[newaxis,:,:] - solidV[:,newaxis,:]
+    speed2 = (Vrel**2).sum(axis=2)
+    s = (D*Vrel).sum(axis=2) / where(speed2 > 0, speed2, 1.0)
+    s = minimum(maximum(s, 0.0), sweep[newaxis,:])
+    C = D - Vrel*s[:,:,newaxis]
+    touching = (C**2).sum(axis=2) < R2
+    # a bullet that only just left its shooter cannot hit it on the way out
+    eligible = bulletaway[newaxis,:] | (newlyaway[newaxis,:] & ~own)
+    earliest = {}
+    for i,j in zip(*(touching & eligible).nonzero()):
+        # relative frame: solid at rest at the origin
+        P1 = Parametric(zeros(2), zeros(2))
+        P2 = Parametric(D[i,j] - Vrel[i,j]*sweep[j], Vrel[i,j])
+        t = firstContactTime(P1, P2, sqrt(R2[i,0]), sweep[j])
+        if t is None:
+            continue
+        if j not in earliest or t < earliest[j][0]:
+            earliest[j] = (t, i)
+    hits = [(int(i), int(j), float(sweep[j] - t)) 
+        for j,(t,i) in sorted(earliest.items())]
+    return hits, away
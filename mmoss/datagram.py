@@ -0,0 +1,196 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+The datagram module carries world snapshots over UDP, alongside the AMP
+TCP connection. On TCP a single lost packet holds up every later update
+until it is retransmitted; over UDP a lost snapshot is simply skipped and
+the next one is applied as soon as it arrives.
+
+The channel is negotiated after joining: the client asks for it with
+ClientDatagramRequest and is given a token, which it sends to the server
+in hello datagrams (from the UDP port it will receive on). From then on
+the server sends that client's world snapshots as sequenced datagrams.
+Joins, drops, private state, control and statistics stay on TCP, and so do
+the snapshot acknowledgements. Snapshots are delta encoded against
+acknowledged states only, so a lost or late snapshot never leaves the
+client without a baseline; the client discards datagrams that arrive out
+of order, and the server sends the objects of skipped snapshots again, as
+well as those of snapshots not acknowledged within encoding.SENTWINDOW.
+
+Classes defined:
+1. DatagramServer - Server end of the datagram channels of all clients.
+2. DatagramClient - Client end of the datagram channel.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import os
+import struct
+import random
+import logging
+from twisted.internet.protocol import DatagramProtocol
+
+__author__ = "Eric Dennison"
+
+DATAGRAMSIZE = 1200
+"""Largest datagram sent (bytes), small enough to avoid IP fragmentation."""
+
+DATAGRAMRECORDS = 24
+"""Maximum object states per snapshot datagram (a full delta record is 47
+bytes)."""
+
+HELLO = 'H'
+"""Datagram kind: client hello (carries the token)."""
+
+SNAPSHOT = 'S'
+"""Datagram kind: world snapshot."""
+
+SNAPSHOTHEADER = struct.Struct('<cIdd')
+"""Snapshot datagram header: kind, sequence number, send time and base
+time."""
+
+
+def packSnapshot(sequence, sendtime, basetime, data):
+    """Build a snapshot datagram.
+
+    Arguments:
+    sequence - Snapshot sequence number.
+    sendtime - Server time the snapshot is sent.
+    basetime - Timestamp the record event times are relative to.
+    data - Delta encoded object states.
+    Returns datagram string.
+    """
+    return SNAPSHOTHEADER.pack(SNAPSHOT, sequence, sendtime, basetime) + data
+
+
+def unpackSnapshot(datagram):
+    """Take apart a snapshot datagram.
+
+    Arguments:
+    datagram - Datagram string.
+    Returns tuple of (sequence, sendtime, basetime, data), or None if the
+    datagram is not a snapshot.
+    """
+    if len(datagram) < SNAPSHOTHEADER.size or datagram[0] != SNAPSHOT:
+        return None
+    kind, sequence, sendtime, basetime = SNAPSHOTHEADER.unpack_from(datagram)
+    return sequence, sendtime, basetime, datagram[SNAPSHOTHEADER.size:]
+
+
+class DatagramServer(DatagramProtocol):
+
+    """Server end of the datagram channels. Clients are matched to their
+    UDP address by the token they were given over TCP.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+
+    def register(self, protocol):
+        """Open a datagram channel for a client connection.
+
+        Arguments:
+        protocol - Reference to the client connection.
+        Returns the token the client must send in its hello datagrams.
+        """
+        self.unregister(protocol)
+        token = os.urandom(8).encode('hex')
+        self.tokens[token] = protocol
+        protocol.datagramtoken = token
+        return token
+
+    def unregister(self, protocol):
+        """Close the datagram channel of a client connection.
+
+        Arguments:
+        protocol - Reference to the client connection.
+        """
+        self.tokens.pop(protocol.datagramtoken, None)
+        protocol.datagramtoken = None
+        protocol.datagramaddress = None
+
+    def datagramReceived(self, datagram, address):
+        """Handle a hello datagram: snapshots for the client with the token
+        are sent to the address it came from.
+
+        Arguments:
+        datagram - Datagram string.
+        address - Tuple of (host, port) it came from.
+        """
+        if datagram[:1] != HELLO:
+            return
+        protocol = self.tokens.get(datagram[1:])
+        if protocol is None:
+            logging.warning("DatagramServer: unknown token from %s:%d" %
+                address)
+            return
+        if protocol.datagramaddress != address:
+            logging.info("DatagramServer: datagram channel to %s:%d" %
+                address)
+            protocol.datagramaddress = address
+
+    def sendSnapshot(self, address, sequence, sendtime, basetime, data):
+        """Send a snapshot datagram.
+
+        Arguments:
+        address - Tuple of (host, port) of the client.
+        sequence - Snapshot sequence number.
+        sendtime - Server time the snapshot is sent.
+        basetime - Timestamp the record event times are relative to.
+        data - Delta encoded object states.
+        """
+        self.transport.write(packSnapshot(sequence, sendtime, basetime, 
+            data), address)
+
+
+class DatagramClient(DatagramProtocol):
+
+    """Client end of the datagram channel. Snapshots are handed to the
+    client protocol just as if they had come over TCP.
+
+    Arguments:
+    protocol - Reference to the ClientProtocol.
+    token - Token from the ClientDatagramRequest response.
+    address - Tuple of (host, port) of the server datagram channel.
+    loss - Fraction of datagrams to drop on arrival (to simulate a lossy
+    network).
+    """
+
+    def __init__(self, protocol, token, address, loss=0.0):
+        self.protocol = protocol
+        self.token = token
+        self.address = address
+        self.loss = loss
+        self.received = 0
+        self.dropped = 0
+
+    def startProtocol(self):
+        """Say hello as soon as the port is open."""
+        self.sendHello()
+
+    def sendHello(self):
+        """Send a hello datagram. It is repeated periodically, in case it is
+        lost and to keep any NAT mapping open."""
+        if not self.transport is None:
+            self.transport.write(HELLO + self.token, self.address)
+
+    def datagramReceived(self, datagram, address):
+        """Handle a snapshot datagram. Datagrams that did not come from the
+        server datagram channel are ignored.
+
+        Arguments:
+        datagram - Datagram string.
+        address - Tuple of (host, port) it came from.
+        """
+        if tuple(address) != self.address:
+            return
+        if self.loss and random.random() < self.loss:
+            self.dropped = self.dropped + 1
+            return
+        snapshot = unpackSnapshot(datagram)
+        if snapshot is None:
+            return
+        self.received = self.received + 1
+        # out of order snapshots are discarded by the decoder
+        self.protocol.worldSnapshotEvent(*snapshot)
@@ -0,0 +1,449 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+The encoding module packs object state updates into fixed size binary
+records (a Numpy structured array) so that a batch of updates travels as a
+single string and is encoded and decoded in one vectorized pass.
+
+Each record holds a one byte type code, the object ID, the event time as a
+float64 offset from a float64 base time carried alongside the batch, and the
+position, velocity, acceleration, rotation (reduced to [0, 2 pi)) and
+rotation rate as float32. Event times stay float64 because a batch can mix
+the spawn time of an asteroid that has drifted untouched since the server
+started with current times: as a float32 such an offset would lose
+milliseconds within a day of uptime.
+
+World snapshots are delta encoded: each client acknowledges the snapshots
+it has applied and the server sends only the fields of each object that
+differ from the last acknowledged state of that object. The snapshot is
+laid out by column: record count, object IDs, field masks, baseline
+sequence numbers and then one column per field holding the values of the
+records whose mask has the field bit set.
+
+Classes defined:
+
+#. :class:`DeltaEncoder` - Server side delta encoder for one client.
+#. :class:`DeltaDecoder` - Client side delta decoder.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+from __future__ import division
+import math
+import time
+import logging
+from collections import deque, OrderedDict
+from numpy import array, dtype, empty, zeros, frombuffer, float64, uint16
+from numpy import where
+from utility import MMOSSShipType, MMOSSBulletType, MMOSSAsteroidType
+from utility import MMOSSSolidType
+
+__author__ = "Eric Dennison"
+
+STATEDTYPE = dtype([('type', 'u1'),
+    ('id', '<u4'),
+    ('t', '<f8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('vx', '<f4'),
+    ('vy', '<f4'),
+    ('a', '<f4'),
+    ('r', '<f4'),
+    ('rr', '<f4')])
+"""Packed layout of one object state record (41 bytes)."""
+
+FIELDS = ('type', 'time', 'x', 'y', 'vx', 'vy', 'a', 'r', 'rr')
+"""Delta encoded fields, in mask bit order."""
+
+FULLDTYPE = dtype([('type', 'u1'),
+    ('time', '<f8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('vx', '<f4'),
+    ('vy', '<f4'),
+    ('a', '<f4'),
+    ('r', '<f4'),
+    ('rr', '<f4')])
+"""Object state as compared and remembered by the delta encoder."""
+
+WIREDTYPES = {'type': dtype('u1'), 'time': dtype('<f8')}
+"""Delta encoded field types that differ from float32."""
+
+FULLMASK = (1 << len(FIELDS)) - 1
+"""Field mask of a record with every field present."""
+
+OBJECTTYPES = [MMOSSShipType, MMOSSBulletType, MMOSSAsteroidType,
+    MMOSSSolidType]
+"""Object type names, indexed by type code."""
+
+TYPECODES = dict((name, code) for code, name in enumerate(OBJECTTYPES))
+"""Type codes, keyed by object type name."""
+
+MAXRECORDS = 1024
+"""Maximum records per encoded batch (a single AMP value is limited to 64K
+bytes)."""
+
+HISTORY = 32
+"""Number of states per object remembered by the client for delta
+encoding."""
+
+TOMBSTONES = 4096
+"""Number of dropped object IDs remembered by the client, so that records
+for them that arrive after the drop (by datagram) are not applied."""
+
+SENTWINDOW = 1.0
+"""Seconds an unacknowledged snapshot is remembered by the server. The
+window is a time rather than a number of snapshots because a tick can
+produce many snapshots (one per datagram). The objects of a snapshot that
+is still not acknowledged after this long are sent again."""
+
+
+def gatherStates(objects):
+    """Collect the dynamic state of a batch of objects. Objects that all live
+    in the same WorldState are gathered straight from its arrays.
+
+    :param objects: List of MMOSSObject references.
+    :returns: Tuple of (object ID array, FULLDTYPE state array).
+    """
+    states = empty(len(objects), dtype=FULLDTYPE)
+    ids = array([obj.objectid for obj in objects], dtype='<u4')
+    if not len(objects):
+        return ids, states
+    world = objects[0].world
+    if world is not None and all(obj.world is world for obj in objects):
+        slots = [obj.slot for obj in objects]
+        states['time'] = world.timestamp[slots]
+        X = world.X[slots]
+        V = world.V[slots]
+        states['a'] = world.a[slots]
+        states['r'] = world.r[slots] % (2 * math.pi)
+        states['rr'] = world.rr[slots]
+    else:
+        states['time'] = [obj.timestamp for obj in objects]
+        X = array([obj.X for obj in objects], dtype=float64)
+        V = array([obj.V for obj in objects], dtype=float64)
+        states['a'] = [obj.a for obj in objects]
+        states['r'] = array([obj.r for obj in objects]) % (2 * math.pi)
+        states['rr'] = [obj.rr for obj in objects]
+    states['type'] = [TYPECODES[obj.OBJECTTYPE] for obj in objects]
+    states['x'] = X[:, 0]
+    states['y'] = X[:, 1]
+    states['vx'] = V[:, 0]
+    states['vy'] = V[:, 1]
+    return ids, states
+
+
+def encodeStates(objects, basetime=None):
+    """Encode the complete dynamic state of a batch of objects.
+
+    :param objects: List of MMOSSObject references.
+    :param basetime: Time that record timestamps are relative to (the
+                     earliest object timestamp if None).
+    :returns: Tuple of (base time, encoded string).
+    """
+    ids, states = gatherStates(objects)
+    records = empty(len(objects), dtype=STATEDTYPE)
+    if not len(objects):
+        return basetime or 0.0, records.tostring()
+    if basetime is None:
+        basetime = float(states['time'].min())
+    records['id'] = ids
+    records['t'] = states['time'] - basetime
+    for name in FIELDS:
+        if name != 'time':
+            records[name] = states[name]
+    return basetime, records.tostring()
+
+
+def decodeStates(basetime, data):
+    """Decode a batch of complete object states.
+
+    :param basetime: Base time of the batch.
+    :param data: Encoded string from encodeStates.
+    :returns: List of (objectid, objecttype, eventtime, x, y, vx, vy, a, r,
+              rr) tuples.
+    """
+    records = frombuffer(data, dtype=STATEDTYPE)
+    if not len(records):
+        return []
+    eventtimes = (records['t'].astype(float64) + basetime).tolist()
+    types = [OBJECTTYPES[code] for code in records['type'].tolist()]
+    return zip(records['id'].tolist(), types, eventtimes,
+               records['x'].tolist(), records['y'].tolist(),
+               records['vx'].tolist(), records['vy'].tolist(),
+               records['a'].tolist(), records['r'].tolist(),
+               records['rr'].tolist())
+
+
+def _column(data, wiretype, count, offset):
+    """Read one column of a delta encoded snapshot.
+
+    :param data: Encoded snapshot string.
+    :param wiretype: Numpy dtype of the column.
+    :param count: Number of values.
+    :param offset: Byte offset of the column.
+    :returns: Tuple of (value array, offset of the next column).
+    """
+    if not count:
+        return empty(0, dtype=wiretype), offset
+    values = frombuffer(data, dtype=wiretype, count=count, offset=offset)
+    return values, offset + count * wiretype.itemsize
+
+
+class DeltaEncoder(object):
+    """Server side delta encoder for the snapshots sent to one client. Every
+    snapshot gets a sequence number. The states in a snapshot become the
+    baseline for later snapshots once the client acknowledges it.
+
+    The client only keeps the last few states of each object (see
+    DeltaDecoder), so a baseline is only used while fewer than that many
+    states of the object have been sent since; after that the object is
+    sent in full.
+
+    Snapshots that are not acknowledged within a window of time are
+    forgotten, and their objects are sent again (see expire).
+
+    :param history: Number of states of each object the client keeps.
+    :param window: Seconds to wait for an acknowledgement.
+    """
+
+    def __init__(self, history=HISTORY, window=SENTWINDOW):
+        self.history = history
+        self.window = window
+        self.sequence = 0
+        self.acked = {}
+        self.sent = {}
+        self.sentorder = deque()
+        # number of snapshots each object has been sent in
+        self.counts = {}
+
+    def encode(self, ids, states, now=None):
+        """Delta encode a snapshot.
+
+        :param ids: Array of object IDs.
+        :param states: FULLDTYPE array of object states (see gatherStates).
+        :param now: Time the snapshot is sent (now if None).
+        :returns: Tuple of (sequence number, base time, encoded string).
+        """
+        self.sequence = self.sequence + 1
+        count = len(ids)
+        idlist = ids.tolist()
+        masks = zeros(count, dtype='<u2')
+        masks[:] = FULLMASK
+        baseseqs = zeros(count, dtype='<u4')
+        baseindex = []
+        baserows = []
+        counts = self.counts
+        sentcounts = []
+        for index, objectid in enumerate(idlist):
+            sent = counts.get(objectid, 0)
+            baseline = self.acked.get(objectid)
+            # the client may have discarded an older baseline
+            if baseline is not None and sent - baseline[2] < self.history:
+                baseindex.append(index)
+                baseseqs[index] = baseline[0]
+                baserows.append(baseline[1])
+            counts[objectid] = sent + 1
+            sentcounts.append(sent + 1)
+        if baseindex:
+            base = array(baserows, dtype=FULLDTYPE)
+            current = states[baseindex]
+            mask = zeros(len(baseindex), dtype='<u2')
+            for bit, name in enumerate(FIELDS):
+                mask |= (current[name] != base[name]).astype(uint16) << bit
+            masks[baseindex] = mask
+        basetime = float(states['time'].min()) if count else 0.0
+        columns = [array([count], dtype='<u4'), ids.astype('<u4'), masks,
+                   baseseqs]
+        for bit, name in enumerate(FIELDS):
+            values = states[name][((masks >> bit) & 1).astype(bool)]
+            if name == 'time':
+                values = values - basetime
+            columns.append(values.astype(WIREDTYPES.get(name, '<f4')))
+        self.sent[self.sequence] = dict(zip(idlist, 
+            zip(states.tolist(), sentcounts)))
+        self.sentorder.append((self.sequence, 
+            time.time() if now is None else now))
+        return (self.sequence, basetime,
+                ''.join([column.tostring() for column in columns]))
+
+    def ack(self, sequence, missing=()):
+        """Make the states of an acknowledged snapshot the baseline. Older
+        snapshots that were not acknowledged are forgotten (the client has
+        discarded them, or they were lost).
+
+        :param sequence: Sequence number of the snapshot.
+        :param missing: IDs of the objects in the snapshot that the client
+                        could not decode (it did not have their baseline).
+                        They lose their baseline and are sent in full.
+        :returns: Set of IDs of the objects in skipped snapshots that have
+                  not been sent since, and of the missing objects (their
+                  states must be sent again).
+        """
+        missing = set(missing)
+        for objectid in missing:
+            self.acked.pop(objectid, None)
+        states = self.sent.pop(sequence, None)
+        if states is None:
+            return missing
+        for objectid, (state, count) in states.items():
+            if not objectid in missing:
+                self.acked[objectid] = (sequence, state, count)
+        skipped = set()
+        while self.sentorder and self.sentorder[0][0] <= sequence:
+            skipped.update(self.sent.pop(self.sentorder.popleft()[0], {}))
+        skipped.difference_update(states)
+        for later in self.sent.values():
+            skipped.difference_update(later)
+        return skipped | missing
+
+    def expire(self, now=None):
+        """Forget the snapshots that have waited longer than the window for
+        an acknowledgement (they were lost, or so were their
+        acknowledgements).
+
+        :param now: Current time (now if None).
+        :returns: Set of IDs of the objects in the forgotten snapshots that
+                  have not been sent since (their states must be sent
+                  again).
+        """
+        if now is None:
+            now = time.time()
+        expired = set()
+        while self.sentorder and self.sentorder[0][1] < now - self.window:
+            expired.update(self.sent.pop(self.sentorder.popleft()[0], {}))
+        if expired:
+            for later in self.sent.values():
+                expired.difference_update(later)
+        return expired
+
+    def forget(self, objectid):
+        """Forget an object that has been dropped.
+
+        :param objectid: Numeric ID of the object.
+        """
+        self.acked.pop(objectid, None)
+        self.counts.pop(objectid, None)
+        for states in self.sent.values():
+            states.pop(objectid, None)
+
+    def reset(self):
+        """Forget all baselines (the next snapshots are sent in full)."""
+        self.acked = {}
+        self.sent = {}
+        self.sentorder.clear()
+        self.counts = {}
+
+
+class DeltaDecoder(object):
+    """Client side decoder for delta encoded snapshots. The reconstructed
+    state of each object is kept for every recent snapshot so that it can
+    serve as the baseline for later ones.
+
+    Snapshots are not ordered with the join and drop events, so records for
+    an object that has been dropped are not decoded (see forget), until the
+    object joins again (see revive).
+
+    :param history: Number of states remembered per object.
+    """
+
+    def __init__(self, history=HISTORY):
+        self.history = history
+        self.lastsequence = 0
+        self.states = {}
+        self.dropped = OrderedDict()
+        self.missing = 0
+
+    def decode(self, sequence, basetime, data):
+        """Decode a snapshot.
+
+        :param sequence: Sequence number of the snapshot.
+        :param basetime: Base time of the snapshot.
+        :param data: Encoded string from DeltaEncoder.encode.
+        :returns: Tuple of (list of (objectid, objecttype, eventtime, x, y,
+                  vx, vy, a, r, rr) tuples, list of IDs of the objects that
+                  could not be decoded for lack of a baseline or because
+                  they have been dropped), or None if
+                  the snapshot arrived out of order and must not be
+                  acknowledged. The IDs that could not be decoded must be
+                  reported with the acknowledgement.
+        """
+        if sequence <= self.lastsequence:
+            return None
+        self.lastsequence = sequence
+        count, offset = _column(data, dtype('<u4'), 1, 0)
+        count = int(count[0])
+        ids, offset = _column(data, dtype('<u4'), count, offset)
+        masks, offset = _column(data, dtype('<u2'), count, offset)
+        baseseqs, offset = _column(data, dtype('<u4'), count, offset)
+        # expand to a full table, with presence flags
+        table = zeros((count, len(FIELDS)))
+        present = zeros((count, len(FIELDS)), dtype=bool)
+        for bit, name in enumerate(FIELDS):
+            present[:, bit] = (masks >> bit) & 1
+            values, offset = _column(data, WIREDTYPES.get(name,
+                dtype('<f4')), int(present[:, bit].sum()), offset)
+            table[present[:, bit], bit] = values
+        table[:, FIELDS.index('time')] += basetime
+        # fill in the missing fields from the baselines
+        partial = (masks != FULLMASK).nonzero()[0].tolist()
+        idlist = ids.tolist()
+        baseseqlist = baseseqs.tolist()
+        keep = [True] * count
+        if partial:
+            baserows = []
+            for index in partial:
+                baseline = self.states.get(idlist[index], {}).get(
+                    baseseqlist[index])
+                if baseline is None:
+                    keep[index] = False
+                    baseline = [0.0] * len(FIELDS)
+                baserows.append(baseline)
+            table[partial] = where(present[partial], table[partial],
+                array(baserows))
+        results = []
+        missing = []
+        dropped = self.dropped
+        for objectid, baseseq, row, kept in zip(idlist, baseseqlist,
+            table.tolist(), keep):
+            if objectid in dropped:
+                missing.append(objectid)
+                continue
+            if not kept:
+                self.missing = self.missing + 1
+                logging.warning("DeltaDecoder: no baseline %d for object %d"
+                    % (baseseq, objectid))
+                missing.append(objectid)
+                continue
+            states = self.states.setdefault(objectid, {})
+            states[sequence] = row
+            # the server never goes back to an older baseline
+            for oldsequence in [s for s in states if s < baseseq]:
+                del states[oldsequence]
+            if len(states) > self.history:
+                del states[min(states)]
+            results.append((objectid, OBJECTTYPES[int(row[0])], row[1],
+                row[2], row[3], row[4], row[5], row[6], row[7], row[8]))
+        return results, missing
+
+    def forget(self, objectid):
+        """Forget an object that has been dropped, and ignore any records
+        for it that are still on the way.
+
+        :param objectid: Numeric ID of the object.
+        """
+        self.states.pop(objectid, None)
+        self.dropped[objectid] = True
+        while len(self.dropped) > TOMBSTONES:
+            self.dropped.popitem(last=False)
+
+    def revive(self, objectid):
+        """Decode records for an object again (it has joined again, e.g.
+        by coming back into view).
+
+        :param objectid: Numeric ID of the object.
+        """
+        self.dropped.pop(objectid, None)
+
+    def reset(self):
+        """Forget all baselines (before requesting a full update)."""
+        self.states = {}
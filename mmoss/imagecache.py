@@ -0,0 +1,221 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Ship images travel as zlib compressed RGBA bytes. The server never decodes
+them: it checks an image against the size limits once, when a ship joins,
+and from then on forwards the compressed bytes verbatim.
+
+Ship images are identified by a hash of their content. The server keeps one
+copy of each image and sends it to a client only when that client does not
+have it cached. The server mirrors every client's cache: both ends apply the
+same sequence of lookups and additions to a least recently used cache of the
+same capacity, so the server always knows what the client holds.
+
+Classes defined:
+1. ImageRejected - Error raised for an image that breaks the limits.
+2. ImageStore - Server side store of images, keyed by hash.
+3. ImageCache - Bounded least recently used cache, keyed by hash.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import zlib
+import hashlib
+from collections import OrderedDict
+
+__author__ = "Eric Dennison"
+
+CACHESIZE = 64
+"""Number of images a client caches (and the server mirrors)."""
+
+MAXIMAGEDIMENSION = 256
+"""Maximum width or height of a ship image (pixels)."""
+
+MAXIMAGEBYTES = 60000
+"""Maximum size of a compressed ship image (a single AMP value is limited
+to 64K bytes)."""
+
+
+class ImageRejected(ValueError):
+    """A ship image is too large or not as declared."""
+    pass
+
+
+def compressImage(data):
+    """Compress an image for sending.
+
+    Arguments:
+    data - Image bytes (RGBA).
+    Returns compressed bytes.
+    """
+    return zlib.compress(data)
+
+
+def decompressImage(data):
+    """Decompress an image that was compressed with compressImage.
+
+    Arguments:
+    data - Compressed image bytes.
+    Returns image bytes (RGBA).
+    """
+    return zlib.decompress(data)
+
+
+def validateImage(data, width, height):
+    """Check a compressed image against the size limits without ever
+    decompressing more than the declared size.
+
+    Arguments:
+    data - Compressed image bytes.
+    width - Declared width of the image.
+    height - Declared height of the image.
+    Returns the decompressed image bytes (RGBA).
+    Raises ImageRejected if the image is too large or not as declared.
+    """
+    if not (0 < width <= MAXIMAGEDIMENSION and 
+        0 < height <= MAXIMAGEDIMENSION):
+        raise ImageRejected("image size %dx%d is not allowed (at most "
+            "%dx%d)" % (width, height, MAXIMAGEDIMENSION, MAXIMAGEDIMENSION))
+    if len(data) > MAXIMAGEBYTES:
+        raise ImageRejected("compressed image is too large (%d bytes, at "
+            "most %d)" % (len(data), MAXIMAGEBYTES))
+    expected = width * height * 4
+    decompressor = zlib.decompressobj()
+    try:
+        raw = decompressor.decompress(data, expected)
+        # anything beyond the declared size is an error
+        extra = decompressor.unconsumed_tail or decompressor.flush(1)
+    except zlib.error:
+        raise ImageRejected("image is not zlib compressed")
+    if len(raw) != expected or extra or decompressor.unused_data:
+        raise ImageRejected("image is not %dx%d RGBA" % (width, height))
+    return raw
+
+
+def imageHash(data, width, height):
+    """Compute the content hash of an image (independent of how it was
+    compressed).
+
+    Arguments:
+    data - Image bytes (RGBA, uncompressed).
+    width - Width of the image.
+    height - Height of the image.
+    Returns hexadecimal hash string.
+    """
+    digest = hashlib.sha1("%dx%d:" % (width, height))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ImageStore(object):
+
+    """Keep a single copy of each image in use by a ship on the server,
+    counting the ships that use it.
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.refcounts = {}
+
+    def add(self, data, width, height):
+        """Add a reference to an image, storing it if it is new. The image
+        is checked against the size limits but only the compressed bytes
+        are kept.
+
+        Arguments:
+        data - Compressed image bytes.
+        width - Width of the image.
+        height - Height of the image.
+        Returns the image hash.
+        Raises ImageRejected if the image is not acceptable.
+        """
+        imagehash = imageHash(validateImage(data, width, height), width,
+            height)
+        if not imagehash in self.images:
+            self.images[imagehash] = (data, width, height)
+            self.refcounts[imagehash] = 0
+        self.refcounts[imagehash] = self.refcounts[imagehash] + 1
+        return imagehash
+
+    def release(self, imagehash):
+        """Remove a reference to an image, discarding the image when it is
+        no longer used.
+
+        Arguments:
+        imagehash - Hash of the image.
+        """
+        if not imagehash in self.refcounts:
+            return
+        self.refcounts[imagehash] = self.refcounts[imagehash] - 1
+        if not self.refcounts[imagehash]:
+            del self.refcounts[imagehash]
+            del self.images[imagehash]
+
+    def get(self, imagehash):
+        """Look up an image.
+
+        Arguments:
+        imagehash - Hash of the image.
+        Returns tuple of (compressed image bytes, width, height).
+        """
+        return self.images[imagehash]
+
+
+class ImageCache(object):
+
+    """Bounded cache of images keyed by hash that discards the least
+    recently used image when full.
+    """
+
+    def __init__(self, capacity=CACHESIZE):
+        """Create an empty cache.
+
+        Arguments:
+        capacity - Maximum number of images.
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, imagehash):
+        return imagehash in self.entries
+
+    def touch(self, imagehash):
+        """Mark an image as just used.
+
+        Arguments:
+        imagehash - Hash of the image.
+        Returns True if the image is in the cache.
+        """
+        if not imagehash in self.entries:
+            return False
+        self.entries[imagehash] = self.entries.pop(imagehash)
+        return True
+
+    def get(self, imagehash, default=None):
+        """Look up an image and mark it as just used.
+
+        Arguments:
+        imagehash - Hash of the image.
+        default - Value returned if the image is not in the cache.
+        Returns the cached image.
+        """
+        if not self.touch(imagehash):
+            return default
+        return self.entries[imagehash]
+
+    def add(self, imagehash, image=None):
+        """Add an image, discarding the least recently used image if the
+        cache is full.
+
+        Arguments:
+        imagehash - Hash of the image.
+        image - The image (e.g. a pygame surface).
+        """
+        self.entries.pop(imagehash, None)
+        self.entries[imagehash] = image
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
@@ -5,16 +5,19 @@ Network message class definitions.
 
 Protocol commands are named [Client/Server]Fucntion[Request/Event]. 
 Client/Server indicates which end of the connection ORIGINATES the message. 
+Server events do not require an answer from the client.
 
 Copyright (c) 2011 by Eric Dennison.  All rights reserved.
 """
 from __future__ import division
 from twisted.protocols import amp
+from imagecache import ImageRejected
 
 MMOSS_PROTOCOL = 12171
 
 REQUEST_FULLUPDATE = "r_fu"
 REQUEST_STATSUPDATE = "r_su"
+REQUEST_PROFILE = "r_pr"
 EVENT_QUIT       = "e_qu"
 
 
@@ -35,13 +38,15 @@ class ClientControlEvent(amp.Command):
     """Client user control event.
     
     Message attributes:
+    sequence - Input sequence number (echoed in private state events).
     timestamp - Timestamp of control event.
     thrust - Forward/reverse thrust force.
     ccwthrust - Counter-clockwise thrust impulse.
     shootv - Velocity of a fired bullet.
     shoote - Energy of a fired bullet.    
     """
-    arguments = [('timestamp', amp.Float()),
+    arguments = [('sequence', amp.Integer()),
+                 ('timestamp', amp.Float()),
                  ('thrust', amp.Float()),
                  ('ccwthrust',amp.Float()),
                  ('shootv', amp.Float()),
@@ -56,11 +61,14 @@ class ClientJoinRequest(amp.Command):
     wmax - Weapon relative maximum level (0-100).
     fmax - Fuel relative maximum level (0-100).
     smax - Shield relative maximum level (0-100).
-    image - Bitmap of the ship icon (pygame format).
+    image - Bitmap of the ship icon (zlib compressed pygame RGBA).
     imagex - Width of image.
     imagey - Height of image.
     thrustimg - Bitmap of the ship thrusting image.
     bulletimg - Bitmap of the ship's bullet image.
+    Errors:
+    IMAGE_REJECTED - The ship image is too large or not as declared (see 
+    mmoss.imagecache).
     """
     arguments = [('shipname',amp.String()),
                     ('radius',amp.Integer()),
@@ -74,6 +82,46 @@ class ClientJoinRequest(amp.Command):
                     ('bulletimg',amp.String())]
     response = [('shipid',amp.Integer()),('time',amp.Float()),
         ('gamewidth',amp.Integer()),('gameheight',amp.Integer())]
+    errors = {ImageRejected: 'IMAGE_REJECTED'}
+
+class ClientSnapshotAck(amp.Command):
+    """Client acknowledgement of an applied world snapshot.
+    
+    Message attributes:
+    sequence - Sequence number of the snapshot.
+    missing - IDs of the objects in the snapshot that the client could not
+    decode because it did not have their baseline.
+    """
+    arguments = [('sequence', amp.Integer()),
+                 ('missing', amp.ListOf(amp.Integer()))]
+    requiresAnswer = False
+
+class ClientDatagramRequest(amp.Command):
+    """Client request for world snapshots to be sent by UDP datagram.
+    
+    Response attributes:
+    token - Token to send in hello datagrams to the server.
+    port - Server UDP port for hello datagrams.
+    """
+    arguments = []
+    response = [('token', amp.String()),
+                ('port', amp.Integer())]
+
+class ClientViewportEvent(amp.Command):
+    """Client viewport event. The server only sends the client updates for
+    objects in or near its viewport.
+    
+    Message attributes:
+    x - Left edge of the viewport in game coordinates.
+    y - Bottom edge of the viewport in game coordinates.
+    width - Width of the viewport.
+    height - Height of the viewport.
+    """
+    arguments = [('x', amp.Float()),
+                 ('y', amp.Float()),
+                 ('width', amp.Float()),
+                 ('height', amp.Float())]
+    requiresAnswer = False
 
 class ClientGenericRequest(amp.Command):
     """Generic client request.
@@ -112,8 +160,6 @@ class ServerObjectStateEvent(amp.Command):
     a - Axial acceleration of object.
     r - Rotational position of object in radians (0 points up).
     rr - Rotational rate of object in radians/second.
-    Response attributes:
-    result - 1 for success.
     """
     arguments = [('objectid', amp.Integer()),  
                  ('objecttype', amp.String()), 
@@ -126,8 +172,28 @@ class ServerObjectStateEvent(amp.Command):
                  ('a', amp.Float()), 
                  ('r', amp.Float()), 
                  ('rr', amp.Float())]
-    response = [('result', amp.Integer())]
+    requiresAnswer = False
     
+class ServerWorldSnapshotEvent(amp.Command):
+    """Server world snapshot event. Carries the state of every object that 
+    changed during a server poll cycle in a single message (split into
+    several messages of up to encoding.MAXRECORDS objects if necessary).
+    
+    The states are delta encoded against the last snapshot acknowledged
+    by the client (see ClientSnapshotAck).
+    
+    Message attributes:
+    sequence - Snapshot sequence number.
+    sendtime - Server time the snapshot was sent.
+    basetime - Timestamp that the record event times are relative to.
+    states - Delta encoded object states (see mmoss.encoding).
+    """
+    arguments = [('sequence', amp.Integer()),
+                 ('sendtime', amp.Float()),
+                 ('basetime', amp.Float()),
+                 ('states', amp.String())]
+    requiresAnswer = False
+
 class ServerObjectJoinEvent(amp.Command):
     """Server object join/spawn event.
     
@@ -136,13 +202,13 @@ class ServerObjectJoinEvent(amp.Command):
     objecttype - Text representation of object type.
     objectname - Name of object.
     radius - Radius of the ship in pixels.
-    image - Bitmap of the ship icon (pygame format).
+    image - Bitmap of the ship icon (zlib compressed pygame RGBA), empty if
+    the client already has the image with this hash cached.
     imagex - Width of image.
     imagey - Height of image.
+    imagehash - Content hash of the image (see mmoss.imagecache).
     thrustimg - Bitmap of the ship thrusting image.
     bulletimg - Bitmap of the ship's bullet image.
-    Response attributes:
-    result - 1 for success.
     """    
     arguments = [('objectid', amp.Integer()),  
                  ('objecttype', amp.String()), 
@@ -151,26 +217,44 @@ class ServerObjectJoinEvent(amp.Command):
                  ('image', amp.String()),  
                  ('imagex', amp.Integer()),
                  ('imagey', amp.Integer()),
+                 ('imagehash', amp.String()),
                  ('thrustimg', amp.String()),
                  ('bulletimg', amp.String())]
-    response = [('result', amp.Integer())]
+    requiresAnswer = False
                  
 class ServerPrivateObjectStateEvent(amp.Command):
-    """Server private object state event.
+    """Server private object state event. This is the authoritative state of
+    the ship owned by the client.
     
     Message attributes:
     objectid - Numeric ID of the object.
     wlevel - Weapon health level.
     flevel - Fuel health level.
     slevel - Shield health level.
-    Response attributes:
-    result - 1 for success.
+    sequence - Sequence number of the last control event processed.
+    eventtime - Server timestamp of the state.
+    x - X coordinate of position.
+    y - Y coordinate of position.
+    vx - X component of velocity.
+    vy - Y component of velocity.
+    a - Axial acceleration.
+    r - Direction object is pointing (radians).
+    rr - Rotational rate (radians per second).
     """
     arguments = [('objectid',amp.Integer()), 
                  ('wlevel',amp.Float()),     
                  ('flevel',amp.Float()),     
-                 ('slevel',amp.Float())]     
-    response = [('result', amp.Integer())]
+                 ('slevel',amp.Float()),
+                 ('sequence', amp.Integer()),
+                 ('eventtime', amp.Float()),
+                 ('x', amp.Float()),
+                 ('y', amp.Float()),
+                 ('vx', amp.Float()),
+                 ('vy', amp.Float()),
+                 ('a', amp.Float()),
+                 ('r', amp.Float()),
+                 ('rr', amp.Float())]
+    requiresAnswer = False
 
 class ServerObjectDropEvent(amp.Command):
     """Server object drop event. An object has died/exploded/quit, etc.
@@ -178,12 +262,10 @@ class ServerObjectDropEvent(amp.Command):
     Message attributes:
     objectid - Numeric ID of the object.
     eventtime - Timestamp of drop.
-    Response attributes:
-    result - 1 for success.
     """
     arguments = [('objectid', amp.Integer()),
                  ('eventtime', amp.Float())] 
-    response = [('result', amp.Integer())]   
+    requiresAnswer = False
 
 class ServerPlayerStatsEvent(amp.Command): 
     """Server player stats event.
@@ -193,13 +275,66 @@ class ServerPlayerStatsEvent(amp.Command):
     playtime - Cumulative seconds of play time.
     killcount - Total number of kills since connected.
     killedcount - Total number of deaths since connected.
-    Response attributes:
-    result - 1 for success.
     """
     arguments = [('playername', amp.String()),
                  ('playtime', amp.Float()),   
                  ('killcount', amp.Integer()),
                  ('killedcount',amp.Integer())
                 ]
-    response = [('result', amp.Integer())]    
+    requiresAnswer = False
+
 
+class ServerTickStatsEvent(amp.Command):
+    """Server tick engine statistics event (response to REQUEST_PROFILE).
+    
+    Message attributes:
+    tick - Number of poll cycles run.
+    overruns - Number of poll cycles that overran their time slot.
+    skipped - Number of poll cycles skipped because of overruns.
+    meanduration - Mean poll cycle duration in seconds.
+    maxduration - Maximum poll cycle duration in seconds.
+    """
+    arguments = [('tick', amp.Integer()),
+                 ('overruns', amp.Integer()),
+                 ('skipped', amp.Integer()),
+                 ('meanduration', amp.Float()),
+                 ('maxduration', amp.Float())]
+    requiresAnswer = False
+
+class ServerQueueStatsEvent(amp.Command):
+    """Server outbound queue statistics event for the client's own 
+    connection (response to REQUEST_PROFILE).
+    
+    Message attributes:
+    priority - Join, drop and statistics events waiting.
+    private - Private ship states waiting.
+    states - Object states waiting.
+    peakdepth - Most messages and states ever waiting at once.
+    pauses - Number of times the connection stopped sending because the
+    client was not keeping up.
+    """
+    arguments = [('priority', amp.Integer()),
+                 ('private', amp.Integer()),
+                 ('states', amp.Integer()),
+                 ('peakdepth', amp.Integer()),
+                 ('pauses', amp.Integer())]
+    requiresAnswer = False
+
+class ServerTickProfileEvent(amp.Command):
+    """Server poll cycle phase timing event (response to REQUEST_PROFILE).
+    One event is sent per phase.
+    
+    Message attributes:
+    phase - Name of the phase - empty string when done.
+    samples - Number of poll cycles in the rolling window.
+    p50 - Median seconds spent in the phase per poll cycle.
+    p95 - 95th percentile seconds spent in the phase per poll cycle.
+    p99 - 99th percentile seconds spent in the phase per poll cycle.
+    (for the "messages" phase these are messages per poll cycle)
+    """
+    arguments = [('phase', amp.String()),
+                 ('samples', amp.Integer()),
+                 ('p50', amp.Float()),
+                 ('p95', amp.Float()),
+                 ('p99', amp.Float())]
+    requiresAnswer = False
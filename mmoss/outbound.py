@@ -0,0 +1,283 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Classes defined:
+1. OutboundQueue - Prioritized, collapsing send queue for one connection.
+2. OutboundBatch - Queues flushed together at the end of a poll cycle.
+3. MessageCache - Server events encoded once for all recipients.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import logging
+from collections import deque
+from zope.interface import implementer
+from twisted.protocols import amp
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+
+__author__ = "Eric Dennison"
+
+MAXPRIORITY = 10000
+"""Maximum number of queued high priority messages before a client is
+considered hopelessly behind and is disconnected."""
+
+
+def encodeMessage(command, **kwargs):
+    """Serialize a server event that requires no answer, exactly as
+    callRemote would put it on the wire.
+
+    Arguments:
+    command - AMP command class (requiresAnswer must be False).
+    kwargs - Command arguments.
+    Returns the encoded message bytes.
+    """
+    box = command.makeArguments(kwargs, None)
+    box[amp.COMMAND] = command.commandName
+    return box.serialize()
+
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+
+    """Queue the messages for one client connection and send them when the
+    transport can take them. The queue is registered with the transport as
+    a streaming producer, so sending stops while the client is not keeping
+    up (the transport write buffer is full) and resumes when it drains.
+
+    Messages are sent in priority order:
+    1. Join, drop and statistics events, first in first out.
+    2. Private ship state, at most one per ship (the latest).
+    3. Object state, at most one per object (the latest), as world
+    snapshots.
+
+    While a client is behind, superseded state updates are collapsed rather
+    than buffered, so the queue stays bounded by the number of objects.
+    """
+
+    def __init__(self, protocol, batch=None):
+        """Create an empty queue.
+
+        Arguments:
+        protocol - Reference to the ServerProtocol that sends the messages
+        (callRemote, writeServerPrivateObjectStateEvent and
+        writeServerWorldSnapshotEvent are used).
+        batch - OutboundBatch that flushes the queue at the end of the
+        server poll cycle (messages queued outside the cycle are sent once
+        control returns to the reactor).
+        """
+        self.protocol = protocol
+        self.batch = batch
+        self.priority = deque()
+        self.private = {}
+        self.states = {}
+        self.paused = False
+        self.stopped = False
+        self.flushcall = None
+        self.pauses = 0
+        self.peakdepth = 0
+
+    def depth(self):
+        """Return the number of messages and object states waiting."""
+        return len(self.priority) + len(self.private) + len(self.states)
+
+    def getStats(self):
+        """Report queue statistics.
+
+        Returns dictionary with current priority, private and state queue
+        depths, the peak total depth and the number of times the transport
+        paused the queue.
+        """
+        return {'priority':len(self.priority),
+            'private':len(self.private),
+            'states':len(self.states),
+            'peakdepth':self.peakdepth,
+            'pauses':self.pauses}
+
+    def push(self, command, **kwargs):
+        """Queue a high priority message.
+
+        Arguments:
+        command - AMP command class.
+        kwargs - Command arguments.
+        """
+        if self.stopped:
+            return
+        self.priority.append((command, kwargs))
+        if len(self.priority) > MAXPRIORITY:
+            logging.warning("OutboundQueue: client is not keeping up, "
+                "disconnecting")
+            self.stopProducing()
+            self.protocol.transport.loseConnection()
+            return
+        self.schedule()
+
+    def pushEncoded(self, data):
+        """Queue a high priority message that is already encoded (see
+        MessageCache).
+
+        Arguments:
+        data - Encoded message bytes.
+        """
+        self.push(None, data=data)
+
+    def queuePrivate(self, obj):
+        """Queue a private state update for a ship (replacing any that is
+        waiting).
+
+        Arguments:
+        obj - Reference to the ship.
+        """
+        if self.stopped:
+            return
+        self.private[obj.objectid] = obj
+        self.schedule()
+
+    def queueStates(self, objects):
+        """Queue state updates for objects (replacing any that are waiting).
+
+        Arguments:
+        objects - List of object references.
+        """
+        if self.stopped:
+            return
+        for obj in objects:
+            self.states[obj.objectid] = obj
+        self.schedule()
+
+    def discard(self, objectid):
+        """Forget waiting state updates for an object that is dropped.
+
+        Arguments:
+        objectid - Numeric ID of the object.
+        """
+        self.private.pop(objectid, None)
+        self.states.pop(objectid, None)
+
+    def schedule(self):
+        """Arrange for the queue to be flushed: at the end of the poll cycle
+        if one is running (so that everything queued in the cycle goes out
+        together, and is timed with it), otherwise once control returns to
+        the reactor.
+        """
+        self.peakdepth = max(self.peakdepth, self.depth())
+        if self.paused or self.stopped:
+            return
+        if not self.batch is None and self.batch.active:
+            self.batch.add(self)
+        elif self.flushcall is None:
+            self.flushcall = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Send as much as the transport will take, in priority order."""
+        if not self.flushcall is None:
+            if self.flushcall.active():
+                self.flushcall.cancel()
+            self.flushcall = None
+        protocol = self.protocol
+        while self.priority and not self.paused and not self.stopped:
+            command, kwargs = self.priority.popleft()
+            if command is None:
+                protocol.writeEncoded(kwargs['data'])
+            else:
+                protocol.callRemote(command, **kwargs)
+        while self.private and not self.paused and not self.stopped:
+            objectid, obj = self.private.popitem()
+            protocol.writeServerPrivateObjectStateEvent(obj)
+        if self.states and not self.paused and not self.stopped:
+            objects = self.states.values()
+            self.states = {}
+            protocol.writeServerWorldSnapshotEvent(objects)
+
+    #
+    # IPushProducer
+    #
+    def pauseProducing(self):
+        """Stop sending: the transport write buffer is full."""
+        self.paused = True
+        self.pauses = self.pauses + 1
+        if not self.flushcall is None:
+            self.flushcall.cancel()
+            self.flushcall = None
+
+    def resumeProducing(self):
+        """Start sending again: the transport write buffer has drained."""
+        self.paused = False
+        self.schedule()
+
+    def stopProducing(self):
+        """Stop for good: the connection is closed."""
+        self.stopped = True
+        if not self.flushcall is None:
+            self.flushcall.cancel()
+            self.flushcall = None
+        self.priority.clear()
+        self.private = {}
+        self.states = {}
+
+
+class OutboundBatch(object):
+
+    """The queues that have had messages queued during a server poll cycle.
+    They are flushed together at the end of the cycle, so the cost of
+    encoding and sending is part of the cycle (and of its profile), and the
+    messages are counted in the tick that produced them.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.queues = set()
+
+    def begin(self):
+        """Start collecting queues (at the start of a poll cycle)."""
+        self.active = True
+
+    def add(self, queue):
+        """Flush a queue at the end of the cycle.
+
+        Arguments:
+        queue - Reference to an OutboundQueue.
+        """
+        self.queues.add(queue)
+
+    def end(self):
+        """Stop collecting and flush the collected queues (at the end of a
+        poll cycle)."""
+        self.active = False
+        queues = self.queues
+        self.queues = set()
+        for queue in queues:
+            queue.flush()
+
+
+class MessageCache(object):
+
+    """Encoded server events, so that an event sent to many clients is
+    serialized once and the same bytes are written to every transport. The
+    server clears the cache every poll cycle.
+    """
+
+    def __init__(self):
+        self.messages = {}
+
+    def encode(self, command, key, **kwargs):
+        """Look up an encoded event, encoding it if it is not cached.
+
+        Arguments:
+        command - AMP command class (requiresAnswer must be False).
+        key - Hashable value that, with the command, identifies the event
+        and all its arguments (e.g. object ID and timestamp).
+        kwargs - Command arguments.
+        Returns the encoded message bytes.
+        """
+        cachekey = (command.commandName, key)
+        data = self.messages.get(cachekey)
+        if data is None:
+            data = encodeMessage(command, **kwargs)
+            self.messages[cachekey] = data
+        return data
+
+    def clear(self):
+        """Forget all encoded events."""
+        self.messages = {}
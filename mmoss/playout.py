@@ -0,0 +1,86 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Remote objects are displayed a little in the past, at the server time
+minus a playout delay, so that the server state that applies at the
+display time has usually arrived already and objects move smoothly even
+when updates are late or arrive in bunches. The delay adapts to the
+network: it follows the measured lateness of world snapshots (from the
+time the server sent them) plus a multiple of their jitter (estimated as
+in RFC 3550).
+
+Classes defined:
+1. PlayoutDelay - Adaptive playout delay.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+
+__author__ = "Eric Dennison"
+
+MINDELAY = 0.02
+"""Smallest playout delay (seconds)."""
+
+MAXDELAY = 0.5
+"""Largest playout delay (seconds); later updates are extrapolated."""
+
+JITTERMULTIPLE = 3.0
+"""Jitter allowance, as a multiple of the measured jitter."""
+
+GAIN = 1/16
+"""Weight of each new measurement in the running estimates (as RFC 3550)."""
+
+SLEW = 0.05
+"""Fraction of the distance to the target delay moved per snapshot, so
+that the display clock never jumps."""
+
+
+class PlayoutDelay(object):
+
+    """Estimate the lateness and jitter of world snapshots and derive the
+    playout delay from them.
+
+    Arguments:
+    mindelay - Smallest delay (seconds).
+    maxdelay - Largest delay (seconds).
+    """
+
+    def __init__(self, mindelay=MINDELAY, maxdelay=MAXDELAY):
+        self.mindelay = mindelay
+        self.maxdelay = maxdelay
+        self.delay = mindelay
+        self.lateness = None
+        self.jitter = 0.0
+        self.transit = None
+
+    def arrival(self, servertime, sendtime):
+        """Account for the arrival of a world snapshot. The lateness is
+        measured from the time the snapshot was sent, not from the event
+        times of its objects, which can be much older (e.g. for objects
+        coming into view).
+
+        Arguments:
+        servertime - Estimated server time on arrival.
+        sendtime - Server time the snapshot was sent.
+        """
+        transit = servertime - sendtime
+        if self.transit is None:
+            self.lateness = transit
+        else:
+            self.jitter = self.jitter + GAIN*(abs(transit - self.transit) -
+                self.jitter)
+            self.lateness = self.lateness + GAIN*(transit - self.lateness)
+        self.transit = transit
+        target = min(self.maxdelay, max(self.mindelay,
+            self.lateness + JITTERMULTIPLE*self.jitter))
+        self.delay = self.delay + SLEW*(target - self.delay)
+
+    def getStats(self):
+        """Report the playout estimates.
+
+        Returns dictionary with the delay, lateness and jitter (seconds).
+        """
+        return {'delay':self.delay,
+            'lateness':self.lateness or 0.0,
+            'jitter':self.jitter}
@@ -0,0 +1,143 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Classes defined:
+1. TickProfiler - Per-phase timing of the server poll cycle.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import time
+from collections import deque
+
+__author__ = "Eric Dennison"
+
+WINDOW = 1000
+"""Number of most recent ticks kept for the rolling percentiles."""
+
+MESSAGES = "messages"
+"""Pseudo phase that records the number of messages sent per tick."""
+
+TICK = "tick"
+"""Pseudo phase that records the total duration of each tick."""
+
+QUEUEDEPTH = "queuedepth"
+"""Pseudo phase that records the deepest client outbound queue left at the
+end of each tick."""
+
+
+class TickProfiler(object):
+
+    """Time the phases of each server poll cycle and count the messages sent
+    per tick. The most recent WINDOW ticks are kept for each phase so that
+    p50/p95/p99 can be reported on request.
+
+    Instrumentation points call lap(phase) at the end of each stretch of work
+    (the time since the previous lap is charged to the named phase, so a
+    phase can be entered many times per tick) and countMessage() for every
+    message sent. Other per tick quantities are recorded with
+    sample(phase, value). When the profiler is disabled these are do-nothing
+    calls.
+    """
+
+    def __init__(self, enabled=False):
+        """Create a tick profiler.
+
+        Arguments:
+        enabled - True to start collecting immediately.
+        """
+        self.samples = {}
+        self.phases = []
+        self.current = {}
+        self.messages = 0
+        self.tickstart = 0.0
+        self.lapstart = 0.0
+        self.setEnabled(enabled)
+
+    def setEnabled(self, enabled):
+        """Turn profiling on or off.
+
+        Arguments:
+        enabled - True to collect, False to make instrumentation free.
+        """
+        self.enabled = enabled
+        if enabled:
+            self.begin = self._begin
+            self.lap = self._lap
+            self.end = self._end
+            self.countMessage = self._countMessage
+            self.sample = self._sample
+        else:
+            self.begin = self.lap = self.end = self._ignore
+            self.countMessage = self.sample = self._ignore
+
+    def _ignore(self, *args):
+        """Instrumentation point when disabled."""
+        pass
+
+    def _begin(self):
+        """Mark the start of a tick."""
+        self.tickstart = self.lapstart = time.time()
+        self.current = {}
+
+    def _lap(self, phase):
+        """Charge the time since the last lap to a phase.
+
+        Arguments:
+        phase - Name of the phase.
+        """
+        now = time.time()
+        self.current[phase] = self.current.get(phase, 0.0) + now - \
+            self.lapstart
+        self.lapstart = now
+
+    def _sample(self, phase, value):
+        """Record a value for a pseudo phase for this tick.
+
+        Arguments:
+        phase - Name of the pseudo phase.
+        value - Value to record.
+        """
+        self.current[phase] = value
+
+    def _end(self):
+        """Mark the end of a tick and record its phase durations."""
+        self.current[TICK] = time.time() - self.tickstart
+        self.current[MESSAGES] = self.messages
+        # phases that were not entered this tick took no time
+        for phase in self.phases:
+            if not phase in self.current:
+                self.current[phase] = 0.0
+        for phase, value in self.current.items():
+            if not phase in self.samples:
+                self.samples[phase] = deque(maxlen=WINDOW)
+                self.phases.append(phase)
+            self.samples[phase].append(value)
+        self.current = {}
+        self.messages = 0
+
+    def _countMessage(self):
+        """Count a single message sent to a client. Messages sent between 
+        ticks are charged to the following tick."""
+        self.messages = self.messages + 1
+
+    def percentiles(self, phase):
+        """Compute rolling percentiles for a phase.
+
+        Arguments:
+        phase - Name of the phase.
+        Returns tuple of (sample count, p50, p95, p99). Durations are in
+        seconds, the messages phase is in messages per tick and sampled
+        phases are in their own units.
+        """
+        values = sorted(self.samples.get(phase, []))
+        count = len(values)
+        if not count:
+            return 0, 0.0, 0.0, 0.0
+        pick = lambda p: float(values[min(count-1, int(p*count))])
+        return count, pick(0.50), pick(0.95), pick(0.99)
+
+    def getPhases(self):
+        """Return list of the phase names seen, in order of first use."""
+        return list(self.phases)
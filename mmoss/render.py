@@ -0,0 +1,87 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Screen update helpers for the client. Objects outside the screen are culled
+before they are drawn, and the rectangles changed by erasing and drawing are
+merged before they are handed to pygame.display.update: overlapping and
+adjacent rectangles are coalesced, and when the changes cover much of the
+screen a full flip is cheaper than updating the pieces.
+
+Functions defined:
+1. onScreen - Test whether an object at a screen position may be visible.
+2. mergeRects - Coalesce the changed screen rectangles.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import pygame
+
+__author__ = "Eric Dennison"
+
+CULLMARGIN = 64
+"""Distance outside the screen (pixels) at which objects are still drawn, to
+allow for acceleration and for anything drawn around the image (e.g.
+thrust flames)."""
+
+MERGEGAP = 2
+"""Rectangles closer than this (pixels) are merged."""
+
+FULLFLIPCOVERAGE = 0.4
+"""Fraction of the screen area above which the whole screen is flipped
+instead of updating the changed rectangles."""
+
+
+def onScreen(x, y, extent, width, height, gamedimensions, margin=CULLMARGIN):
+    """Test whether an object may be visible. The game field wraps around,
+    so an object just beyond the right or bottom edge of the field is
+    visible at the left or top of the screen.
+
+    Arguments:
+    x, y - Screen coordinates of the object centre, wrapped to the game field
+    (as returned by MMOSSClient.gameToScreenCoordinates).
+    extent - Largest distance from the centre that the object is drawn at
+    (see MMOSSDisplayableObject.screenExtent).
+    width, height - Size of the screen.
+    gamedimensions - Size of the game field.
+    margin - Extra distance outside the screen at which objects are drawn.
+    Returns True if the object should be drawn.
+    """
+    reach = extent + margin
+    return ((x < width + reach or x > gamedimensions[0] - reach) and
+        (y < height + reach or y > gamedimensions[1] - reach))
+
+
+def mergeRects(rects, area, gap=MERGEGAP, coverage=FULLFLIPCOVERAGE):
+    """Clip the changed rectangles to the screen and merge those that
+    overlap or nearly touch.
+
+    Arguments:
+    rects - List of changed rectangles (pygame.Rect or rect style tuples).
+    area - Rectangle of the whole screen.
+    gap - Rectangles closer than this are merged.
+    coverage - Fraction of the screen above which a full flip is preferred.
+    Returns list of pygame.Rect to update, or None if the whole screen
+    should be flipped.
+    """
+    area = pygame.Rect(area)
+    merged = []
+    for rect in rects:
+        rect = area.clip(rect)
+        if not rect.width or not rect.height:
+            continue
+        grown = rect.inflate(2*gap, 2*gap)
+        i = 0
+        while i < len(merged):
+            if grown.colliderect(merged[i]):
+                # the union may now reach rectangles already passed over
+                rect.union_ip(merged.pop(i))
+                grown = rect.inflate(2*gap, 2*gap)
+                i = 0
+            else:
+                i = i + 1
+        merged.append(rect)
+    covered = sum([rect.width*rect.height for rect in merged])
+    if covered > coverage*area.width*area.height:
+        return None
+    return merged
@@ -0,0 +1,76 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Classes defined:
+1. EventScheduler - Min-heap of timed events keyed by object ID.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import heapq
+
+__author__ = "Eric Dennison"
+
+COMPACTSLACK = 64
+"""Number of stale heap entries tolerated before the heap is rebuilt."""
+
+
+class EventScheduler(object):
+
+    """Keep track of future events (e.g. bullet end of life) in a min-heap so
+    that finding the events that are due costs O(k log n) for k due events,
+    instead of a scan of every object. Each key has at most one pending
+    event: rescheduling a key replaces its event and cancelled or replaced
+    entries are discarded lazily when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def schedule(self, key, eventtime):
+        """Schedule (or reschedule) the event for a key.
+
+        Arguments:
+        key - Identifier for the event (e.g. object ID).
+        eventtime - Timestamp when the event is due.
+        """
+        self.pending[key] = eventtime
+        heapq.heappush(self.heap, (eventtime, key))
+        if len(self.heap) > 2*len(self.pending) + COMPACTSLACK:
+            self.compact()
+
+    def cancel(self, key):
+        """Cancel the pending event for a key, if any.
+
+        Arguments:
+        key - Identifier for the event.
+        """
+        self.pending.pop(key, None)
+
+    def compact(self):
+        """Rebuild the heap without stale entries."""
+        self.heap = [(eventtime, key) for key, eventtime in
+            self.pending.items()]
+        heapq.heapify(self.heap)
+
+    def popDue(self, timestamp):
+        """Remove and return all events due at or before a time.
+
+        Arguments:
+        timestamp - Current time.
+        Returns list of (key, event time) tuples in time order.
+        """
+        due = []
+        heap = self.heap
+        pending = self.pending
+        while heap and heap[0][0] <= timestamp:
+            eventtime, key = heapq.heappop(heap)
+            if pending.get(key) == eventtime:
+                del pending[key]
+                due.append((key, eventtime))
+        return due
@@ -10,12 +10,25 @@ Copyright (c) 2011 by Eric Dennison.  All rights reserved.
 import random
 import time
 from twisted.internet import reactor
-from twisted.internet import task
 from serverprotocol import *
 from stats import PlayerStats
+from collision import SpatialHash, bulletHits
+from worldstate import WorldState
+from scheduler import EventScheduler
+from tickengine import TickEngine, OVERRUN_SKIP
+from profiler import TickProfiler, QUEUEDEPTH
+from imagecache import ImageStore
+from datagram import DatagramServer
+from outbound import MessageCache, OutboundBatch
 
 POLLRATE = 0.02
 
+VIEWPORTMARGIN = 200
+"""Distance around a client viewport within which objects are sent."""
+
+INTERESTCELLSIZE = 128
+"""Nominal cell size of the grid used to find objects in client viewports."""
+
 __author__ = "Eric Dennison"
 
 
@@ -24,90 +37,189 @@ class Server(object):
     """Instantiate and run() to launch the mMOSS game server.
     """
     
-    def __init__(self, port, gamedimensions, asteroiddensity):
+    def __init__(self, port, gamedimensions, asteroiddensity, 
+        pollrate=POLLRATE, overrunpolicy=OVERRUN_SKIP, profile=False):
         """Create mMOSS game server.
         
         Arguments:
         port - Internet port to listen on.
         gamedimensions - Tuple representing (W,H) dimensions of game.
         asteroiddensity - Fraction of game area consumed by asteroid material.
+        pollrate - Target seconds per server poll cycle (tick).
+        overrunpolicy - What to do when a poll cycle overruns its time slot
+        (one of OVERRUNPOLICIES).
+        profile - True to time the phases of each poll cycle.
         """
         self.port = port
         self.clientdata = {}
+        self.pendingstate = {}
         self.bulletlist = {}
+        self.bulletexpiry = EventScheduler()
+        self.fuelouts = EventScheduler()
         self.asteroidlist = {}
         self.playerstats = PlayerStats()
         self.idcounter = 0
         self.gamedimensions = gamedimensions
+        self.grid = SpatialHash(gamedimensions)
+        self.interest = SpatialHash(gamedimensions, INTERESTCELLSIZE)
+        self.images = ImageStore()
+        self.datagrams = DatagramServer()
+        self.messages = MessageCache()
+        self.outbound = OutboundBatch()
+        self.world = WorldState(gamedimensions)
         self.spawnAsteroids(asteroiddensity)
-        self.skippollcount = 0
-        self.polltask = task.LoopingCall(self.serverPoll)
-        self.polltask.start(POLLRATE) # call every so often
+        self.lastpolltime = time.time() - pollrate
+        self.profiler = TickProfiler(profile)
+        self.tickengine = TickEngine(self.serverPoll, pollrate, overrunpolicy)
+        self.tickengine.start() # call every so often
         random.seed()
 
 
-    def serverPoll(self):
-        """Server poll is called by Twisted to check for object expiration 
-        or collisions.
+    def serverPoll(self, timestamp=None):
+        """Server poll is called by the tick engine to check for object 
+        expiration or collisions.
+        
+        Arguments:
+        timestamp - Server time of the tick (now if None).
         """
-        if self.skippollcount:
-            self.skippollcount = 0
-            return
-        timestamp = time.time()
-        for objid,obj in self.bulletlist.items():
-            # bullet lifetime expired?
-            if obj.endoflife <= timestamp:
-                obj.isalive = False
-                for d in self.clientdata:
-                    d.sendServerObjectDropEvent(obj, obj.endoflife)                
-            else:
-                # cache current position
-                obj.cachePosition(timestamp-obj.timestamp)
-        for protocol,ship in self.clientdata.items():
-            # ship out of fuel
-            if ship.fuelouttime <= timestamp:
-                # no thrust, no shots
-                ship.processCommand(timestamp,0,0,0,0)    
-                # inform everyone of new thrust, fuel
-                self.sendObjectToPeers(protocol,ship) 
+        profiler = self.profiler
+        profiler.begin()
+        if timestamp is None:
+            timestamp = time.time()
+        self.messages.clear()
+        # everything queued in this cycle is sent at the end of it
+        self.outbound.begin()
+        interval = timestamp - self.lastpolltime
+        self.lastpolltime = timestamp
+        # bullets whose lifetime expired
+        for objid,endoflife in self.bulletexpiry.popDue(timestamp):
+            obj = self.bulletlist[objid]
+            obj.isalive = False
+            for d in self.clientdata:
+                d.sendServerObjectDropEvent(obj, endoflife)                
+            self.dropBullet(obj)
+        profiler.lap('expiry')
+        # ships that ran out of fuel, processed at the moment they ran out
+        for protocol,fuelouttime in self.fuelouts.popDue(timestamp):
+            ship = self.clientdata[protocol]
+            # no thrust, no shots
+            ship.processCommand(max(fuelouttime,ship.timestamp),0,0,0,0)    
+            self.scheduleFuelOut(protocol,ship)
+            # inform everyone of new thrust, fuel
+            self.sendObjectToPeers(protocol,ship) 
+        profiler.lap('fuelout')
+        # cache current positions of everything in one pass
+        self.world.cachePositions(timestamp)
+        profiler.lap('positions')
         # get a list of ships to use
         shipitems = self.clientdata.items()
         asteroiditems = self.asteroidlist.items()
         items = shipitems+asteroiditems
-        #for protocol,ship in shipitems:
-        for dummy, obj in items:
-            obj.cachePosition(timestamp-obj.timestamp)
-        for protocol,obj in items:
-            # collisions with objects (bullets, etc.)
-            for bulletid,bullet in self.bulletlist.items():
-                if obj.checkCollision(bullet):
-                    if type(obj) is MMOSSShip:
-                        if obj.processCollision(timestamp,bullet):
-                            # survived, update shield levels
-                            protocol.sendServerPrivateObjectStateEvent(obj) 
-                        else:
-                            # not survived, update shooter stats
-                            self.playerstats.kill(bullet.shooter.objectname) 
-                    for d in self.clientdata:   
-                        # drop the bullets for everyone
-                        d.sendServerObjectDropEvent(bullet, timestamp)
-            # collisions with peer ships or asteroids - 
-            # look at all subsequent ships in shipitems
-            for protocol2,obj2 in items[items.index((protocol,obj))+1:]: 
-                if obj.checkCollision(obj2):
-                    # updates velocity, shields, etc. for both
-                    obj.processCollision(timestamp,obj2) 
-                    # update state
-                    self.sendObjectToPeers(protocol,obj)           
-                    self.sendObjectToPeers(protocol2,obj2)
-                    
-        # figure out what needs to be dropped and keep the living bullets
-        self.bulletlist = dict([(objid,obj) for objid,obj in 
-            self.bulletlist.items() if obj.isalive])
+        # bin the solids in the broadphase grid by cached position
+        self.grid.clear()
+        indexbyid = {}
+        for index,(dummy, obj) in enumerate(items):
+            self.grid.insert(index, obj.Xcache, obj.radius)
+            indexbyid[obj.objectid] = index
+        profiler.lap('broadphase')
+        # collisions with objects (bullets, etc.) - one batched, swept test
+        # covering the time since the last poll
+        bullets = self.bulletlist.values()
+        if bullets and items:
+            world = self.world
+            solidslots = [obj.slot for dummy,obj in items]
+            bulletslots = [bullet.slot for bullet in bullets]
+            sweep = (timestamp - world.timestamp[bulletslots]).clip(0, 
+                interval)
+            hits, away = bulletHits(world.Xcache[solidslots],
+                world.Vcache[solidslots],
+                world.radius[solidslots],
+                array([obj.objectid for dummy,obj in items]),
+                world.Xcache[bulletslots],
+                world.Vcache[bulletslots],
+                array([bullet.away for bullet in bullets]),
+                array([bullet.shooterid for bullet in bullets]),
+                sweep,
+                self.gamedimensions)
+            for bullet,isaway in zip(bullets, away.tolist()):
+                bullet.away = isaway
+            profiler.lap('bullets')
+            for index,bulletindex,before in hits:
+                protocol,obj = items[index]
+                bullet = bullets[bulletindex]
+                hittime = timestamp - before
+                if type(obj) is MMOSSShip:
+                    if obj.processCollision(hittime,bullet):
+                        # survived, update shield levels
+                        protocol.sendServerPrivateObjectStateEvent(obj) 
+                    else:
+                        # not survived, update shooter stats
+                        self.playerstats.kill(bullet.shooter.objectname) 
+                else:
+                    obj.processCollision(hittime,bullet)
+                for d in self.clientdata:   
+                    # drop the bullets for everyone
+                    d.sendServerObjectDropEvent(bullet, hittime)
+                if not bullet.isalive:
+                    self.dropBullet(bullet)
+            profiler.lap('bullethits')
+        # collisions with peer ships or asteroids - pairs sharing a grid cell
+        # plus pairs that were in contact last time (so they can separate)
+        pairs = dict(((i,j),(i,j)) for i,j in self.grid.candidatePairs())
+        for index,(dummy, obj) in enumerate(items):
+            for otherobj in obj.collidingwith:
+                otherindex = indexbyid.get(otherobj.objectid)
+                if not otherindex is None:
+                    pairs[(min(index,otherindex),max(index,otherindex))] = \
+                        (index,otherindex)
+        for index,index2 in sorted(pairs.values()):
+            protocol,obj = items[index]
+            protocol2,obj2 = items[index2]
+            if obj.checkCollision(obj2):
+                # updates velocity, shields, etc. for both
+                obj.processCollision(timestamp,obj2) 
+                # update state
+                self.sendObjectToPeers(protocol,obj)           
+                self.sendObjectToPeers(protocol2,obj2)
+        profiler.lap('solids')
+        # figure out what needs to be dropped
         dropships = [protocol for protocol,ship in self.clientdata.items() 
             if not ship.isalive]
         for protocol in dropships: self.dropClient(protocol)
-        self.skippollcount = math.trunc((time.time()-timestamp)/POLLRATE)
+        profiler.lap('dropships')
+        # one state message per client for everything that changed
+        self.flushObjectStates()
+        self.outbound.end()
+        profiler.lap('snapshots')
+        if profiler.enabled:
+            # what the flush at the end of the cycle could not send
+            profiler.sample(QUEUEDEPTH, max([d.outbox.depth() for d in 
+                self.clientdata] or [0]))
+        profiler.end()
+
+    def dropBullet(self, bullet):
+        """Remove a dead bullet from the server.
+        
+        Arguments:
+        bullet - Reference to the bullet object.
+        """
+        self.bulletexpiry.cancel(bullet.objectid)
+        self.pendingstate.pop(bullet.objectid, None)
+        self.world.detach(bullet)
+        del self.bulletlist[bullet.objectid]
+
+    def scheduleFuelOut(self, protocol, ship):
+        """(Re)arm the fuel out event for a ship. This must be called
+        whenever processCommand changes the fuel use rate.
+        
+        Arguments:
+        protocol - Reference to the connection that owns the ship.
+        ship - Reference to the ship object.
+        """
+        if ship.fuelouttime < 1E3000:
+            self.fuelouts.schedule(protocol, ship.fuelouttime)
+        else:
+            self.fuelouts.cancel(protocol)
 
     def sendAllObjects(self, protocol):
         """Send complete state information for all server objects to a single
@@ -116,13 +228,17 @@ class Server(object):
         Arguments:
         protocol - Reference to a client connection.
         """
+        if not protocol.viewport is None:
+            # everything in view will be sent with the next snapshot
+            protocol.visible = set()
+            return
         objects = self.clientdata.items() + self.asteroidlist.items()
         for key,obj in objects:
             if not key is protocol:
                 protocol.sendServerObjectJoinEvent(obj)
-            protocol.sendServerObjectStateEvent(obj)
-        for obj in self.bulletlist.values():
-            protocol.sendServerObjectStateEvent(obj) # all other objects
+        # all object states, including bullets
+        protocol.sendServerWorldSnapshotEvent([obj for key,obj in objects] + 
+            self.bulletlist.values())
     
     def sendNewObjectToPeers(self, protocol, obj):
         """Send complete state information for a new server object to all
@@ -138,20 +254,130 @@ class Server(object):
                 d.sendServerObjectJoinEvent(obj)
             
     def sendObjectToPeers(self, protocol, obj):
-        """Send the object state information to all peer connections.
+        """Send the object state information to all peer connections. The
+        public state is sent with the next world snapshot (see 
+        flushObjectStates).
         
         Arguments: 
         protocol - Reference to a client connection that originated the state
         update.
         obj - Reference to the object that needs to be sent to all.
         """
-        for d in self.clientdata:
-            # public data
-            d.sendServerObjectStateEvent(obj) 
+        # public data
+        self.pendingstate[obj.objectid] = obj
         if type(obj) == MMOSSShip:
             # private data to owner
             protocol.sendServerPrivateObjectStateEvent(obj) 
 
+    def flushObjectStates(self):
+        """Send the state of every object changed since the last flush to 
+        all peer connections, as one world snapshot per connection. Clients
+        that reported a viewport only get objects in or near it, and are 
+        sent join and drop events as objects enter and leave it. Objects
+        in snapshots that were never acknowledged are sent again.
+        """
+        pending = self.pendingstate
+        self.pendingstate = {}
+        for d in self.clientdata:
+            d.expireSnapshots(self.lastpolltime)
+        viewing = [d for d in self.clientdata if not d.viewport is None]
+        if viewing:
+            objects = self.buildInterest()
+            for d in viewing:
+                self.updateInterest(d, objects, pending)
+        if not pending:
+            return
+        everyone = pending.values()
+        for d in self.clientdata:
+            if d.viewport is None:
+                d.sendServerWorldSnapshotEvent(everyone)
+
+    def buildInterest(self):
+        """Bin every object in the interest grid by cached position.
+        
+        Returns dictionary of objects keyed by ID.
+        """
+        objects = dict((obj.objectid, obj) for obj in 
+            self.clientdata.values() + self.asteroidlist.values() + 
+            self.bulletlist.values())
+        self.interest.clear()
+        for objectid,obj in objects.items():
+            self.interest.insert(objectid, obj.Xcache, obj.radius)
+        return objects
+
+    def updateInterest(self, protocol, objects, pending):
+        """Bring a client up to date with the objects in or near its 
+        viewport: drop the ones that left, join the ones that entered and
+        send the state of those that entered or changed.
+        
+        Arguments:
+        protocol - Reference to a client connection with a viewport.
+        objects - Dictionary of all objects keyed by ID (see buildInterest).
+        pending - Dictionary of changed objects keyed by ID.
+        """
+        x, y, width, height = protocol.viewport
+        inview = self.interest.queryRect(x - VIEWPORTMARGIN, 
+            y - VIEWPORTMARGIN, width + 2*VIEWPORTMARGIN, 
+            height + 2*VIEWPORTMARGIN)
+        ship = self.clientdata.get(protocol)
+        if ship:
+            # always see your own ship
+            inview.add(ship.objectid)
+        for objectid in protocol.visible - inview:
+            if objectid in objects:
+                protocol.sendServerObjectDropEvent(objects[objectid], 
+                    self.lastpolltime)
+            else:
+                protocol.visible.discard(objectid)
+        entering = inview - protocol.visible
+        protocol.visible.update(entering)
+        tosend = []
+        for objectid in entering:
+            obj = objects[objectid]
+            if not obj is ship:
+                protocol.sendServerObjectJoinEvent(obj)
+            tosend.append(obj)
+        tosend.extend(obj for objectid,obj in pending.items() 
+            if objectid in inview and not objectid in entering)
+        if tosend:
+            protocol.sendServerWorldSnapshotEvent(tosend)
+
+    def resendObjects(self, protocol, objectids):
+        """Send the current state of objects again to a client that missed
+        their last update.
+        
+        Arguments:
+        protocol - Reference to a client connection.
+        objectids - Collection of object IDs.
+        """
+        objects = dict((obj.objectid, obj) for obj in 
+            self.clientdata.values())
+        objects.update(self.asteroidlist)
+        objects.update(self.bulletlist)
+        if not protocol.viewport is None:
+            objectids = [objectid for objectid in objectids 
+                if objectid in protocol.visible]
+        tosend = [objects[objectid] for objectid in objectids 
+            if objectid in objects]
+        if tosend:
+            protocol.sendServerWorldSnapshotEvent(tosend)
+
+    def setViewport(self, protocol, x, y, width, height):
+        """Record the area of the game field a client displays.
+        
+        Arguments:
+        protocol - Reference to a client connection.
+        x - Left edge of the viewport.
+        y - Bottom edge of the viewport.
+        width - Width of the viewport.
+        height - Height of the viewport.
+        """
+        if protocol.viewport is None:
+            # until now the client has been sent everything
+            protocol.visible = set(obj.objectid for obj in 
+                self.clientdata.values() + self.asteroidlist.values() + 
+                self.bulletlist.values())
+        protocol.viewport = (x, y, width, height)
 
     def dropClient(self, protocol):
         """Send a drop event to all peer connections for the ship object
@@ -167,6 +393,10 @@ class Server(object):
                 d.sendServerObjectDropEvent(objtodrop, timestamp)
             # update stats
             self.playerstats.killed(objtodrop.objectname)
+            self.pendingstate.pop(objtodrop.objectid, None)
+            self.images.release(objtodrop.imagehash)
+            self.world.detach(objtodrop)
+            self.fuelouts.cancel(protocol)
             self.clientdata.pop(protocol)    # remove the client from our list
                 
     def spawnAsteroids(self, density):
@@ -188,6 +418,7 @@ class Server(object):
                 rr=random.random()-0.5,
                 radius=radius)
             self.spawnObjectLocation(newasteroid)   # revise location
+            self.world.attach(newasteroid)
             self.asteroidlist[newid] = newasteroid
     
     def spawnObjectLocation(self, newobj):
@@ -212,13 +443,14 @@ class Server(object):
                 obj.cachePosition(timestamp-obj.timestamp)
                 colliding = colliding or newobj.insideCollisionDistance(obj) 
 
-    def processClientControl(self, protocol, timestamp, thrust, ccwthrust, 
-        shootv, shoote):
+    def processClientControl(self, protocol, sequence, timestamp, thrust, 
+        ccwthrust, shootv, shoote):
         """Process control message (thrust, weapon firing) and send updated
         objects to all connected peers.
         
         Arguments:
         protocol - Reference to a connection to the controlling client.
+        sequence - Input sequence number of the control event.
         timestamp - Server timestamp (estimated) for the control event.
         thrust - Value of commanded thrust (+ forward, - backwards).
         ccwthrust - Value of rotaitonal thrust (+ ccw).
@@ -230,16 +462,21 @@ class Server(object):
         ship = self.clientdata[protocol]
         controlling, bullet = ship.processCommand(timestamp, thrust, 
             ccwthrust, shootv, shoote)
+        ship.lastsequence = sequence
+        self.scheduleFuelOut(protocol, ship)
         if controlling:
             self.sendObjectToPeers(protocol, ship)
         if bullet:
             bullet.objectid = self.getNewID()
+            self.world.attach(bullet)
             self.bulletlist[bullet.objectid] = bullet
+            self.bulletexpiry.schedule(bullet.objectid, bullet.endoflife)
             self.sendObjectToPeers(protocol, bullet)
-            protocol.sendServerPrivateObjectStateEvent(ship)
+        # the owner always learns which input has been processed
+        protocol.sendServerPrivateObjectStateEvent(ship)
             
-    def joinClient(self, protocol, shipname, radius, wmax, fmax, smax, image, 
-            thrustimg, bulletimg):
+    def joinClient(self, protocol, shipname, radius, wmax, fmax, smax, 
+            imagehash, thrustimg, bulletimg):
         """Process a join request message received from a client.
         
         Arguments:
@@ -249,7 +486,7 @@ class Server(object):
         wmax - Maximum weapon health level.
         fmax - Maximum fuel level.
         smax - Maximum shield level.
-        image - Binary image exported from pygame.
+        imagehash - Hash of the ship image (already in the image store).
         thrustimg - Binary imnage of thrust.
         bulletimg - Binary image of a projectile.
         Returns: Tuple with (ID of joined player, horizontal, vertical size
@@ -263,13 +500,15 @@ class Server(object):
             fmax=fmax, 
             wmax=wmax, 
             smax=smax, 
-            image=image,
             thrustimg=thrustimg,
             bulletimg=bulletimg,
             x=0,
             y=0 )
+        newship.imagehash = imagehash
         self.spawnObjectLocation(newship)   # revise location
+        self.world.attach(newship)
         self.clientdata[protocol] = newship
+        self.scheduleFuelOut(protocol, newship)
         self.sendNewObjectToPeers(protocol,newship)
         self.sendObjectToPeers(protocol,newship)
         newship.ischanged = False
@@ -289,6 +528,20 @@ class Server(object):
             protocol.sendServerPlayerStatsEvent(player)
         protocol.sendServerPlayerStatsEvent(PlayerStats.Player("",0,0,0))
 
+    def sendProfile(self, protocol):
+        """Send tick engine statistics, the statistics of the client's own
+        outbound queue and poll cycle phase timing.
+        
+        Arguments:
+        protocol - Reference to the client that requested the profile.
+        """
+        protocol.sendServerTickStatsEvent(self.tickengine.getStats())
+        protocol.sendServerQueueStatsEvent(protocol.outbox.getStats())
+        for phase in self.profiler.getPhases():
+            protocol.sendServerTickProfileEvent(phase, 
+                *self.profiler.percentiles(phase))
+        protocol.sendServerTickProfileEvent("",0,0.0,0.0,0.0)
+
     def getNewID(self):
         """Generate a unique ID for a new object.
         
@@ -299,10 +552,12 @@ class Server(object):
 
 
     def run(self):
-        """Execute the Twisted ServerFActory and listen on the mMOSS TCP port.
+        """Execute the Twisted ServerFActory and listen on the mMOSS TCP port
+        (and the same UDP port for datagram channels).
         """
         pf = ServerFactory(self)
         reactor.listenTCP(self.port, pf)
+        reactor.listenUDP(self.port, self.datagrams)
         reactor.run()
 
 
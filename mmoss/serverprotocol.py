@@ -15,6 +15,10 @@ from twisted.internet import protocol
 from mmoss.network import *
 from mmoss.utility import *
 from mmoss.server import *
+from mmoss.encoding import DeltaEncoder, MAXRECORDS, gatherStates
+from mmoss.imagecache import ImageCache
+from mmoss.outbound import OutboundQueue
+from mmoss.datagram import DATAGRAMRECORDS
 
 __author__ = "Eric Dennison"
 
@@ -33,9 +37,26 @@ class ServerProtocol(amp.AMP):
         logging.info("connectionMade: transport %s" % 
             (self.transport.client.__str__()))
         self.server = self.factory.server
+        self.snapshots = DeltaEncoder()
+        # area of interest: None for the whole game field
+        self.viewport = None
+        self.visible = set()
+        # mirror of the images the client has cached
+        self.images = ImageCache()
+        # everything for the client goes through the queue, which stops
+        # sending while the transport is backed up
+        self.outbox = OutboundQueue(self, self.server.outbound)
+        self.transport.registerProducer(self.outbox, True)
+        # snapshots go by UDP once the client has said hello
+        self.datagramtoken = None
+        self.datagramaddress = None
 
     def connectionLost(self, data):
         """Notify the server that a connecton has been lost."""
+        logging.info("connectionLost: outbound queue %s" % 
+            (self.outbox.getStats()))
+        self.outbox.stopProducing()
+        self.server.datagrams.unregister(self)
         self.server.dropClient(self)
         self.server = None
 
@@ -62,7 +83,7 @@ class ServerProtocol(amp.AMP):
         wmax - Maximum weapon health level (0-100).
         fmax - Maximum fuel level (0-100).
         smax - Maximum shield level (0-100).
-        image - Bitmap image of the ship icon (pygame export).
+        image - Bitmap image of the ship icon (compressed pygame export).
         imagex - Width of the ship image.
         imagey - Height of the ship image.
         thrustimg - Bitmap image of the ship thrust (e.g. flame).
@@ -74,7 +95,7 @@ class ServerProtocol(amp.AMP):
             abs(wmax),
             abs(fmax),
             abs(smax),
-            pygame.image.fromstring(image, (imagex,imagey),"RGBA"), 
+            self.server.images.add(image, imagex, imagey), 
             thrustimg, 
             bulletimg)
         return {'shipid':newid, 'time':time.time(), 'gamewidth':gamewidth, 
@@ -83,10 +104,12 @@ class ServerProtocol(amp.AMP):
     ClientJoinRequest.responder(joinRequest)
 
     # ClientControlEvent
-    def controlCommand(self, timestamp, thrust, ccwthrust, shootv, shoote):
+    def controlCommand(self, sequence, timestamp, thrust, ccwthrust, shootv,
+        shoote):
         """Notify server of a player control command.
 
         Message attributes:
+        sequence - Input sequence number.
         timestamp - Timestamp of control event.
         thrust - Forward/reverse thrust force.
         ccwthrust - Counter-clockwise thrust impulse.
@@ -94,6 +117,7 @@ class ServerProtocol(amp.AMP):
         shoote - Energy of a fired bullet.
         """
         self.server.processClientControl(self,
+            sequence,
             timestamp,
             thrust,
             ccwthrust,
@@ -103,6 +127,55 @@ class ServerProtocol(amp.AMP):
 
     ClientControlEvent.responder(controlCommand)
 
+    def snapshotAck(self, sequence, missing):
+        """Notify server that the client has applied a world snapshot.
+        
+        Arguments:
+        sequence - Sequence number of the snapshot.
+        missing - IDs of the objects the client could not decode.
+        """
+        skipped = self.snapshots.ack(sequence, missing)
+        if skipped:
+            # lost, discarded out of order or without a baseline
+            self.server.resendObjects(self, skipped)
+        return {}
+
+    ClientSnapshotAck.responder(snapshotAck)
+
+    def expireSnapshots(self, now):
+        """Send again the objects of snapshots the client has not
+        acknowledged in time.
+        
+        Arguments:
+        now - Current server time.
+        """
+        expired = self.snapshots.expire(now)
+        if expired:
+            self.server.resendObjects(self, expired)
+
+    def datagramRequest(self):
+        """Notify server that the client wants world snapshots by UDP 
+        datagram.
+        """
+        return {'token':self.server.datagrams.register(self), 
+            'port':self.server.port}
+
+    ClientDatagramRequest.responder(datagramRequest)
+
+    def viewportEvent(self, x, y, width, height):
+        """Notify server of the area of the game field the client displays.
+        
+        Arguments:
+        x - Left edge of the viewport.
+        y - Bottom edge of the viewport.
+        width - Width of the viewport.
+        height - Height of the viewport.
+        """
+        self.server.setViewport(self, x, y, width, height)
+        return {}
+
+    ClientViewportEvent.responder(viewportEvent)
+
     def genericRequest(self, request):
         """Notify server of a generic client request.
         
@@ -110,9 +183,13 @@ class ServerProtocol(amp.AMP):
         request - String code for a request.
         """
         if request == REQUEST_FULLUPDATE:
+            # the client has thrown away its baselines
+            self.snapshots.reset()
             self.server.sendAllObjects(self)
         elif request == REQUEST_STATSUPDATE:
             self.server.sendStats(self)
+        elif request == REQUEST_PROFILE:
+            self.server.sendProfile(self)
         return {'result':1}
         
     ClientGenericRequest.responder(genericRequest)
@@ -133,13 +210,36 @@ class ServerProtocol(amp.AMP):
     # Functions to call from the server
     #
 
+    def callRemote(self, command, **kw):
+        """Send a message to the client (counted by the tick profiler)."""
+        self.factory.server.profiler.countMessage()
+        return amp.AMP.callRemote(self, command, **kw)
+
+    def writeEncoded(self, data):
+        """Send an encoded message to the client (see MessageCache).
+        
+        Arguments:
+        data - Encoded message bytes.
+        """
+        self.factory.server.profiler.countMessage()
+        self.transport.write(data)
+
     def sendServerObjectStateEvent(self, obj):
+        """Queue the object state for the client (it is sent with the next
+        world snapshot).
+        
+        Arguments: 
+        obj - Reference to an object.
+        """
+        self.outbox.queueStates([obj])
+
+    def writeServerObjectStateEvent(self, obj):
         """Generate the server object state event.
         
         Arguments: 
         obj - Reference to an object.
         """
-        logging.info("sendServerObjectStateEvent: %s" %(obj))
+        logging.info("writeServerObjectStateEvent: %s" %(obj))
         self.callRemote(ServerObjectStateEvent,
             objectid=obj.objectid,
             objecttype=obj.OBJECTTYPE,
@@ -152,27 +252,78 @@ class ServerProtocol(amp.AMP):
             a=obj.a,
             r=obj.r,
             rr=obj.rr)
+
+    def sendServerWorldSnapshotEvent(self, objects):
+        """Queue object states for the client. States still waiting from
+        earlier ticks are replaced, so a client that is not keeping up gets
+        only the latest state of each object.
+        
+        Arguments:
+        objects - List of object references.
+        """
+        self.outbox.queueStates(objects)
+
+    def writeServerWorldSnapshotEvent(self, objects):
+        """Generate server world snapshot events, delta encoded against the
+        last snapshot acknowledged by the client.
+        
+        Arguments:
+        objects - List of object references.
+        """
+        ids, states = gatherStates(objects)
+        address = self.datagramaddress
+        chunk = MAXRECORDS if address is None else DATAGRAMRECORDS
+        now = time.time()
+        for start in range(0, len(ids), chunk):
+            sequence, basetime, data = self.snapshots.encode(
+                ids[start:start+chunk], states[start:start+chunk], now)
+            logging.info("writeServerWorldSnapshotEvent: %d: %d bytes" % 
+                (sequence, len(data)))
+            if address is None:
+                self.callRemote(ServerWorldSnapshotEvent,
+                    sequence=sequence,
+                    sendtime=now,
+                    basetime=basetime,
+                    states=data)
+            else:
+                self.factory.server.profiler.countMessage()
+                self.server.datagrams.sendSnapshot(address, sequence, 
+                    now, basetime, data)
         
     def sendServerObjectJoinEvent(self, obj):
-        """Generate the server object joined event.
+        """Generate the server object joined event. The event is encoded
+        once for all the clients it is sent to (twice for a ship: with and
+        without the image).
         
         Arguments: 
         obj - Reference to an object.
         """
+        if not self.viewport is None and not obj.objectid in self.visible:
+            # it will be sent when it comes into view
+            return
         logging.info("sendServerObjectJoinEvent: %s" % (obj))
         if type(obj) is MMOSSShip:
-            self.callRemote(ServerObjectJoinEvent,
+            image, imagex, imagey = self.server.images.get(obj.imagehash)
+            if self.images.touch(obj.imagehash):
+                # the client has it already
+                image = ""
+            else:
+                self.images.add(obj.imagehash)
+            self.outbox.pushEncoded(self.server.messages.encode(
+                ServerObjectJoinEvent, (obj.objectid, bool(image)),
                 objectid=obj.objectid,
                 objecttype=obj.OBJECTTYPE,
                 objectname=obj.objectname,
                 radius=obj.radius,
-                image=pygame.image.tostring(obj.image,"RGBA"),
-                imagex=obj.image.get_width(),
-                imagey=obj.image.get_height(),
+                image=image,
+                imagex=imagex,
+                imagey=imagey,
+                imagehash=obj.imagehash,
                 thrustimg="",
-                bulletimg="")
+                bulletimg=""))
         elif type(obj) is MMOSSAsteroid:
-            self.callRemote(ServerObjectJoinEvent,
+            self.outbox.pushEncoded(self.server.messages.encode(
+                ServerObjectJoinEvent, obj.objectid,
                 objectid=obj.objectid,
                 objecttype=obj.OBJECTTYPE,
                 objectname="",
@@ -180,36 +331,69 @@ class ServerProtocol(amp.AMP):
                 image="",
                 imagex=0,
                 imagey=0,
+                imagehash="",
                 thrustimg="",
-                bulletimg="")
+                bulletimg=""))
 
     def sendServerPrivateObjectStateEvent(self, obj):
-        """Generate a server private object state event.
+        """Queue a private state update for the client (replacing any that
+        is still waiting for the same ship).
+        
+        Arguments:
+        obj - Reference to an object.
+        """
+        self.outbox.queuePrivate(obj)
+
+    def writeServerPrivateObjectStateEvent(self, obj):
+        """Generate a server private object state event, with the 
+        authoritative state of the client's own ship and the sequence number
+        of the last input processed.
         
         Arguments:
         obj - Reference to an object.
         """
-        logging.info("sendServerPrivateObjectStateEvent: private id: "
-            "%d wlevel: %f flevel: %f slevel: %f" % (obj.objectid, 
-                obj.wlevel, obj.flevel, obj.slevel))
+        logging.info("writeServerPrivateObjectStateEvent: private id: "
+            "%d wlevel: %f flevel: %f slevel: %f sequence: %d" % 
+                (obj.objectid, obj.wlevel, obj.flevel, obj.slevel, 
+                obj.lastsequence))
+        X = obj.X
+        V = obj.V
         self.callRemote(ServerPrivateObjectStateEvent,
             objectid=obj.objectid,
             wlevel=obj.wlevel,
             flevel=obj.flevel,
-            slevel=obj.slevel)
-
+            slevel=obj.slevel,
+            sequence=obj.lastsequence,
+            eventtime=obj.timestamp,
+            x=X[0],
+            y=X[1],
+            vx=V[0],
+            vy=V[1],
+            a=obj.a,
+            r=obj.r,
+            rr=obj.rr)
 
     def sendServerObjectDropEvent(self, obj, time):
-        """Generate a server object drop event.
+        """Generate a server object drop event (encoded once for all the
+        clients it is sent to).
         
         Arguments:
         obj - Reference to an object.
         time - Timestamp of the drop event.
         """
+        if not self.viewport is None:
+            if not obj.objectid in self.visible:
+                # the client does not know about it
+                return
+            self.visible.discard(obj.objectid)
         logging.info("sendServerObjectDropEvent: %s" % (obj))
-        self.callRemote(ServerObjectDropEvent,
+        self.snapshots.forget(obj.objectid)
+        # states still waiting for a dropped object are stale
+        self.outbox.discard(obj.objectid)
+        self.outbox.pushEncoded(self.server.messages.encode(
+            ServerObjectDropEvent, (obj.objectid, time),
             objectid=obj.objectid,
-            eventtime=time)
+            eventtime=time))
         
     def sendServerPlayerStatsEvent(self, player):
         """Generate a player statistics event for a single player.
@@ -220,12 +404,55 @@ class ServerProtocol(amp.AMP):
         logging.info("sendServerStatsEvent: %s %f %d %s" % 
             (player.name, player.playtime, player.killcount, 
                 player.killedcount))
-        self.callRemote(ServerPlayerStatsEvent, 
+        self.outbox.push(ServerPlayerStatsEvent, 
             playername=player.name,
             playtime=player.playtime,
             killcount=player.killcount,
             killedcount=player.killedcount)
 
+    def sendServerTickStatsEvent(self, stats):
+        """Generate a tick engine statistics event.
+        
+        Arguments:
+        stats - Dictionary of statistics from TickEngine.getStats().
+        """
+        self.outbox.push(ServerTickStatsEvent,
+            tick=stats['tick'],
+            overruns=stats['overruns'],
+            skipped=stats['skipped'],
+            meanduration=stats['meanduration'],
+            maxduration=stats['maxduration'])
+
+    def sendServerQueueStatsEvent(self, stats):
+        """Generate an outbound queue statistics event.
+        
+        Arguments:
+        stats - Dictionary of statistics from OutboundQueue.getStats().
+        """
+        self.outbox.push(ServerQueueStatsEvent,
+            priority=stats['priority'],
+            private=stats['private'],
+            states=stats['states'],
+            peakdepth=stats['peakdepth'],
+            pauses=stats['pauses'])
+
+    def sendServerTickProfileEvent(self, phase, samples, p50, p95, p99):
+        """Generate a poll cycle phase timing event for a single phase.
+        
+        Arguments:
+        phase - Name of the phase (empty string when done).
+        samples - Number of poll cycles in the rolling window.
+        p50 - Median time in phase.
+        p95 - 95th percentile time in phase.
+        p99 - 99th percentile time in phase.
+        """
+        self.outbox.push(ServerTickProfileEvent,
+            phase=phase,
+            samples=samples,
+            p50=p50,
+            p95=p95,
+            p99=p99)
+
 class ServerFactory(protocol.ServerFactory):
     """Twisted protocol factory for instantiating server protocol."""
     protocol = ServerProtocol
@@ -0,0 +1,148 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+Classes defined:
+1. TickEngine - Fixed timestep driver for the server poll cycle.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+
+from __future__ import division
+import math
+import time
+import logging
+from twisted.internet import reactor
+
+__author__ = "Eric Dennison"
+
+OVERRUN_SKIP = "skip"
+"""Overrun policy: drop the tick slots that were missed."""
+
+OVERRUN_CATCHUP = "catchup"
+"""Overrun policy: run the missed ticks back to back (up to MAXCATCHUP)."""
+
+OVERRUN_STRETCH = "stretch"
+"""Overrun policy: start the next tick one interval after the late one."""
+
+OVERRUNPOLICIES = [OVERRUN_SKIP, OVERRUN_CATCHUP, OVERRUN_STRETCH]
+
+MAXCATCHUP = 5
+"""Maximum number of missed ticks to run back to back before skipping."""
+
+REPORTTICKS = 500
+"""Number of ticks between tick engine log reports."""
+
+
+class TickEngine(object):
+
+    """Call a function at a fixed target rate with a monotonically increasing
+    tick number, measure how long each tick takes and apply a defined policy
+    when a tick overruns its time slot.
+    """
+
+    def __init__(self, callback, interval, policy=OVERRUN_SKIP):
+        """Create a tick engine (call start() to run it).
+
+        Arguments:
+        callback - Function called once per tick with the tick timestamp.
+        interval - Target seconds per tick.
+        policy - One of OVERRUNPOLICIES.
+        """
+        if not policy in OVERRUNPOLICIES:
+            raise ValueError("unknown overrun policy: %s" % (policy))
+        self.callback = callback
+        self.interval = interval
+        self.policy = policy
+        self.tick = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lastduration = 0.0
+        self.maxduration = 0.0
+        self.totalduration = 0.0
+        self.nexttime = 0.0
+        self.delayedcall = None
+        self.reportoverruns = 0
+
+    def start(self):
+        """Run the first tick now and schedule the following ones."""
+        self.nexttime = time.time()
+        self.runTicks()
+
+    def stop(self):
+        """Stop calling the tick function."""
+        if self.delayedcall and self.delayedcall.active():
+            self.delayedcall.cancel()
+        self.delayedcall = None
+
+    def runTick(self, ticktime):
+        """Run a single tick and account for its duration.
+
+        Arguments:
+        ticktime - Timestamp handed to the tick function.
+        """
+        start = time.time()
+        self.callback(ticktime)
+        self.lastduration = time.time() - start
+        self.totalduration = self.totalduration + self.lastduration
+        self.maxduration = max(self.maxduration, self.lastduration)
+        self.tick = self.tick + 1
+        if not self.tick % REPORTTICKS:
+            self.report()
+
+    def runTicks(self):
+        """Run the tick that is due, handle any overrun and schedule the
+        next tick.
+        """
+        self.delayedcall = None
+        if self.policy == OVERRUN_CATCHUP:
+            # simulation time advances by exactly one interval per tick
+            self.runTick(self.nexttime)
+        else:
+            self.runTick(time.time())
+        self.nexttime = self.nexttime + self.interval
+        now = time.time()
+        if now > self.nexttime:
+            # the tick slot was overrun
+            self.overruns = self.overruns + 1
+            if self.policy == OVERRUN_CATCHUP:
+                catchup = 0
+                while now > self.nexttime and catchup < MAXCATCHUP:
+                    self.runTick(self.nexttime)
+                    self.nexttime = self.nexttime + self.interval
+                    catchup = catchup + 1
+                    now = time.time()
+            if self.policy == OVERRUN_STRETCH:
+                self.nexttime = now + self.interval
+            elif now > self.nexttime:
+                missed = int(math.floor((now - self.nexttime)/self.interval))+1
+                self.skipped = self.skipped + missed
+                self.nexttime = self.nexttime + missed*self.interval
+        self.delayedcall = reactor.callLater(max(0.0, self.nexttime - now),
+            self.runTicks)
+
+    def getStats(self):
+        """Report tick engine statistics.
+
+        Returns dictionary with tick count, overrun count, skipped tick count,
+        last, mean and maximum tick durations (seconds).
+        """
+        return {'tick':self.tick,
+            'overruns':self.overruns,
+            'skipped':self.skipped,
+            'lastduration':self.lastduration,
+            'meanduration':self.totalduration/max(1,self.tick),
+            'maxduration':self.maxduration}
+
+    def report(self):
+        """Log a summary of tick engine statistics. Overruns since the last
+        report are logged as a warning.
+        """
+        stats = self.getStats()
+        message = ("tick %(tick)d: overruns %(overruns)d, skipped "
+            "%(skipped)d, mean %(meanduration)f s, max %(maxduration)f s" %
+            stats)
+        if self.overruns > self.reportoverruns:
+            logging.warning(message)
+        else:
+            logging.info(message)
+        self.reportoverruns = self.overruns
@@ -7,6 +7,7 @@ such as player ships, asteroids, bullets, etc.
 Classes defined:
 
 #. :class:`MMOSSFactory` - MMOSSObject factory
+#. :class:`MMOSSObjectType` - Metaclass of game objects.
 #. :class:`MMOSSObject` - Base class for game objects.
 #. :class:`MMOSSBullet` - Bullet object.
 #. :class:`MMOSSSolid` - Base class for objects with mass/dimensions.
@@ -19,8 +20,11 @@ from __future__ import division
 import time
 import math
 import pygame
-from numpy import array, linalg, dot
+from copy import copy
+from collections import deque
+from numpy import array, linalg, dot, ndarray
 from parametric import Parametric
+from worldstate import WorldStateField
 
 __author__ = "Eric Dennison"
 
@@ -82,6 +86,10 @@ rocky things"""
 CR = 0.95
 """Coefficient of restitution defines degree of energy loss in collisions."""
 
+STATEHISTORY = 32
+"""Maximum number of server states buffered for playback by a displayable 
+object."""
+
 
 #
 # Definitions for MMOSS Objects
@@ -92,6 +100,19 @@ MMOSSBulletType = "bullet"
 MMOSSAsteroidType = "asteroid"
 MMOSSSolidType = "solid"
 
+class MMOSSObjectType(type):
+    """Metaclass of game objects. It counts the game object classes 
+    defined, so that MMOSSFactory can tell when its registry is out of date.
+    """
+
+    generation = 0
+    """Number of game object classes defined so far."""
+
+    def __init__(cls, name, bases, namespace):
+        super(MMOSSObjectType, cls).__init__(name, bases, namespace)
+        MMOSSObjectType.generation = MMOSSObjectType.generation + 1
+
+
 class MMOSSObject(object):
     """Generic MMOSS game entity base class.
     
@@ -108,8 +129,21 @@ class MMOSSObject(object):
     :keyword image: Reference to pygame image.
     """
 
+    __metaclass__ = MMOSSObjectType
+
+    # dynamic state, optionally held in a WorldState slot
+    X = WorldStateField('X', vector=True)
+    V = WorldStateField('V', vector=True)
+    a = WorldStateField('a')
+    r = WorldStateField('r')
+    rr = WorldStateField('rr')
+    timestamp = WorldStateField('timestamp')
+    radius = WorldStateField('radius')
+
     def __init__(self, *args, **kwargs):
         super(MMOSSObject, self).__init__()
+        self.world = None
+        self.slot = None
         self.radius = 0
         self.ischanged = True
         self.isalive = True
@@ -130,12 +164,41 @@ class MMOSSObject(object):
         """Copy server-determined info into an existing object.
         """
         self.timestamp = obj.timestamp
-        self.X = obj.X
-        self.V = obj.V
+        self.X = obj.X.copy()
+        self.V = obj.V.copy()
         self.a = obj.a
         self.r = obj.r
         self.rr = obj.rr
 
+    def setDynamics(self, timestamp, x, y, vx, vy, a, r, rr):
+        """Set server-determined info in an existing object. Position and 
+        velocity are written into the existing arrays (no allocation) unless
+        the object lives in a WorldState.
+        
+        :param timestamp: Server timestamp of the state.
+        :param x: X coordinate of position.
+        :param y: Y coordinate of position.
+        :param vx: X component of velocity.
+        :param vy: Y component of velocity.
+        :param a: Axial acceleration.
+        :param r: Direction object is pointing (radians, zero right).
+        :param rr: Rotational rate of object (radians per second).
+        """
+        self.timestamp = timestamp
+        if self.world is None:
+            X = self.X
+            X[0] = x
+            X[1] = y
+            V = self.V
+            V[0] = vx
+            V[1] = vy
+        else:
+            self.X = (x, y)
+            self.V = (vx, vy)
+        self.a = a
+        self.r = r
+        self.rr = rr
+
     def directionVector(self):
         """Return a unit vector aligned with the object direction.
         """
@@ -240,15 +303,77 @@ class MMOSSObject(object):
 
 class MMOSSDisplayableObject(MMOSSObject):
     """Generic MMOSS game entity base class that can be displayed.
+
+    The states received from the server are buffered so that the object can
+    be displayed a little in the past (see playback), when the state that
+    applies has usually arrived already.
     """
 
     def __init__(self, *args, **kwargs):
         super(MMOSSDisplayableObject, self).__init__(*args, **kwargs)
         self.dirtyrects = []
         self.client = kwargs.pop('client', None)
+        self.history = deque(maxlen=STATEHISTORY)
         # z order. Lower numbers render first
         self.z = 1
 
+    def setDynamics(self, timestamp, x, y, vx, vy, a, r, rr):
+        """Set server-determined info and buffer it for playback.
+        
+        :param timestamp: Server timestamp of the state.
+        """
+        super(MMOSSDisplayableObject, self).setDynamics(timestamp, x, y, 
+            vx, vy, a, r, rr)
+        self.recordState()
+
+    def recordState(self):
+        """Buffer the current state for playback. States must be recorded 
+        in time order; one that is older than the newest is ignored.
+        """
+        history = self.history
+        if history and history[-1][0] >= self.timestamp:
+            return
+        X = self.X
+        V = self.V
+        history.append((self.timestamp, X[0], X[1], V[0], V[1], self.a,
+            self.r, self.rr))
+
+    def playback(self, displaytime):
+        """Set the object to the buffered state that applies at a display
+        time: the newest state no later than the display time. Between
+        states the object moves exactly as the server forecast it, so 
+        forecasting from that state interpolates between the two. States
+        older than the one used are discarded.
+        
+        :param displaytime: Time at which the object will be displayed.
+        :returns: False if no state applies yet (every buffered state is
+                  later than the display time), so the object should not
+                  be displayed.
+        """
+        history = self.history
+        if not history:
+            return False
+        while len(history) > 1 and history[1][0] <= displaytime:
+            history.popleft()
+        state = history[0]
+        if state[0] > displaytime:
+            return False
+        if state[0] != self.timestamp:
+            MMOSSObject.setDynamics(self, *state)
+        return True
+
+    def screenExtent(self):
+        """Find how far from its centre the object may be drawn: half the
+        diagonal of its image (which covers any rotation of the image), or
+        its radius if that is larger or it has no image.
+        
+        :returns: Distance in pixels.
+        """
+        if self.image is None:
+            return self.radius
+        return max(self.radius, math.hypot(self.image.get_width(), 
+            self.image.get_height()) / 2)
+
     def displaySingleObject(self, displaytime, screen):
         """Write a single image to the screen. This must be overridden 
         by the inheriting class!
@@ -434,11 +559,13 @@ class MMOSSSolid(MMOSSObject):
         P1 = Parametric(self.X, self.V)
         P2 = Parametric(othersolid.Xclosest, othersolid.V)
         # compute collision based on the instant the objects would have touched
-        collisiontimes = P1.timeatdistance(P2, self.radius + othersolid.radius)
+        collisiontimes = [t.real for t in 
+            P1.timeatdistance(P2, self.radius + othersolid.radius) 
+            if t.imag == 0]
         if len(collisiontimes) > 0:
             tcollision = min(collisiontimes)
             self.updateCurrentState(servertime + tcollision)
-            otheroldX = othersolid.X
+            otheroldX = othersolid.X.copy()
             othersolid.updateCurrentState(servertime + tcollision)
             # tweak the Xclosest vector to match
             othersolid.Xclosest = othersolid.Xclosest + othersolid.X - otheroldX
@@ -582,6 +709,8 @@ class MMOSSShip(MMOSSSolid):
         self.shootv = 0.0
         self.shoote = 0.0
         self.fuelouttime = 1E3000
+        # sequence number of the last control command processed (server)
+        self.lastsequence = 0
 
     def forecastFuel(self, deltat):
         """Calculate fuel levels for some time after last update.
@@ -633,6 +762,16 @@ class MMOSSShip(MMOSSSolid):
         self.slevel = self.slevel - SHIPKEFACTOR * self.mass * deltav ** 2
         self.isalive = self.slevel >= 0.0
 
+    def setDynamics(self, timestamp, x, y, vx, vy, a, r, rr):
+        """Set server-determined info in an existing ship. The thrust and 
+        fuel use rate follow from the acceleration.
+        
+        :param timestamp: Server timestamp of the state.
+        """
+        super(MMOSSShip, self).setDynamics(timestamp, x, y, vx, vy, a, r, rr)
+        self.thrust = self.a * self.mass / ACCEL
+        self.fuserate = abs(self.thrust) * FUELUSERATE
+
     def updateFuel(self, wlevel, flevel, slevel):
         """Update the ship fuel levels.
         
@@ -708,15 +847,48 @@ class MMOSSShip(MMOSSSolid):
 class MMOSSFactory(object):
     """The factory class is responsible for instantiating game objects
     of various types, in response to messages from the server.
+
+    The classes are looked up in a registry keyed by (objecttype, 
+    displayable) that is shared by all factories. It is rebuilt when 
+    a new MMOSSObject subclass has been defined since it was last built
+    (see MMOSSObjectType).
     """
 
+    registry = {}
+    """Usable classes keyed by (objecttype, displayable)."""
+
+    generation = -1
+    """MMOSSObjectType.generation when the registry was built."""
+
+    prototypes = {}
+    """Default constructed object of each class, with the names of its 
+    mutable attributes, keyed by class (see buildState)."""
+
+    STATEKEYWORDS = frozenset(['client', 'gamedimensions', 'objectname'])
+    """Keywords that buildState can set as plain attributes of a copied 
+    prototype. Any other keyword goes through the constructor."""
+
     def __init__(self):
-        """Build list of object classes that ARE and ARE NOT displayable.
+        """Build the registry of object classes that ARE and ARE NOT 
+        displayable, unless it is up to date.
+        """
+        self.refresh()
+
+    def refresh(self):
+        """Rebuild the registry if subclasses have been defined since it was
+        last built.
         """
-        self.notdisplayableclasses = self.getUsableSubclasses(
-            MMOSSObject, False)
-        self.displayableclasses = self.getUsableSubclasses(
-            MMOSSObject, True)
+        cls = MMOSSFactory
+        if cls.generation != MMOSSObjectType.generation:
+            registry = {}
+            for displayable in [False, True]:
+                # the first class found for a type wins
+                for usable in self.getUsableSubclasses(MMOSSObject, 
+                    displayable):
+                    registry.setdefault((usable.OBJECTTYPE, displayable),
+                        usable)
+            cls.registry = registry
+            cls.generation = MMOSSObjectType.generation
 
     def getUsableSubclasses(self, parent, displayable):
         """Recursive function walks the inheritance tree looking for 
@@ -729,13 +901,78 @@ class MMOSSFactory(object):
         """
         usable = []
         for cls in parent.__subclasses__():
-            if "OBJECTTYPE" not in dir(cls) or (
-            displayable and ("displayObject" not in dir(cls))):
+            if not hasattr(cls, "OBJECTTYPE") or (
+            displayable and not hasattr(cls, "displayObject")):
                 usable.extend(self.getUsableSubclasses(cls, displayable))
             else:
                 usable.append(cls)
         return usable
 
+    def getClass(self, objecttype, displayable):
+        """Look up the class to instantiate for an object type.
+        
+        :param objecttype: Text identification of class.
+        :param displayable: True if must be able to be drawn (client side)
+        :returns: The class, or None if there is none.
+        """
+        if MMOSSFactory.generation != MMOSSObjectType.generation:
+            self.refresh()
+        return MMOSSFactory.registry.get((objecttype, displayable))
+
+    def buildState(self, objecttype, displayable, objectid, timestamp, x, y,
+        vx, vy, a, r, rr, **kwargs):
+        """Instantiate an object from a state update (the common case on 
+        the client). Same as buildObject with the type and state passed
+        directly. The constructors are not run: a default constructed 
+        prototype of the class is copied (its containers and arrays are
+        copied too) and the state is set with setDynamics. Keywords other 
+        than STATEKEYWORDS fall back to the constructor.
+        
+        :param objecttype: Text identification of class.
+        :param displayable: True if must be able to be drawn (client side)
+        :param objectid: Numeric ID of object.
+        :param timestamp: Server timestamp of the state.
+        :param x: X coordinate of position.
+        :param y: Y coordinate of position.
+        :param vx: X component of velocity.
+        :param vy: Y component of velocity.
+        :param a: Axial acceleration.
+        :param r: Direction object is pointing (radians, zero right).
+        :param rr: Rotational rate of object (radians per second).
+        :returns: the instantiated object (None if the type is unknown).
+        """
+        cls = self.getClass(objecttype, displayable)
+        if cls is None:
+            return None
+        if not self.STATEKEYWORDS.issuperset(kwargs):
+            return cls(objectid=objectid, timestamp=timestamp, x=x, y=y, 
+                vx=vx, vy=vy, a=a, r=r, rr=rr, **kwargs)
+        prototype = MMOSSFactory.prototypes.get(cls)
+        if prototype is None:
+            prototype = self.buildPrototype(cls)
+        prototype, mutables = prototype
+        obj = cls.__new__(cls)
+        state = obj.__dict__
+        state.update(prototype.__dict__)
+        for name in mutables:
+            state[name] = copy(state[name])
+        state.update(kwargs)
+        obj.objectid = objectid
+        obj.setDynamics(timestamp, x, y, vx, vy, a, r, rr)
+        return obj
+
+    def buildPrototype(self, cls):
+        """Default construct the prototype of a class for buildState.
+        
+        :param cls: Class to instantiate.
+        :returns: Tuple of (prototype, names of the attributes that must be 
+                  copied rather than shared).
+        """
+        prototype = cls()
+        mutables = [name for name, value in prototype.__dict__.iteritems()
+            if isinstance(value, (list, dict, set, deque, ndarray))]
+        MMOSSFactory.prototypes[cls] = (prototype, mutables)
+        return prototype, mutables
 
     def buildObject(self, *args, **kwargs):
         """Instantiate an object that is descended from the MMOSSObject class.
@@ -781,15 +1018,10 @@ class MMOSSFactory(object):
         
         :returns: the instantiated object.
         """
-        objecttype = kwargs.pop('objecttype', '')
-        displayable = kwargs.pop('displayable', False)
-        if displayable:
-            classes = self.displayableclasses
-        else:
-            classes = self.notdisplayableclasses
-        for cls in classes:
-            if cls.OBJECTTYPE == objecttype:
-                return cls(*args, **kwargs)
+        cls = self.getClass(kwargs.pop('objecttype', ''), 
+            kwargs.pop('displayable', False))
+        if not cls is None:
+            return cls(*args, **kwargs)
 
 
         
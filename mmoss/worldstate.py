@@ -0,0 +1,242 @@
+"""
+mMOSS moderately Multiplayer Online Side Scroller
+
+The worldstate module keeps the dynamic state of many game objects in
+contiguous Numpy arrays (one slot per object) so that the server can forecast
+every object position for a poll cycle in a single vectorized pass.
+
+Classes defined:
+
+#. :class:`WorldStateField` - Descriptor for a dynamic object attribute.
+#. :class:`WorldState` - Struct-of-arrays store for object dynamics.
+
+Copyright (c) 2011 by Eric Dennison.  All rights reserved.
+"""
+from __future__ import division
+from numpy import array, zeros, concatenate, column_stack, cos, sin, newaxis, \
+    ndarray
+
+__author__ = "Eric Dennison"
+
+CAPACITY = 256
+"""Initial number of object slots (the store doubles when full)."""
+
+
+class WorldStateField(object):
+    """Descriptor for a dynamic attribute of an MMOSSObject. The value lives
+    in the object itself until the object is attached to a :class:`WorldState`,
+    after which the object is a thin view onto its slot.
+
+    Vector values of attached objects are views onto the slot, so that in
+    place writes (e.g. obj.X[0] = x) reach the store. A caller that keeps an
+    old position across a change of state (e.g. updateCurrentState) must 
+    copy it.
+    """
+
+    def __init__(self, name, vector=False):
+        """Create a field descriptor.
+
+        :param name: Name of the attribute and of the WorldState array.
+        :param vector: True if the attribute is a 2-element Numpy array.
+        """
+        self.name = name
+        self.local = '_' + name
+        self.vector = vector
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        world = obj.world
+        if world is None:
+            return obj.__dict__[self.local]
+        value = getattr(world, self.name)[obj.slot]
+        if self.vector:
+            return value
+        return float(value)
+
+    def __set__(self, obj, value):
+        world = obj.world
+        if world is None:
+            obj.__dict__[self.local] = value
+        else:
+            getattr(world, self.name)[obj.slot] = value
+
+
+class WorldState(object):
+    """Struct-of-arrays store for the dynamic state of game objects. Each
+    attached object owns one slot in the X, V, a, r, rr, timestamp and radius
+    arrays.
+
+    :param gamedimensions: Tuple representing (W,H) dimensions of game.
+    :param capacity: Initial number of slots.
+    """
+
+    FIELDS = ('X', 'V', 'a', 'r', 'rr', 'timestamp', 'radius')
+
+    def __init__(self, gamedimensions, capacity=CAPACITY):
+        self.gamedimensions = array(gamedimensions, dtype=float)
+        self.capacity = 0
+        self.objects = []
+        self.freeslots = []
+        self.live = zeros(0, dtype=bool)
+        self.X = zeros((0, 2))
+        self.V = zeros((0, 2))
+        self.a = zeros(0)
+        self.r = zeros(0)
+        self.rr = zeros(0)
+        self.timestamp = zeros(0)
+        self.radius = zeros(0)
+        self.Xcache = zeros((0, 2))
+        self.Vcache = zeros((0, 2))
+        self.rcache = zeros(0)
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        """Enlarge all arrays to a new number of slots.
+
+        :param capacity: New number of slots.
+        """
+        extra = capacity - self.capacity
+        for name in self.FIELDS + ('Xcache', 'Vcache', 'rcache'):
+            old = getattr(self, name)
+            setattr(self, name,
+                concatenate((old, zeros((extra,) + old.shape[1:]))))
+        self.live = concatenate((self.live, zeros(extra, dtype=bool)))
+        self.objects.extend([None] * extra)
+        # pop() hands out the lowest free slot first
+        self.freeslots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def attach(self, obj):
+        """Move the dynamic state of an object into a slot.
+
+        :param obj: Reference to an MMOSSObject.
+        """
+        if obj.world is self:
+            return
+        values = [getattr(obj, name) for name in self.FIELDS]
+        if not self.freeslots:
+            self._grow(2 * self.capacity)
+        slot = self.freeslots.pop()
+        self.live[slot] = True
+        self.objects[slot] = obj
+        obj.world, obj.slot = self, slot
+        for name, value in zip(self.FIELDS, values):
+            setattr(obj, name, value)
+
+    def detach(self, obj):
+        """Move the dynamic state of an object out of its slot and free the
+        slot. The object keeps working on its own.
+
+        :param obj: Reference to an MMOSSObject.
+        """
+        if obj.world is not self:
+            return
+        # vector values are views onto the slot, which is about to be reused
+        values = [value.copy() if isinstance(value, ndarray) else value
+            for value in [getattr(obj, name) for name in self.FIELDS]]
+        slot = obj.slot
+        obj.world, obj.slot = None, None
+        for name, value in zip(self.FIELDS, values):
+            setattr(obj, name, value)
+        self.live[slot] = False
+        self.objects[slot] = None
+        self.freeslots.append(slot)
+
+    def forecastRates(self, timestamp, slots):
+        """Vectorized version of MMOSSObject.forecastRates.
+
+        :param timestamp: Time to forecast to.
+        :param slots: Array of slot indices.
+        :returns: Velocity array.
+        """
+        deltat = timestamp - self.timestamp[slots]
+        a = self.a[slots]
+        r = self.r[slots]
+        rr = self.rr[slots]
+        V = self.V[slots]
+        spinning = rr != 0.0
+        thrusting = ~spinning & (a != 0.0)
+        if spinning.any():
+            dt = deltat[spinning]
+            sr = r[spinning]
+            srr = rr[spinning]
+            Temp = column_stack((sin(srr * dt + sr) - sin(sr),
+                                 -cos(srr * dt + sr) + cos(sr)))
+            V[spinning] += (a[spinning] / srr)[:, newaxis] * Temp
+        if thrusting.any():
+            at = a[thrusting] * deltat[thrusting]
+            tr = r[thrusting]
+            V[thrusting] += column_stack((at * cos(tr), at * sin(tr)))
+        return V
+
+    def forecastPositions(self, timestamp, slots):
+        """Vectorized version of MMOSSObject.forecastPosition.
+
+        :param timestamp: Time to forecast to.
+        :param slots: Array of slot indices.
+        :returns: Tuple of (wrapped position array, rotation array).
+        """
+        deltat = timestamp - self.timestamp[slots]
+        a = self.a[slots]
+        r = self.r[slots]
+        rr = self.rr[slots]
+        X = self.X[slots] + self.V[slots] * deltat[:, newaxis]
+        spinning = rr != 0.0
+        thrusting = ~spinning & (a != 0.0)
+        if spinning.any():
+            dt = deltat[spinning]
+            sr = r[spinning]
+            srr = rr[spinning]
+            Temp = column_stack((
+                (-cos(srr * dt + sr) + cos(sr)) / srr - sin(sr) * dt,
+                (-sin(srr * dt + sr) + sin(sr)) / srr + cos(sr) * dt))
+            X[spinning] += (a[spinning] / srr)[:, newaxis] * Temp
+        if thrusting.any():
+            half = 0.5 * a[thrusting] * deltat[thrusting] ** 2
+            tr = r[thrusting]
+            X[thrusting] += column_stack((half * cos(tr), half * sin(tr)))
+        return X % self.gamedimensions, r + rr * deltat
+
+    def cachePositions(self, timestamp):
+        """Vectorized MMOSSObject.cachePosition for every attached object.
+        The results are kept in the Xcache and rcache arrays and published
+        to the Xcache, rcache and Xcachelist attributes of each object. The
+        current velocities are kept in the Vcache array.
+
+        :param timestamp: Current server time.
+        """
+        slots = self.live.nonzero()[0]
+        if not len(slots):
+            return
+        Xcache, rcache = self.forecastPositions(timestamp, slots)
+        self.Xcache[slots] = Xcache
+        self.Vcache[slots] = self.forecastRates(timestamp, slots)
+        self.rcache[slots] = rcache
+        # edge positions
+        W, H = self.gamedimensions
+        radius = self.radius[slots]
+        top = H - Xcache[:, 1] < radius
+        bottom = Xcache[:, 1] < radius
+        right = W - Xcache[:, 0] < radius
+        left = Xcache[:, 0] < radius
+        edge = (top | bottom | right | left).tolist()
+        objects = self.objects
+        for i, slot in enumerate(slots.tolist()):
+            obj = objects[slot]
+            X = Xcache[i]
+            obj.Xcache = X
+            obj.rcache = rcache[i]
+            if not edge[i]:
+                obj.Xcachelist = [X]
+                continue
+            Xlist = [X]
+            if top[i]:
+                Xlist.append(X - array([0, H]))
+            if bottom[i]:
+                Xlist.append(X + array([0, H]))
+            if right[i]:
+                Xlist.append(X - array([W, 0]))
+            if left[i]:
+                Xlist.append(X + array([W, 0]))
+            obj.Xcachelist = Xlist